@@ -0,0 +1,118 @@
+"""
+Measures the cost of the per-row read checks of a listing page, with the
+access decision cache disabled, scoped to the request, and shared across
+requests through redis.
+
+    paster script production.ini scripts/benchmark_access.py -- \
+        p myproject tickets --user someone --rows 25 --pages 20
+
+"""
+import argparse
+import time
+
+from pylons import app_globals as g, tmpl_context as c
+
+from vulcanforge.artifact.util import iter_artifact_classes
+from vulcanforge.auth.model import User
+from vulcanforge.project.model import Project
+
+
+class ScriptException(Exception):
+    pass
+
+
+MODES = (
+    ('uncached', False, False),
+    ('request', True, False),
+    ('shared', True, True),
+)
+
+
+def load_rows(app_config, limit):
+    rows = []
+    for a_cls in iter_artifact_classes():
+        if len(rows) >= limit:
+            break
+        rows.extend(a_cls.query.find(
+            {'app_config_id': app_config._id}).limit(limit - len(rows)))
+    return rows
+
+
+def run_pages(rows, user, page_size):
+    """Check read access on each row, one simulated request per page"""
+    durations = []
+    for start in range(0, len(rows), page_size):
+        # a new request starts with empty credentials
+        g.security.credentials.clear()
+        began = time.time()
+        for artifact in rows[start:start + page_size]:
+            g.security.has_access(artifact, 'read', user=user)
+        durations.append(time.time() - began)
+    return durations
+
+
+def main(args):
+    project_path = "/{}/{}".format(args.neighborhood, args.project)
+    project, extra = Project.by_url_path(project_path)
+    if project is None:
+        raise ScriptException("No such project: " + project_path)
+    app_config = project.app_config(args.mount_point)
+    if app_config is None:
+        raise ScriptException("No such tool: " + args.mount_point)
+    if args.user:
+        user = User.by_username(args.user)
+        if user is None:
+            raise ScriptException("No such user: " + args.user)
+    else:
+        user = User.anonymous()
+    c.user = user
+
+    rows = load_rows(app_config, args.rows * args.pages)
+    if not rows:
+        raise ScriptException("No artifacts in " + args.mount_point)
+    print "Checking read access on {} artifacts, {} per page".format(
+        len(rows), args.rows)
+
+    security = g.security
+    settings = (security.access_cache, security.shared_access_cache)
+    try:
+        for name, enabled, shared in MODES:
+            if shared and not g.cache:
+                continue
+            security.access_cache = enabled
+            security.shared_access_cache = shared
+            security.invalidate_access_cache()
+            security.reset_access_cache_stats()
+            # the first pass warms the mongo session and the shared cache
+            run_pages(rows, user, args.rows)
+            security.reset_access_cache_stats()
+            durations = run_pages(rows, user, args.rows)
+            stats = security.access_cache_stats()
+            print ("{:>9}: {:8.2f} ms/page, {:6.3f} ms/row, "
+                   "hits {hits}, shared hits {shared_hits}, "
+                   "misses {misses}").format(
+                name,
+                1000 * sum(durations) / len(durations),
+                1000 * sum(durations) / len(rows),
+                **stats)
+    finally:
+        security.access_cache, security.shared_access_cache = settings
+        security.reset_access_cache_stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the access decision cache on a tool listing'
+    )
+    parser.add_argument('neighborhood')
+    parser.add_argument('project')
+    parser.add_argument('mount_point')
+    parser.add_argument('--user', default=None,
+                        help='username to check access for (anonymous)')
+    parser.add_argument('--rows', type=int, default=25,
+                        help='rows per listing page')
+    parser.add_argument('--pages', type=int, default=20,
+                        help='number of pages to check')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,81 @@
+"""
+Measures building the master navigation data of a user: cold (every
+fragment rebuilt), after a change to one of the user's projects, after a
+change to the user's memberships, and warm.
+
+    paster script production.ini scripts/benchmark_navdata.py -- \
+        --user someone --runs 10
+
+Use a user who is a member of many projects (say 500) to see the cost of
+the per-project fragments. Cold runs bump the global navdata version, which
+orphans the cached navdata of every user.
+
+"""
+import argparse
+import time
+
+from pylons import app_globals as g, tmpl_context as c
+
+from vulcanforge.auth.model import User
+from vulcanforge.common.controllers.rest import WebAPIController
+from vulcanforge.project import navdata
+from vulcanforge.project.model import Project
+
+
+class ScriptException(Exception):
+    pass
+
+
+def timed(controller, runs, before=None):
+    durations = []
+    result = None
+    for i in range(runs):
+        if before is not None:
+            before()
+        # a new request starts with empty credentials
+        g.security.credentials.clear()
+        began = time.time()
+        result = controller.navdata()
+        durations.append(time.time() - began)
+    return durations, result
+
+
+def main(args):
+    if not g.cache:
+        raise ScriptException("navdata is only cached with redis.host set")
+    user = User.by_username(args.user)
+    if user is None:
+        raise ScriptException("No such user: " + args.user)
+    c.user = user
+    controller = WebAPIController()
+
+    durations, result = timed(controller, 1, navdata.bump_global)
+    projects = [p for hood in result['hoods'] for p in hood['children']]
+    if not projects:
+        raise ScriptException(args.user + " is not a member of any project")
+    print "{} is a member of {} projects in {} neighborhoods".format(
+        args.user, len(projects), len(result['hoods']))
+    project = Project.query_get(shortname=projects[-1]['shortname'])
+
+    for name, before in (
+            ('cold', navdata.bump_global),
+            ('project', lambda: navdata.bump_project(project._id)),
+            ('member', lambda: navdata.bump_user(user._id)),
+            ('warm', None)):
+        durations, result = timed(controller, args.runs, before)
+        print "{:>8}: {:8.2f} ms avg, {:8.2f} ms min".format(
+            name,
+            1000 * sum(durations) / len(durations),
+            1000 * min(durations))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks building the master navigation data')
+    parser.add_argument('--user', required=True,
+                        help='username to build the navigation data of')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='builds measured in each mode')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,101 @@
+"""
+Measures global searches: solr requests and latency per search, with the
+facet counts of the searching user cold and cached.
+
+    paster script production.ini scripts/benchmark_search.py -- \
+        --q "some words" --user someone --runs 20
+
+Searches as anonymous without --user. Facet counts are only cached for
+users without project roles, so a project member's searches stay in the
+cold mode. Run against a local solr with an index of realistic size;
+the mock solr (solr.mock = true) counts requests but has no filter query or
+facet support, so finds nothing.
+
+"""
+import argparse
+import time
+
+from pylons import app_globals as g, tmpl_context as c
+
+from vulcanforge.auth.model import User
+from vulcanforge.search import controllers
+from vulcanforge.search.controllers import SearchController
+
+ROW = "{:>8}: {:4.1f} requests, {:8.2f} ms avg, {:8.2f} ms min"
+
+
+class ScriptException(Exception):
+    pass
+
+
+class CountingSolr(object):
+    """Proxy of a solr client counting its search requests"""
+
+    def __init__(self, solr):
+        self.solr = solr
+        self.requests = 0
+
+    def search(self, q, **kw):
+        self.requests += 1
+        return self.solr.search(q, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.solr, name)
+
+
+def timed(controller, solr, args, before=None):
+    durations = []
+    requests = 0
+    result = None
+    for i in range(args.runs):
+        if before is not None:
+            before()
+        # a new request starts with empty credentials
+        g.security.credentials.clear()
+        solr.requests = 0
+        began = time.time()
+        result = controller.search(q=args.q, limit=args.limit)
+        durations.append(time.time() - began)
+        requests += solr.requests
+    return durations, float(requests) / args.runs, result
+
+
+def main(args):
+    if args.user:
+        c.user = User.by_username(args.user)
+        if c.user is None:
+            raise ScriptException("No such user: " + args.user)
+    else:
+        c.user = User.anonymous()
+    solr = CountingSolr(g.search.solr)
+    g.search.solr = solr
+    controller = SearchController()
+    try:
+        durations, requests, result = timed(controller, solr, args)
+        print "{} results of {} types for {!r}".format(
+            result['count'], len(result['types']), args.q)
+        for name, before in (
+                ('cold', lambda: controllers.facet_cache().clear()),
+                ('cached', None)):
+            durations, requests, result = timed(controller, solr, args, before)
+            print ROW.format(
+                name,
+                requests,
+                1000 * sum(durations) / len(durations),
+                1000 * min(durations))
+    finally:
+        g.search.solr = solr.solr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks global search requests')
+    parser.add_argument('--q', required=True, help='query to search for')
+    parser.add_argument('--user', help='username to search as')
+    parser.add_argument('--limit', type=int, default=25,
+                        help='results per page')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='searches measured in each mode')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,112 @@
+"""
+Compares redis connections, memory and fan-out time of websocket
+subscriptions made with one redis PubSub per connection against the shared
+PubSubHub of the websocket server.
+
+    python scripts/benchmark_websocket_hub.py --connections 2000
+
+Each mode runs in its own process so memory figures are not mixed.
+
+"""
+import gevent
+import gevent.monkey
+
+gevent.monkey.patch_all(dns=False)
+import argparse
+import os
+import resource
+import time
+from multiprocessing import Process
+
+import redis
+
+from vulcanforge.websocket.hub import PubSubHub
+
+
+def rss_kb():
+    with open('/proc/self/statm') as fp:
+        pages = int(fp.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def connected_clients(client):
+    return client.info()['connected_clients']
+
+
+def make_direct(client, count, channels):
+    subscriptions = []
+    for i in range(count):
+        pubsub = client.pubsub()
+        pubsub.subscribe(['system'] + channels)
+        subscriptions.append(pubsub)
+    return subscriptions
+
+
+def make_hub(client, count, channels):
+    hub = PubSubHub(client, queue_size=10000)
+    subscriptions = []
+    for i in range(count):
+        subscription = hub.subscription()
+        subscription.subscribe(['system'] + channels)
+        subscriptions.append(subscription)
+    return subscriptions
+
+
+def run(mode, args):
+    client = redis.Redis(host=args.host, port=args.port, db=args.db,
+                         max_connections=args.connections + 10)
+    channel = 'benchmark.{}'.format(os.getpid())
+    clients_before = connected_clients(client)
+    rss_before = rss_kb()
+
+    factory = make_hub if mode == 'hub' else make_direct
+    subscriptions = factory(client, args.connections, [channel])
+    received = [0]
+    expected = args.connections * args.messages
+
+    def consume(subscription):
+        for message in subscription.listen():
+            if message['type'] == 'message':
+                received[0] += 1
+
+    greenlets = [gevent.spawn(consume, s) for s in subscriptions]
+    gevent.sleep(1)  # let the subscriptions settle
+
+    publisher = redis.Redis(host=args.host, port=args.port, db=args.db)
+    start = time.time()
+    for i in range(args.messages):
+        publisher.publish(channel, 'message {}'.format(i))
+    while received[0] < expected and time.time() - start < args.timeout:
+        gevent.sleep(0.01)
+    duration = time.time() - start
+
+    print ("{:>6}: {:6d} redis connections, {:8d} KB rss, "
+           "{:8d}/{} deliveries in {:.2f}s").format(
+        mode,
+        connected_clients(publisher) - clients_before - 1,
+        rss_kb() - rss_before,
+        received[0], expected, duration)
+    gevent.killall(greenlets)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the websocket pub/sub hub')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--connections', type=int, default=1000,
+                        help='simulated websocket connections')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='messages published to every connection')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for all deliveries')
+    args = parser.parse_args()
+    for mode in ('direct', 'hub'):
+        process = Process(target=run, args=(mode, args))
+        process.start()
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
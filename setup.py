@@ -112,6 +112,7 @@ setup(
     run_migrations = vulcanforge.command.migration:MigrationCommand
     models = vulcanforge.command:ShowModelsCommand
     reindex = vulcanforge.command:ReindexCommand
+    reindex_parallel = vulcanforge.command:ParallelReindexCommand
     reindex_globals = vulcanforge.command:ReindexGlobalsCommand
     reindex_notifications = vulcanforge.command:ReindexNotifications
     reindex_exchange = vulcanforge.command:ReindexExchangeCommand
@@ -146,6 +147,7 @@ setup(
     turn_fail_whale_on = vulcanforge.command.fail_whale:TurnFailWhaleOnCommand
     turn_fail_whale_off = vulcanforge.command.fail_whale:TurnFailWhaleOffCommand
     scan-files = vulcanforge.command.virus_scan:ScanFiles
+    reconcile-counters = vulcanforge.command.counters:ReconcileCountersCommand
 
     [easy_widgets.engines]
     jinja = vulcanforge.config.render.jinja:JinjaEngine
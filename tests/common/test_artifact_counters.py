@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_artifact_counters
+"""
+import unittest
+import mock
+
+import ming
+from bson import ObjectId
+from ming import schema as S
+from ming.odm import FieldProperty, ThreadLocalODMSession
+from ming.odm.declarative import MappedClass
+
+from vulcanforge.common.model.session import (
+    ArtifactSessionExtension,
+    VFSessionExtension
+)
+from vulcanforge.project.model.project import count_members
+
+INCREMENT = 'vulcanforge.artifact.model.ArtifactCounter.increment'
+
+
+class CounterSessionExtension(ArtifactSessionExtension):
+    """The counters of ArtifactSessionExtension, without its indexing"""
+
+    def after_flush(self, obj=None):
+        self.update_counters()
+        VFSessionExtension.after_flush(self, obj)
+
+
+counted_doc_session = ming.Session()
+counted_orm_session = ThreadLocalODMSession(
+    doc_session=counted_doc_session,
+    extensions=[CounterSessionExtension])
+
+
+class AppConfig(object):
+    project_id = ObjectId()
+
+
+class CountedArtifact(MappedClass):
+
+    class __mongometa__:
+        name = 'counted_artifact'
+        session = counted_orm_session
+
+    counted = True
+    app_config = AppConfig()
+
+    _id = FieldProperty(S.ObjectId)
+    app_config_id = FieldProperty(S.ObjectId)
+    deleted = FieldProperty(bool, if_missing=False)
+    text = FieldProperty(str, if_missing='')
+
+    @classmethod
+    def counter_values(cls, doc):
+        if not doc or doc.get('deleted'):
+            return {}
+        return {'all': 1}
+
+
+def counted(increment):
+    return sum(call[1].get('all', 0) for call in increment.call_args_list)
+
+
+class ArtifactCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        counted_doc_session.bind = ming.create_datastore('mim://')
+        counted_orm_session.clear()
+        self.app_config_id = ObjectId()
+
+    def tearDown(self):
+        counted_orm_session.clear()
+
+    def test_create_then_update(self):
+        with mock.patch(INCREMENT) as increment:
+            artifact = CountedArtifact(app_config_id=self.app_config_id)
+            counted_orm_session.flush()
+            artifact.text = 'edited'
+            counted_orm_session.flush()
+        self.assertEqual(counted(increment), 1)
+
+    def test_delete_then_update(self):
+        artifact = CountedArtifact(app_config_id=self.app_config_id)
+        counted_orm_session.flush()
+        counted_orm_session.clear()
+        with mock.patch(INCREMENT) as increment:
+            artifact = CountedArtifact.query.get(_id=artifact._id)
+            artifact.deleted = True
+            counted_orm_session.flush()
+            artifact.text = 'edited'
+            counted_orm_session.flush()
+            self.assertEqual(counted(increment), -1)
+            artifact.deleted = False
+            counted_orm_session.flush()
+        self.assertEqual(counted(increment), 0)
+
+
+class RoleState(object):
+
+    def __init__(self, original_document):
+        self.original_document = original_document
+        self.extra_state = {}
+
+
+class MemberCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = ObjectId()
+        self.member = {'user_id': ObjectId(), 'roles': [ObjectId()]}
+
+    def test_create_then_update(self):
+        state = RoleState({})
+        with mock.patch(INCREMENT) as increment:
+            count_members(self.project_id, state, self.member)
+            count_members(self.project_id, state, dict(self.member, x=1))
+        self.assertEqual(counted(increment), 1)
+
+    def test_leave_then_delete(self):
+        state = RoleState(self.member)
+        with mock.patch(INCREMENT) as increment:
+            count_members(self.project_id, state, dict(self.member, roles=[]))
+            count_members(self.project_id, state, None)
+        self.assertEqual(counted(increment), -1)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_highlight
+"""
+import itertools
+import unittest
+import mock
+
+from vulcanforge.config.render.highlight import Highlighter, LexerMemo
+
+
+class DictCache(dict):
+
+    def get(self, name):
+        return dict.get(self, name)
+
+    def set(self, name, value, expiration=None):
+        self[name] = value
+
+
+class LexerMemoTestCase(unittest.TestCase):
+
+    def test_memoized_by_extension(self):
+        memo = LexerMemo()
+        lexer = memo.for_filename('a/b.py')
+        self.assertIs(memo.for_filename('c.py'), lexer)
+        self.assertIsNone(memo.for_filename('c.not-a-language'))
+
+    def test_named_files(self):
+        memo = LexerMemo()
+        self.assertEqual(memo.for_filename('CMakeLists.txt').name, 'CMake')
+        self.assertNotEqual(memo.for_filename('notes.txt').name, 'CMake')
+
+
+class HighlighterTestCase(unittest.TestCase):
+
+    options = dict(cssclass='codehilite', linenos='inline')
+    text = u'\n'.join(u'x_{} = {}'.format(i, i) for i in range(10)) + u'\n'
+
+    def setUp(self):
+        self.cache = DictCache()
+        self.highlighter = Highlighter(cache=self.cache, chunk_lines=4)
+        self.lexer = self.highlighter.lexers.for_filename('a.py')
+
+    def test_chunks_cached(self):
+        html = self.highlighter.highlight(self.text, self.lexer, **self.options)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(html.count('class="lineno"'), 10)
+        self.assertIn('<span class="lineno">10 </span>', html)
+        again = self.highlighter.highlight(
+            self.text, self.lexer, **self.options)
+        self.assertEqual(again, html)
+        self.assertEqual(self.highlighter.counts['hits'], 3)
+
+    def test_time_budget(self):
+        self.highlighter.time_budget = 0
+        html = self.highlighter.highlight(
+            u'<b>\n' + self.text, self.lexer, **self.options)
+        self.assertEqual(self.cache, {})
+        self.assertEqual(self.highlighter.counts['plain'], 3)
+        self.assertIn('<span class="lineno">1 </span>&lt;b&gt;', html)
+        self.assertIn('<span class="lineno">11 </span>x_9 = 9', html)
+
+    def test_string_across_chunks(self):
+        text = u'a = 1\nb = """\nx = 1\n\ny = 2\n"""\nc = 3\n'
+        html = self.highlighter.highlight(text, self.lexer, **self.options)
+        whole = Highlighter(chunk_lines=1000).highlight(
+            text, self.lexer, **self.options)
+        self.assertEqual(html, whole)
+        self.assertNotIn('<span class="n">y</span>', html)
+
+    def test_slow_text_lexed_in_chunks(self):
+        # every call of time.time is one second later
+        clock = itertools.count()
+        self.highlighter.time_budget = 2.5
+        with mock.patch('time.time', side_effect=lambda: next(clock)):
+            html = self.highlighter.highlight(
+                self.text, self.lexer, **self.options)
+        # the first chunk of the stream, before the deadline
+        self.assertEqual(self.highlighter.counts['plain'], 2)
+        self.assertIn('<span class="n">x_0</span>', html)
+        self.assertIn('<span class="lineno">10 </span>x_9 = 9', html)
+
+        self.highlighter.time_budget = 60
+        html = self.highlighter.highlight(
+            self.text, self.lexer, **self.options)
+        self.assertEqual(self.highlighter.counts['plain'], 2)
+        self.assertIn('<span class="n">x_9</span>', html)
+        # lexed chunk by chunk, and cached by their own content
+        key = self.highlighter.make_key(
+            u'x_8 = 8\nx_9 = 9', self.lexer,
+            dict(self.options, linenostart=9))
+        self.assertIn(key, self.cache)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_smtp
+"""
+import asyncore
+import smtpd
+import threading
+import unittest
+from email.mime.text import MIMEText
+
+from vulcanforge.notification.util import SMTPClient, SMTPConnectionPool
+
+
+class RecordingServer(smtpd.SMTPServer):
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.accepted = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.accepted += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class SMTPClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RecordingServer()
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        self.pool = SMTPConnectionPool(port=self.server.port)
+
+    def tearDown(self):
+        self.pool.close()
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def _serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def _send(self, client, addresses, subject='hi'):
+        return client.sendmail(
+            addresses, 'from@example.com', 'reply@example.com', subject,
+            'msg-id@example.com', None, MIMEText('hello'))
+
+    def test_connection_reused(self):
+        client = SMTPClient(
+            pool=self.pool, batch_size=1, return_path='bounce@example.com')
+        self._send(client, ['a@example.com', 'b@example.com'])
+        self._send(client, ['c@example.com'], subject='again')
+        self.assertEqual(
+            [rcpttos for mailfrom, rcpttos, data in self.server.messages],
+            [['a@example.com'], ['b@example.com'], ['c@example.com']])
+        self.assertIn('To: b@example.com', self.server.messages[1][2])
+        self.assertEqual(self.server.messages[1][2].count('\nTo:'), 1)
+        self.assertEqual(self.server.accepted, 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['reuses'], 1)
+        self.assertEqual(stats['sends'], 3)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['waiting'], 0)
+
+    def test_batch_send(self):
+        client = SMTPClient(
+            pool=self.pool, batch_size=2, return_path='bounce@example.com')
+        addresses = ['a@example.com', 'b@example.com', 'c@example.com']
+        self._send(client, addresses)
+        self.assertEqual(
+            [rcpttos for mailfrom, rcpttos, data in self.server.messages],
+            [['a@example.com', 'b@example.com'], ['c@example.com']])
+        self.assertIn('To: undisclosed-recipients:;',
+                      self.server.messages[0][2])
+        stats = self.pool.stats()
+        self.assertEqual(stats['sends'], 2)
+        self.assertEqual(stats['recipients'], 3)
+
+    def test_reconnect_after_disconnect(self):
+        client = SMTPClient(
+            pool=self.pool, batch_size=1, return_path='bounce@example.com')
+        self._send(client, ['a@example.com'])
+        # the server closes the idle connection
+        for last_used, smtp_client in self.pool._idle:
+            smtp_client.close()
+        self._send(client, ['b@example.com'])
+        self.assertEqual(len(self.server.messages), 2)
+        stats = self.pool.stats()
+        self.assertEqual(stats['connects'], 2)
+        self.assertEqual(stats['discards'], 1)
+        self.assertEqual(stats['open'], 1)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_solr_indexer
+"""
+import unittest
+
+from vulcanforge.search.solr import SolrIndexer
+
+
+class FlakySolr(object):
+
+    def __init__(self):
+        self.fail = False
+        self.added = []
+
+    def add(self, docs, **kw):
+        if self.fail:
+            raise IOError('solr is down')
+        self.added.extend(doc['id'] for doc in docs)
+
+    def delete(self, **kw):
+        if self.fail:
+            raise IOError('solr is down')
+
+
+class SolrIndexerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.solr = FlakySolr()
+        # nothing is sent until flushed
+        self.indexer = SolrIndexer(self.solr, batch_size=10, max_delay=60)
+
+    def tearDown(self):
+        self.solr.fail = False
+
+    def test_failed_background_flush_is_requeued(self):
+        self.indexer.add([{'id': 'a'}, {'id': 'b'}])
+        self.solr.fail = True
+        self.indexer.flush(raise_errors=False)
+        self.assertEqual(self.indexer.pending, 2)
+        self.assertIsNotNone(self.indexer.last_error)
+        self.solr.fail = False
+        self.indexer.flush(raise_errors=False)
+        self.assertEqual(self.solr.added, ['a', 'b'])
+        self.assertEqual(self.indexer.pending, 0)
+        self.assertIsNone(self.indexer.last_error)
+
+    def test_next_producer_sees_background_failure(self):
+        self.indexer.add([{'id': 'a'}])
+        self.solr.fail = True
+        self.indexer.flush(raise_errors=False)
+        with self.assertRaises(IOError):
+            self.indexer.add([{'id': 'b'}])
+        self.assertEqual(self.indexer.pending, 1)
+
+        self.solr.fail = False
+        self.indexer.add([{'id': 'b'}])
+        # the backlog is sent before the new operation is queued
+        self.assertEqual(self.solr.added, ['a'])
+        self.assertEqual(self.indexer.pending, 1)
+        self.assertIsNone(self.indexer.last_error)
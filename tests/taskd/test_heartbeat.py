@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_heartbeat
+"""
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import ming
+from ming.odm import session
+from tg import config
+
+from vulcanforge.common.model.session import main_doc_session
+from vulcanforge.taskd import MonQTask
+from vulcanforge.taskd.worker import TaskdWorker
+
+# the cutoff of `taskd timeout` with its default -t 60
+REAP_AFTER = 60
+
+
+class HeartbeatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._bind = main_doc_session.bind
+        main_doc_session.bind = ming.create_datastore('mim://')
+        self._app_globals = config.get('pylons.app_globals')
+        config['pylons.app_globals'] = object()
+        self.worker = TaskdWorker('test.ini', name='worker-a')
+        self.worker.heartbeat_interval = 0.05
+        self.worker.reap_after = REAP_AFTER
+
+    def tearDown(self):
+        self.worker.stop_heartbeat()
+        main_doc_session.bind = self._bind
+        config['pylons.app_globals'] = self._app_globals
+
+    def busy_task(self, process, claimed_ago, retries=0):
+        claimed = datetime.utcnow() - timedelta(seconds=claimed_ago)
+        task = MonQTask(
+            state='busy', priority=10, result_type='forget',
+            task_name='vulcanforge.taskd.tasks.test', process=process,
+            time_start=claimed, heartbeat=claimed, retries=retries,
+            context=dict(project_id=None, app_config_id=None, user_id=None),
+            args=[], kwargs={})
+        session(task).flush(task)
+        return task
+
+    def reap(self):
+        return MonQTask.reap(
+            datetime.utcnow() - timedelta(seconds=REAP_AFTER))
+
+    def test_busy_task_heartbeated_is_not_reaped(self):
+        # claimed longer ago than the reap cutoff, and still running
+        task = self.busy_task('worker-a', claimed_ago=2 * REAP_AFTER)
+        # a task of a dead worker, given up on rather than requeued
+        dead = self.busy_task('worker-b', claimed_ago=2 * REAP_AFTER,
+                              retries=3)
+        self.worker.in_flight.add(task)
+        self.worker.start_heartbeat()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            session(MonQTask).expunge(task)
+            task = MonQTask.query.get(_id=task._id)
+            if task.heartbeat > task.time_start:
+                break
+            time.sleep(0.05)
+        self.assertGreater(task.heartbeat, task.time_start)
+
+        reaped = self.reap()
+        self.assertEqual([t._id for t in reaped], [dead._id])
+        session(MonQTask).expunge(task)
+        task = MonQTask.query.get(_id=task._id)
+        self.assertEqual(task.state, 'busy')
+        self.assertEqual(task.process, 'worker-a')
+
+    def test_stop_heartbeat(self):
+        self.worker.start_heartbeat()
+        self.assertTrue(self.worker._heartbeat_thread.is_alive())
+        thread = self.worker._heartbeat_thread
+        self.worker.stop_heartbeat()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.worker._heartbeat_thread)
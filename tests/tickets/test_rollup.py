@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_rollup
+
+Needs a mongod on localhost; skipped without one.
+"""
+import unittest
+
+from bson import ObjectId
+from pymongo import MongoClient, monitoring
+from pymongo.errors import ConnectionFailure
+
+from vulcanforge.tools.tickets.model.rollup import (
+    rollup_sums,
+    move_subtree,
+    coerce_sums
+)
+
+FIELDS = ['_estimate', '_hours']
+# tickets per level of a 5-level tree of 1,000 tickets
+LEVELS = [1, 9, 90, 300, 600]
+
+
+class CommandRecorder(monitoring.CommandListener):
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class RollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = CommandRecorder()
+        self.client = MongoClient(serverSelectionTimeoutMS=1000,
+                                  event_listeners=[self.recorder])
+        try:
+            self.client.admin.command('ismaster')
+        except ConnectionFailure:
+            self.skipTest('no mongod on localhost')
+        self.coll = self.client.vulcanforge_test_rollup.ticket
+        self.coll.drop()
+        self.coll.create_index([('app_config_id', 1), ('ancestor_ids', 1)])
+        self.app_config_id = ObjectId()
+        self.levels = []
+        docs = {}
+        for size in LEVELS:
+            parents = self.levels[-1] if self.levels else None
+            level = []
+            for i in range(size):
+                doc = dict(_id=ObjectId(), app_config_id=self.app_config_id,
+                           super_id=None, sub_ids=[], ancestor_ids=[],
+                           custom_fields={'_estimate': 1.5, '_hours': 0.0})
+                if parents:
+                    parent = docs[parents[i % len(parents)]]
+                    doc['super_id'] = parent['_id']
+                    doc['ancestor_ids'] = parent['ancestor_ids'] + [
+                        parent['_id']]
+                    parent['sub_ids'].append(doc['_id'])
+                docs[doc['_id']] = doc
+                level.append(doc['_id'])
+            self.levels.append(level)
+        self.coll.insert_many(docs.values())
+        self.root_id = self.levels[0][0]
+        del self.recorder.commands[:]
+
+    def tearDown(self):
+        self.client.drop_database('vulcanforge_test_rollup')
+        self.client.close()
+
+    def rollup(self):
+        return rollup_sums(self.coll, self.app_config_id, self.root_id, FIELDS)
+
+    def test_one_aggregation_and_one_write(self):
+        changes = self.rollup()
+        self.assertEqual(self.recorder.commands, ['aggregate', 'update'])
+        # every ticket with subtickets
+        self.assertEqual(len(changes), sum(LEVELS[:-1]))
+        root = self.coll.find_one(self.root_id)
+        self.assertEqual(root['custom_fields']['_estimate'], 600 * 1.5)
+        self.assertEqual(root['custom_fields']['_hours'], 0.0)
+        parent = self.coll.find_one(self.levels[3][0])
+        self.assertEqual(parent['custom_fields']['_estimate'],
+                         len(parent['sub_ids']) * 1.5)
+
+    def test_unchanged_sums_not_written(self):
+        self.rollup()
+        del self.recorder.commands[:]
+        self.assertEqual(self.rollup(), {})
+        self.assertEqual(self.recorder.commands, ['aggregate'])
+
+    def test_leaf_change(self):
+        self.rollup()
+        leaf = self.coll.find_one(self.levels[4][0])
+        self.coll.update_one({'_id': leaf['_id']},
+                             {'$set': {'custom_fields._hours': 2.0}})
+        del self.recorder.commands[:]
+        changes = self.rollup()
+        self.assertEqual(self.recorder.commands, ['aggregate', 'update'])
+        self.assertEqual(set(changes), set(leaf['ancestor_ids']))
+        for sums in changes.itervalues():
+            self.assertEqual(sums['_hours'], 2.0)
+
+    def test_move_subtree(self):
+        moved = self.coll.find_one(self.levels[2][0])
+        new_super_id = self.levels[1][-1]
+        self.assertNotIn(new_super_id, moved['ancestor_ids'])
+        new_path = [self.root_id, new_super_id]
+        self.coll.update_one({'_id': moved['_id']}, {'$set': {
+            'super_id': new_super_id, 'ancestor_ids': new_path}})
+        del self.recorder.commands[:]
+        paths = move_subtree(self.coll, self.app_config_id, moved['_id'],
+                             moved['ancestor_ids'], new_path)
+        self.assertEqual(self.recorder.commands, ['find', 'update'])
+        self.assertEqual(len(paths), self.coll.count(
+            {'ancestor_ids': moved['_id']}))
+        for doc in self.coll.find({'ancestor_ids': moved['_id']}):
+            self.assertEqual(doc['ancestor_ids'][:3],
+                             new_path + [moved['_id']])
+
+    def test_string_values(self):
+        numeric, other = self.levels[4][:2]
+        self.coll.update_one({'_id': numeric},
+                             {'$set': {'custom_fields._hours': '2'}})
+        self.coll.update_one({'_id': other},
+                             {'$set': {'custom_fields._hours': 'n/a'}})
+        converted = coerce_sums(
+            self.coll, {'app_config_id': self.app_config_id}, FIELDS)
+        self.assertEqual(converted, 1)
+        doc = self.coll.find_one(numeric)
+        self.assertEqual(doc['custom_fields']['_hours'], 2.0)
+        doc = self.coll.find_one(other)
+        self.assertEqual(doc['custom_fields']['_hours'], 'n/a')
+        self.rollup()
+        root = self.coll.find_one(self.root_id)
+        self.assertEqual(root['custom_fields']['_hours'], 2.0)
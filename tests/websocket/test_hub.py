@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_hub
+"""
+import unittest
+import mock
+from vulcanforge.websocket.hub import PubSubHub
+
+
+class HubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = mock.Mock()
+        self.hub = PubSubHub(self.redis, queue_size=2)
+        self.hub.pubsub = mock.Mock()
+        self.hub.start = mock.Mock()
+
+    def _message(self, channel, data):
+        return {
+            'type': 'message',
+            'pattern': None,
+            'channel': channel,
+            'data': data
+        }
+
+    def _drain(self, subscription):
+        messages = []
+        while not subscription.queue.empty():
+            messages.append(subscription.queue.get_nowait())
+        return messages
+
+    def test_reference_counted_subscriptions(self):
+        sub_1 = self.hub.subscription()
+        sub_2 = self.hub.subscription()
+        sub_1.subscribe(['foo'])
+        sub_2.subscribe(['foo', 'bar'])
+        self.hub.pubsub.subscribe.assert_has_calls([
+            mock.call(['foo']),
+            mock.call(['bar'])
+        ])
+        self.assertEqual(self.hub.pubsub.subscribe.call_count, 2)
+        sub_1.unsubscribe(['foo'])
+        self.assertFalse(self.hub.pubsub.unsubscribe.called)
+        sub_2.close()
+        self.hub.pubsub.unsubscribe.assert_has_calls([
+            mock.call(['foo']),
+            mock.call(['bar'])
+        ], any_order=True)
+        self.assertEqual(self.hub.subscribers, {})
+
+    def test_pinned_channel(self):
+        sub = self.hub.subscription()
+        sub.subscribe(['system'])
+        sub.close()
+        self.assertFalse(self.hub.pubsub.subscribe.called)
+        self.assertFalse(self.hub.pubsub.unsubscribe.called)
+
+    def test_acknowledgements(self):
+        sub = self.hub.subscription()
+        sub.subscribe('foo')
+        sub.unsubscribe()
+        self.assertEqual(self._drain(sub), [
+            {'type': 'subscribe', 'pattern': None, 'channel': 'foo',
+             'data': 1},
+            {'type': 'unsubscribe', 'pattern': None, 'channel': 'foo',
+             'data': 0}
+        ])
+
+    def test_dispatch(self):
+        sub_1 = self.hub.subscription()
+        sub_2 = self.hub.subscription()
+        sub_1.subscribe(['foo'])
+        sub_2.subscribe(['bar'])
+        self._drain(sub_1)
+        self._drain(sub_2)
+        self.hub.dispatch(self._message('foo', 'hi'))
+        self.assertEqual(self._drain(sub_1), [self._message('foo', 'hi')])
+        self.assertEqual(self._drain(sub_2), [])
+
+    def test_slow_connection(self):
+        sub = self.hub.subscription()
+        sub.subscribe(['foo'])
+        self._drain(sub)
+        for data in ('a', 'b', 'c'):
+            self.hub.dispatch(self._message('foo', data))
+        self.assertEqual([m['data'] for m in self._drain(sub)], ['a', 'b'])
+        self.assertEqual(self.hub.counts['dropped'], 1)
+
+    def test_close_ends_listen(self):
+        sub = self.hub.subscription()
+        sub.subscribe(['foo'])
+        self._drain(sub)
+        self.hub.dispatch(self._message('foo', 'hi'))
+        sub.close()
+        self.assertEqual(list(sub.listen()), [])
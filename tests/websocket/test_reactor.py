@@ -307,3 +307,39 @@ class TestAuthBroker(ReactorTestCase):
                 }
             }))
         self.assertFalse(self.mock_redis.rpush.called)
+
+    def test_authorization_cached(self):
+        self.auth.can_listen = set(['foo'])
+        self.auth.authorize = mock.Mock(wraps=self.auth.authorize)
+        message = json.dumps({'subscribe': ['foo']})
+        self.reactor.react(message)
+        self.reactor.react(message)
+        self.assertEqual(self.auth.authorize.call_count, 1)
+        self.assertEqual(self.mock_pubsub.subscribe.call_count, 2)
+
+    def test_authorization_cache_expires(self):
+        self.auth.can_listen = set(['foo'])
+        self.auth.authorize = mock.Mock(wraps=self.auth.authorize)
+        message = json.dumps({'subscribe': ['foo']})
+        self.reactor.react(message)
+        self.reactor.authorized['listen', 'foo'] = 0
+        self.reactor.react(message)
+        self.assertEqual(self.auth.authorize.call_count, 2)
+
+    def test_authorization_cache_cleared(self):
+        self.auth.can_listen = set(['foo'])
+        self.reactor.react(json.dumps({'subscribe': ['foo']}))
+        self.reactor.clear_authorizations()
+        self.auth.can_listen.remove('foo')
+        with self.assertRaises(NotAuthorized):
+            self.reactor.react(json.dumps({'subscribe': ['foo']}))
+
+    def test_authorize_only_uncached(self):
+        self.auth.can_listen = set(['foo', 'bar'])
+        self.auth.authorize = mock.Mock(wraps=self.auth.authorize)
+        self.reactor.react(json.dumps({'subscribe': ['foo']}))
+        self.reactor.react(json.dumps({'subscribe': ['foo', 'bar']}))
+        self.auth.authorize.assert_called_with(
+            listen_channels=set(['bar']),
+            publish_channels=set(),
+            event_targets=set())
@@ -121,6 +121,31 @@ class ConnectionControllerTestCase(unittest.TestCase):
             'data': 'bye'
         })
 
+    def test_speaker_authorization_change(self):
+        msgs = [
+            {
+                'channel': 'user.foo',
+                'data': json.dumps({'type': 'AuthorizationChanged'}),
+                'pattern': None,
+                'type': 'message'
+            },
+            {
+                'channel': 'foo',
+                'data': 'hi',
+                'pattern': None,
+                'type': 'message'
+            }
+        ]
+        self.pubsub.listen.side_effect = self._listen_side_effect(msgs)
+        self.controller.run_speaker()
+        self.reactor.clear_authorizations.assert_called_once_with()
+        self.assertEqual(self.websocket.send.call_count, 1)
+        self.assertDictEqual(json.loads(self.websocket.send.call_args[0][0]), {
+            'type': 'message',
+            'channel': 'foo',
+            'data': 'hi'
+        })
+
     def test_listen_frame_exceptions(self):
         self.websocket.receive = self._raise_on_call(Exception())
         with self.assertRaises(LostConnection):
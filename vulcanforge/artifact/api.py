@@ -46,6 +46,37 @@ class ArtifactAPI(object):
 
         return artifact
 
+    def get_artifacts_by_index_ids(self, index_ids):
+        """
+        Bulk version of get_artifact_by_index_id: one reference query, then
+        one artifact query per class and tool.
+
+        @return: dict mapping index_id to artifact, for those found
+
+        """
+        result = {}
+        remaining = set()
+        for index_id in index_ids:
+            if index_id in result or index_id in remaining:
+                continue
+            artifact = None
+            for regex, func in self.INDEX_ID_EPHEMERALS.iteritems():
+                match = regex.match(index_id)
+                if match:
+                    artifact = func(index_id, match)
+            if artifact is None:
+                remaining.add(index_id)
+            else:
+                result[index_id] = artifact
+        if remaining:
+            refs = ArtifactReference.query.find(
+                {'_id': {'$in': list(remaining)}}).all()
+            for index_id, artifact in ArtifactReference.artifacts_by_id(
+                    refs).iteritems():
+                if artifact is not None:
+                    result[index_id] = artifact
+        return result
+
     def parse_shortlink(self, link):
         """Parse a shortlink into its project/app/artifact parts"""
         link_bracket_match = self.PARSE_SHORTLINK_RE.match(link)
@@ -77,19 +108,23 @@ class ArtifactAPI(object):
         else:
             return None
 
-    def find_shortlink_refs(self, text, **kw):
-        ref_ids = []
+    def find_shortlinks(self, text):
+        """The shortlinks in markdown text, outside of code blocks"""
+        links = []
         # TODO: include markdown extensions in vulcanforge then uncomment
         # fcp = FencedCodeProcessor()
         # converted = fcp.run(text.split('\n'))
         converted = text.split('\n')
         for line in converted:
             if not line.startswith('    '):
-                ref_ids.extend(
-                    self.get_ref_id_by_shortlink(alink.group(1), **kw)
-                    for alink in self.SHORTLINK_RE.finditer(line) if alink
-                )
-        return ref_ids
+                links.extend(alink.group(1)
+                             for alink in self.SHORTLINK_RE.finditer(line))
+        return links
+
+    def find_shortlink_refs(self, text, **kw):
+        links = self.find_shortlinks(text)
+        ref_ids = self.get_ref_ids_by_shortlinks(links, **kw)
+        return [ref_ids.get(link) for link in links]
 
     def get_artifact_by_shortlink(self, shortlink):
         parsed = self.parse_shortlink(shortlink)
@@ -111,20 +146,32 @@ class ArtifactAPI(object):
             return artifact
 
     def get_ref_id_by_shortlink(self, shortlink, upsert=True):
-        parsed = self.parse_shortlink(shortlink)
-        if parsed:
+        return self.get_ref_ids_by_shortlinks(
+            [shortlink], upsert=upsert).get(shortlink)
+
+    def get_ref_ids_by_shortlinks(self, shortlinks, upsert=True):
+        """
+        Resolve shortlinks to the index_ids of their artifacts, with one
+        Shortlink query for all of them.
+
+        @return: dict mapping each parseable shortlink to its ref_id or None
+
+        """
+        result = {}
+        for link, shortlink in Shortlink.from_links(*shortlinks).iteritems():
             ref_id = None
 
             # standard method
-            shortlink = Shortlink.get_from_parsed(parsed)
             if shortlink:
                 ref_id = shortlink.ref_id
 
             # try ephemerals
             if ref_id is None:
+                parsed = self.parse_shortlink(link)
                 for regex, func in self.SHORTLINK_EPHERMERALS.iteritems():
                     match = regex.match(parsed['artifact'])
                     if match:
                         ref_id = func['ref_id'](parsed, match, upsert=upsert)
 
-            return ref_id
+            result[link] = ref_id
+        return result
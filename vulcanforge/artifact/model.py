@@ -12,7 +12,8 @@ from ming.odm import state, session
 from ming.odm import (
     FieldProperty,
     ForeignIdProperty,
-    RelationProperty
+    RelationProperty,
+    MapperExtension
 )
 from ming.odm.declarative import MappedClass
 from ming.utils import LazyProperty
@@ -28,6 +29,8 @@ from vulcanforge.common.model.session import (
 from vulcanforge.common.helpers import absurl, urlquote
 from vulcanforge.common.util import nonce, get_client_ip
 from vulcanforge.common.util.filesystem import import_object
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.config.render.markdown_pool import shortlink_tag
 from vulcanforge.auth.model import User
 from vulcanforge.auth.schema import ACL
 from vulcanforge.neighborhood.model import Neighborhood
@@ -263,6 +266,11 @@ class Artifact(BaseMappedClass, ArtifactApiMixin):
 
     type_s = 'Generic Artifact'
 
+    # instances are counted in the ArtifactCounter of their tool, adding
+    # the value of counter_size_field to its total_size
+    counted = False
+    counter_size_field = None
+
     # Artifact base schema
     mod_date = FieldProperty(datetime, if_missing=datetime.utcnow)
     app_config_id = ForeignIdProperty(
@@ -280,6 +288,22 @@ class Artifact(BaseMappedClass, ArtifactApiMixin):
     def attachment_class(cls):  # pragma no cover
         raise NotImplementedError('attachment_class')
 
+    @classmethod
+    def counter_values(cls, doc):
+        """What a stored document of a counted class adds to the counter of
+        its tool; nothing once it is flagged deleted"""
+        if not doc or doc.get('deleted'):
+            return {}
+        values = {'all': 1}
+        if cls.counter_size_field:
+            values['total_size'] = doc.get(cls.counter_size_field) or 0
+        return values
+
+    @classmethod
+    def counter_query(cls):
+        """Query of the documents counter_values counts"""
+        return {'deleted': {'$ne': True}}
+
     @classmethod
     def translate_query(cls, q, fields):
         for f in fields:
@@ -295,11 +319,16 @@ class Artifact(BaseMappedClass, ArtifactApiMixin):
     def ref(self):
         return ArtifactReference.from_artifact(self)
 
-    def index_id(self):
-        index_id = '%s.%s#%s' % (
-            self.__class__.__module__, self.__class__.__name__, self._id)
+    @classmethod
+    def index_id_of(cls, _id):
+        """index_id of the artifact of this class with the given _id,
+        without loading it"""
+        index_id = '%s.%s#%s' % (cls.__module__, cls.__name__, _id)
         return index_id.replace('.', '/')
 
+    def index_id(self):
+        return self.index_id_of(self._id)
+
     def shorthand_id(self):
         return str(self._id)  # pragma no cover
 
@@ -509,7 +538,8 @@ class Snapshot(Artifact):
         unique_indexes = [('artifact_class', 'artifact_id', 'version')]
         indexes = [
             ('artifact_id', 'version'),
-            ('artifact_id', '_id')
+            ('artifact_id', '_id'),
+            ('app_config_id', '_id')
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -1003,6 +1033,39 @@ class ArtifactReference(BaseMappedClass):
                 session(obj).flush(obj)
         return obj
 
+    @classmethod
+    def artifacts_by_id(cls, refs):
+        """
+        Look up the artifacts referenced by refs, with one query per
+        artifact class and tool.
+
+        @return: dict mapping ref _id to artifact
+
+        """
+        groups = defaultdict(list)
+        for ref in refs:
+            aref = ref.artifact_reference
+            groups[(aref.module, aref.classname, aref.app_config_id)].append(
+                ref)
+        result = {}
+        for (module, classname, app_config_id), group in groups.iteritems():
+            try:
+                artifact_cls = import_object('{}:{}'.format(module, classname))
+                with g.context_manager.push(app_config_id=app_config_id):
+                    artifacts = dict(
+                        (a._id, a) for a in artifact_cls.query.find({
+                            '_id': {'$in': [
+                                r.artifact_reference.artifact_id
+                                for r in group]}}))
+            except Exception as e:
+                LOG.exception('Error loading artifacts of %s:%s for %s: %s',
+                              module, classname, app_config_id, e)
+                continue
+            for ref in group:
+                result[ref._id] = artifacts.get(
+                    ref.artifact_reference.artifact_id)
+        return result
+
     @property
     def artifact(self):
         """Look up the artifact referenced"""
@@ -1026,6 +1089,26 @@ class ArtifactReference(BaseMappedClass):
             self.references.append(dict(index_id=index_id, **kwargs))
 
 
+class ShortlinkExtension(MapperExtension):
+    """Drops rendered markdown that resolved a changed shortlink"""
+
+    def _invalidate(self, *docs):
+        tags = set(shortlink_tag(doc.get('project_shortname'), doc['link'])
+                   for doc in docs if doc and doc.get('link'))
+        if tags:
+            g.invalidate_shortlinks(*tags)
+
+    def after_delete(self, instance, state, sess):
+        self._invalidate(state.document)
+
+    def after_insert(self, instance, state, sess):
+        self._invalidate(state.document)
+
+    def after_update(self, instance, state, sess):
+        # artifact saves update the url and title shown for the link too
+        self._invalidate(state.original_document, state.document)
+
+
 class Shortlink(BaseMappedClass):
     """Collection mapping shorthand_ids for artifacts to ArtifactReferences"""
 
@@ -1037,6 +1120,7 @@ class Shortlink(BaseMappedClass):
             ('ref_id',),
             ('app_config_id',)
         ]
+        extensions = [ShortlinkExtension]
 
     # Stored properties
     _id = FieldProperty(S.ObjectId)
@@ -1092,39 +1176,60 @@ class Shortlink(BaseMappedClass):
 
     @classmethod
     def from_links(cls, *links):
-        """Convert a sequence of shortlinks to matching Shortlink objects"""
-        result = {}
+        """Convert a sequence of shortlinks to matching Shortlink objects,
+        resolving all of them with one query"""
+        parsed_links = {}
         for link in links:
-            if link not in result:
+            if link not in parsed_links:
                 parsed = g.artifact.parse_shortlink(link)
                 if parsed:
-                    result[link] = cls.get_from_parsed(parsed)
-        return result
+                    parsed_links[link] = parsed
+        if not parsed_links:
+            return {}
+        clauses = dict(
+            (cls._parsed_key(parsed), cls._parsed_query(parsed))
+            for parsed in parsed_links.itervalues())
+        candidates = defaultdict(list)
+        for slink in cls.query.find({'$or': clauses.values()}):
+            candidates[(slink.link, slink.project_shortname, None)].append(
+                slink)
+            if slink.app_mount:
+                candidates[(slink.link, slink.project_shortname,
+                            slink.app_mount)].append(slink)
+        return dict(
+            (link, cls._choose(candidates[cls._parsed_key(parsed)], parsed))
+            for link, parsed in parsed_links.iteritems())
 
     @classmethod
     def get_from_parsed(cls, parsed):
-        result = None
+        return cls._choose(
+            cls.query.find(cls._parsed_query(parsed)).all(), parsed)
+
+    @staticmethod
+    def _parsed_key(parsed):
+        return parsed['artifact'], parsed['project'], parsed['app'] or None
 
-        # assemble query
+    @staticmethod
+    def _parsed_query(parsed):
         query = {
             'link': parsed['artifact'],
             'project_shortname': parsed['project']
         }
         if parsed['app']:
             query['app_mount'] = parsed['app']
-        cursor = cls.query.find(query)
-
-        # determine link to choose if multiple options
-        num = cursor.count()
-        if num == 1 or not getattr(c, 'app', None):
-            result = cursor.first()
-        elif num > 1:
-            result = cls._filter_by_context(cursor, parsed)
-        return result
+        return query
 
     @classmethod
-    def _filter_by_context(cls, cursor, parsed=None):
-        opts = cursor.all()
+    def _choose(cls, opts, parsed=None):
+        """determine link to choose if multiple options"""
+        if not opts:
+            return None
+        if len(opts) == 1 or not getattr(c, 'app', None):
+            return opts[0]
+        return cls._filter_by_context(opts, parsed)
+
+    @classmethod
+    def _filter_by_context(cls, opts, parsed=None):
         for slink in opts:
             if slink.app_config_id == c.app.config._id:
                 result = slink
@@ -1143,7 +1248,7 @@ class Shortlink(BaseMappedClass):
                         result = slink
                         break
                 else:
-                    result = cursor.first()
+                    result = opts[0]
                     LOG.warn('Ambiguous link {}'.format(parsed))
         return result
 
@@ -1160,6 +1265,57 @@ class VisualizableArtifact(Artifact, VisualizableMixIn):
         return self.index_id()
 
 
+class ArtifactCounter(BaseMappedClass):
+    """
+    Materialized counts of the live artifacts of a tool, or of the members
+    of a project (app_config_id None).
+
+    Tool counters are kept up to date by ArtifactSessionExtension as counted
+    artifacts are saved and deleted, member counters by ProjectRole's mapper
+    extension. Bulk removals bypass both; `paster reconcile-counters`
+    rebuilds the counters from the collections.
+
+    """
+    class __mongometa__:
+        session = main_orm_session
+        name = 'artifact_counter'
+        unique_indexes = [('project_id', 'app_config_id')]
+        indexes = ['app_config_id']
+
+    _id = FieldProperty(S.ObjectId)
+    project_id = ForeignIdProperty('Project')
+    app_config_id = ForeignIdProperty('AppConfig', if_missing=None)
+    all = FieldProperty(int, if_missing=0)
+    total_size = FieldProperty(int, if_missing=0)
+
+    @classmethod
+    def increment(cls, project_id, app_config_id=None, **values):
+        values = dict((k, v) for k, v in values.iteritems() if v)
+        if not values:
+            return
+        pymongo_db_collection(cls)[1].update_one(
+            {'project_id': project_id, 'app_config_id': app_config_id},
+            {'$inc': values},
+            upsert=True)
+
+    @classmethod
+    def _read(cls, query, key):
+        return dict((doc[key], doc) for doc in
+                    pymongo_db_collection(cls)[1].find(query))
+
+    @classmethod
+    def for_app_configs(cls, app_config_ids):
+        """Counter documents of the tools, by app config id"""
+        return cls._read(
+            {'app_config_id': {'$in': list(app_config_ids)}}, 'app_config_id')
+
+    @classmethod
+    def for_projects(cls, project_ids):
+        """Member counter documents of the projects, by project id"""
+        return cls._read({'project_id': {'$in': list(project_ids)},
+                          'app_config_id': None}, 'project_id')
+
+
 class LogEntry(BaseMappedClass):
 
     class __mongometa__:
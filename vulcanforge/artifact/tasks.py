@@ -33,13 +33,17 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, mod_dates=None):
     with _indexing_disabled(artifact_orm_session._get()):
         solr_docs = []
         ids_to_repost = set()
+        refs = dict((ref._id, ref) for ref in ArtifactReference.query.find(
+            {'_id': {'$in': list(ref_ids)}}))
+        artifacts = ArtifactReference.artifacts_by_id(refs.values())
+        link_refs = []
         for ref_id in ref_ids:
             try:
-                ref = ArtifactReference.query.get(_id=ref_id)
+                ref = refs.get(ref_id)
                 if ref is None:
                     LOG.info('no reference found for %s' % str(ref_id))
                     continue
-                artifact = ref.artifact
+                artifact = artifacts.get(ref_id)
                 if mod_dates:
                     mod_date = mod_dates.get(ref_id, None)
                     if mod_date > artifact.mod_date:
@@ -61,18 +65,30 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, mod_dates=None):
                         LOG.info('no solarization found for %s', str(ref_id))
                 if update_refs:
                     if artifact.link_content:
-                        l_ref_ids = g.artifact.find_shortlink_refs(
-                            unescape_unicode(artifact.link_content),
-                            upsert=True)
-                        for link_ref_id in l_ref_ids:
-                            if link_ref_id:
-                                ref.upsert_reference(link_ref_id)
+                        link_refs.append((ref, g.artifact.find_shortlinks(
+                            unescape_unicode(artifact.link_content))))
             except Exception:
                 LOG.error('Error indexing artifact %s', ref_id)
                 exceptions.append(sys.exc_info())
 
+        # resolve the shortlinks of all the artifacts together
+        if link_refs:
+            try:
+                link_ref_ids = g.artifact.get_ref_ids_by_shortlinks(
+                    [link for ref, links in link_refs for link in links],
+                    upsert=True)
+            except Exception:
+                LOG.error('Error resolving shortlinks of %s', ref_ids)
+                exceptions.append(sys.exc_info())
+            else:
+                for ref, links in link_refs:
+                    for link in links:
+                        link_ref_id = link_ref_ids.get(link)
+                        if link_ref_id:
+                            ref.upsert_reference(link_ref_id)
+
         if solr_docs:
-            g.solr.add(solr_docs, waitFlush=True, waitSearcher=True)
+            g.solr_indexer.add(solr_docs)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
@@ -87,7 +103,6 @@ def del_artifacts(deleted_specs):
     for delete_spec in deleted_specs:
         ref_ids.append(delete_spec['ref_id'])
         try:
-            g.solr.delete(id=delete_spec['ref_id'])
             ref = ArtifactReference.query.get(_id=delete_spec['ref_id'])
             if ref is None:
                 LOG.info('no reference found for %s', delete_spec['ref_id'])
@@ -101,8 +116,9 @@ def del_artifacts(deleted_specs):
         except Exception:
             LOG.error('Error indexing artifact %s', delete_spec['ref_id'])
             exceptions.append(sys.exc_info())
+    g.solr_indexer.delete(ref_ids)
     if update_docs:
-        g.solr.add(update_docs)
+        g.solr_indexer.add(update_docs)
     ArtifactReference.query.remove(dict(_id={'$in': ref_ids}))
     Shortlink.query.remove(dict(ref_id={'$in': ref_ids}))
     if len(exceptions) == 1:
@@ -435,6 +435,7 @@ class User(SOLRIndexed):
     Vulcan's representation of individual human users.
     """
     SALT_LEN = 8
+    NOT_REAL_USERNAMES = ('*anonymous', 'root', 'admin')
 
     class __mongometa__:
         name = 'user'
@@ -708,7 +709,7 @@ class User(SOLRIndexed):
         return self.is_real_user() and not self.disabled
 
     def is_real_user(self):
-        return not self.username in ('*anonymous', 'root', 'admin')
+        return not self.username in self.NOT_REAL_USERNAMES
 
     @classmethod
     def upsert(cls, username):
@@ -3,11 +3,14 @@ This module provides the security predicates used in decorating various models.
 """
 import logging
 from collections import defaultdict
+from hashlib import sha1
 from itertools import chain
 from ming.odm.declarative import MappedClass
 
 from webob import exc
+from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c, request, app_globals as g
+from tg import config
 from tg.controllers.util import redirect
 from tg.flash import flash
 from ming.utils import LazyProperty
@@ -25,8 +28,16 @@ Please click the back button to return to the previous page.
 
 
 class SecurityManager(object):
+    access_version_key = 'security.access.version'
+
     def __init__(self):
         self.RoleCache = RoleCache
+        self.access_cache = asbool(config.get('security.access_cache', True))
+        self.shared_access_cache = asbool(
+            config.get('security.access_cache.shared', False))
+        self.access_cache_timeout = asint(
+            config.get('security.access_cache.timeout', 600))
+        self.access_stats = dict(hits=0, shared_hits=0, misses=0)
 
     @property
     def credentials(self):
@@ -48,13 +59,48 @@ class SecurityManager(object):
             project = c.project.root_project
         return project
 
+    def acl_key(self, acl):
+        """Hashable summary of an ACL"""
+        return tuple(
+            tuple(sorted(ace.items())) if hasattr(ace, 'items') else repr(ace)
+            for ace in acl)
+
+    def _acl_chain_key(self, obj):
+        """Hashable summary of the ACLs of obj and its parent security
+        contexts, which is all that roles_with_permission depends on besides
+        the project's roles.
+
+        """
+        key = []
+        while obj:
+            key.append((obj.__class__, self.acl_key(obj.acl)))
+            obj = hasattr(obj, 'parent_security_context') and \
+                obj.parent_security_context()
+        return tuple(key)
+
     def roles_with_permission(self, obj, permission, project=None):
-        """Returns most encompassing roles that have the given permission"""
+        """Returns most encompassing roles that have the given permission
+
+        Results are memoized on the request's credentials, keyed by the
+        ACL chain, so objects sharing an ACL (e.g. every artifact of a tool)
+        are evaluated once. ACL changes change the key; role changes clear
+        the credentials.
+
+        """
         if project is None:
             project = self._get_project_from_obj(obj)
             if project is None:
                 return []
 
+        cache = self.credentials.permission_roles
+        key = (project._id, permission, self._acl_chain_key(obj))
+        roles = cache.get(key)
+        if roles is None:
+            roles = cache[key] = self._roles_with_permission(
+                obj, permission, project)
+        return list(roles)
+
+    def _roles_with_permission(self, obj, permission, project):
         # try for special roles
         role_anon = ProjectRole.anonymous(project)._id
         if self.role_has_permission(role_anon, obj, permission):
@@ -219,9 +265,7 @@ class SecurityManager(object):
                 user_id=user._id, project_id=project._id).reaching_ids
 
         # determine permissions for this obj
-        result = self.any_role_has_permission(
-            roles, obj, permission, user=user, project=project
-        )
+        result = self.acl_decision(roles, obj, permission)
 
         if not result and not isinstance(obj, Neighborhood):
             result = self.has_access(project.neighborhood, 'admin', user=user)
@@ -231,6 +275,93 @@ class SecurityManager(object):
 
         return result
 
+    def filter_by_access(self, objs, permission, user=None, project=None,
+                         key=None):
+        """The objs on which user has the permission, in order.
+
+        has_access is evaluated once per distinct key(obj). The default key
+        is the ACL chain of obj, which loads its parent security contexts;
+        callers that know the objs share them (e.g. the artifacts of one
+        tool) can pass a cheaper key, and should pass the project.
+
+        """
+        if key is None:
+            key = self._acl_chain_key
+        decisions = {}
+        allowed = []
+        for obj in objs:
+            obj_key = key(obj)
+            if obj_key not in decisions:
+                decisions[obj_key] = self.has_access(
+                    obj, permission, user=user, project=project)
+            if decisions[obj_key]:
+                allowed.append(obj)
+        return allowed
+
+    def acl_decision(self, roles, obj, permission):
+        """Whether any of roles has permission on obj by its ACL chain alone,
+        i.e. any_role_has_permission without the neighborhood fallback.
+
+        Decisions depend only on the role ids, the ACL chain and the
+        permission, so they are memoized on the request's credentials under
+        that key, and optionally shared across requests through redis. The
+        shared keys carry a version stamp that invalidate_access_cache bumps
+        whenever ACLs or project roles change.
+
+        """
+        if not self.access_cache:
+            return bool(self.any_role_has_permission(roles, obj, permission))
+        cache = self.credentials.access_decisions
+        key = (permission, frozenset(roles), self._acl_chain_key(obj))
+        result = cache.get(key)
+        if result is not None:
+            self.access_stats['hits'] += 1
+            return result
+        shared_key = None
+        if self.shared_access_cache and g.cache:
+            shared_key = self._shared_access_key(key)
+            stored = g.cache.get(shared_key)
+            if stored is not None:
+                self.access_stats['shared_hits'] += 1
+                result = cache[key] = stored == '1'
+                return result
+        self.access_stats['misses'] += 1
+        result = cache[key] = bool(
+            self.any_role_has_permission(roles, obj, permission))
+        if shared_key:
+            g.cache.set(shared_key, '1' if result else '0',
+                        self.access_cache_timeout)
+        return result
+
+    def _shared_access_key(self, key):
+        permission, roles, chain_key = key
+        digest = sha1(repr(
+            (permission, sorted(map(str, roles)), chain_key))).hexdigest()
+        return 'security.access.%s.%s' % (self._access_version(), digest)
+
+    def _access_version(self):
+        credentials = self.credentials
+        if credentials.access_version is None:
+            credentials.access_version = \
+                g.cache.get(self.access_version_key) or '0'
+        return credentials.access_version
+
+    def invalidate_access_cache(self):
+        """Orphan the access decisions shared across requests"""
+        if self.shared_access_cache and g.cache:
+            g.cache.incr(self.access_version_key)
+
+    def access_cache_stats(self):
+        stats = dict(self.access_stats)
+        total = sum(stats.values())
+        stats['hit_ratio'] = \
+            float(total - stats['misses']) / total if total else 0.0
+        return stats
+
+    def reset_access_cache_stats(self):
+        for key in self.access_stats:
+            self.access_stats[key] = 0
+
     def raise_forbidden(self, message=FORBIDDEN_MSG):
         if not c.user.is_anonymous:
             request.environ['error_message'] = message
@@ -311,6 +442,9 @@ class Credentials(object):
         """clear cache"""
         self.users = {}
         self.projects = {}
+        self.permission_roles = {}
+        self.access_decisions = {}
+        self.access_version = None
 
     def load_user_roles(self, user_id, *project_ids):
         """Load the credentials with all user roles for a set of projects"""
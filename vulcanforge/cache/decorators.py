@@ -1,5 +1,9 @@
 import logging
 import hashlib
+import json
+import math
+import random
+import time
 
 from webhelpers.html import literal
 from pylons import app_globals as g, tmpl_context as c
@@ -9,6 +13,9 @@ from vulcanforge.common.controllers.decorators import controller_decorator
 
 LOG = logging.getLogger(__name__)
 
+# marks cached values stored along with their expiry
+ENVELOPE = '\x00vfcache:'
+
 
 class BaseCacheDecorator(object):
     """
@@ -25,16 +32,33 @@ class BaseCacheDecorator(object):
         the cache
     :param override_kwarg str keyword argument passed to the function that
         causes force run of the function
+    :param stale_timeout int seconds an expired value is still served while
+        one request recomputes it. Defaults to timeout.
+    :param lock_timeout int seconds one request may hold the right to
+        recompute a value before another request takes over
+    :param lock_wait float seconds a request waits for a value being computed
+        by another request before computing it too
+    :param early_expiry float weight of the probabilistic early refresh:
+        values are recomputed ahead of expiry with a probability growing with
+        the time they took to compute. 0 disables early refresh.
 
     """
+    lock_poll_interval = 0.05
+
     def __init__(self, name=None, key=None, timeout=None, allow_overrides=False,
-                 override_kwarg='force', debug_timeout=None):
+                 override_kwarg='force', debug_timeout=None,
+                 stale_timeout=None, lock_timeout=10, lock_wait=2.0,
+                 early_expiry=1.0):
         self.name = name
         self.key = key
         self.timeout = timeout
         self.debug_timeout = debug_timeout
         self.allow_overrides = allow_overrides
         self.override_kwarg = override_kwarg
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.early_expiry = early_expiry
 
     def extra_param_kwargs(self):
         return {}
@@ -79,25 +103,116 @@ class BaseCacheDecorator(object):
             return self.timeout
         return self.debug_timeout or self.timeout
 
+    def get_storage_timeout(self):
+        """Seconds values are kept in redis: fresh, then stale"""
+        timeout = self.get_timeout()
+        if not timeout:
+            return timeout
+        if self.stale_timeout is None:
+            return 2 * timeout
+        return timeout + self.stale_timeout
+
+    def get_expires(self):
+        timeout = self.get_timeout()
+        if timeout:
+            return time.time() + timeout
+        return None
+
+    def is_fresh(self, expires, delta):
+        """Whether a value expiring at expires, which took delta seconds to
+        compute, can be served without recomputing it.
+
+        Recomputation is triggered early at random, more likely the closer
+        the expiry and the costlier the value, so that a single request
+        usually refreshes a popular value before it expires.
+
+        """
+        if expires is None:
+            return True
+        now = time.time()
+        if self.early_expiry and delta:
+            now -= delta * self.early_expiry * math.log(1.0 - random.random())
+        return now < expires
+
+    def get_lockname(self, name, key):
+        return 'cache-lock.%s.%s' % (name, key)
+
+    def acquire_lock(self, name, key):
+        return g.cache.acquire_lock(
+            self.get_lockname(name, key), self.lock_timeout)
+
+    def release_lock(self, name, key, token):
+        try:
+            g.cache.release_lock(self.get_lockname(name, key), token)
+        except Exception:
+            LOG.exception('Error releasing cache lock for %s %s', name, key)
+
+    def wait_for_value(self, name, key):
+        """Poll for a value computed by the request holding the lock"""
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline:
+            time.sleep(self.lock_poll_interval)
+            value = self.get_entry(name, key)[0]
+            if value:
+                return value
+        return None
+
+    def _pack(self, payload, expires, delta):
+        return '%s%s\n%s' % (ENVELOPE, json.dumps([expires, delta]), payload)
+
+    def _unpack(self, stored):
+        """:returns: payload, expires, delta"""
+        if not stored or not stored.startswith(ENVELOPE):
+            # values cached before expiry was tracked
+            return stored, None, 0
+        header, payload = stored[len(ENVELOPE):].split('\n', 1)
+        expires, delta = json.loads(header)
+        return payload, expires, delta
+
     def get_cached(self, name, key):  # pragma no cover
         raise NotImplementedError('get_cached')
 
     def set_cached(self, name, key, value):  # pragma no cover
         raise NotImplementedError('set_cached')
 
+    def get_entry(self, name, key):
+        """:returns: value, expires timestamp, seconds taken to compute"""
+        return self.get_cached(name, key), None, 0
+
+    def set_entry(self, name, key, value, expires, delta):
+        return self.set_cached(name, key, value)
+
+    def compute(self, func, args, kwargs, name, key):
+        start = time.time()
+        value = func(*args, **kwargs)
+        self.set_entry(
+            name, key, value, self.get_expires(), time.time() - start)
+        return value
+
     def __call__(self, func):
         def wrapper(*args, **kwargs):
             if not g.cache:
                 return func(*args, **kwargs)
             name, key = self.get_keyname(func, args=args, kwargs=kwargs)
             if self.allow_overrides and kwargs.pop(self.override_kwarg, None):
-                value = None
-            else:
-                value = self.get_cached(name, key)
-            if not value:
-                value = func(*args, **kwargs)
-                self.set_cached(name, key, value)
-            return value
+                return self.compute(func, args, kwargs, name, key)
+            value, expires, delta = self.get_entry(name, key)
+            if value and self.is_fresh(expires, delta):
+                return value
+            # single flight: one request recomputes while the others serve
+            # the stale value, or wait for the new one if there is none
+            token = self.acquire_lock(name, key)
+            if token is None:
+                if value:
+                    return value
+                value = self.wait_for_value(name, key)
+                if value:
+                    return value
+            try:
+                return self.compute(func, args, kwargs, name, key)
+            finally:
+                if token is not None:
+                    self.release_lock(name, key, token)
 
         return wrapper
 
@@ -105,27 +220,48 @@ class BaseCacheDecorator(object):
 class cache_str(BaseCacheDecorator):
 
     def get_cached(self, name, key):
-        return g.cache.hget(name, key)
+        return self.get_entry(name, key)[0]
 
     def set_cached(self, name, key, value):
-        return g.cache.hset(name, key, value, self.get_timeout())
+        return self.set_entry(name, key, value, self.get_expires(), 0)
+
+    def get_entry(self, name, key):
+        return self._unpack(g.cache.hget(name, key))
+
+    def set_entry(self, name, key, value, expires, delta):
+        return g.cache.hset(name, key, self._pack(value, expires, delta),
+                            self.get_storage_timeout())
 
 
 class cache_literal(cache_str):
-    def get_cached(self, name, key):
-        result = super(cache_literal, self).get_cached(name, key)
+    def get_entry(self, name, key):
+        result, expires, delta = super(cache_literal, self).get_entry(
+            name, key)
         if result:
             result = literal(result)
-        return result
-
-
-class cache_json(BaseCacheDecorator):
-
-    def get_cached(self, name, key):
-        return g.cache.hget_json(name, key)
-
-    def set_cached(self, name, key, value):
-        return g.cache.hset_json(name, key, value, self.get_timeout())
+        return result, expires, delta
+
+
+class cache_json(cache_str):
+
+    def get_entry(self, name, key):
+        payload, expires, delta = super(cache_json, self).get_entry(name, key)
+        value = None
+        if payload:
+            try:
+                value = json.loads(payload)
+            except ValueError:
+                LOG.warn('Invalid json cached in %s,%s', name, key)
+        return value, expires, delta
+
+    def set_entry(self, name, key, value, expires, delta):
+        try:
+            value_json = json.dumps(value)
+        except TypeError:
+            LOG.warn('Cannot cache to %s -- invalid json %s', name, value)
+        else:
+            return super(cache_json, self).set_entry(
+                name, key, value_json, expires, delta)
 
 
 class BaseCacheController(BaseCacheDecorator):
@@ -171,7 +307,14 @@ class cache_method(BaseCacheController, cache_json):
 
 
 class cache_rendered(BaseCacheController):
-    """Cache the result of a controller method post-render"""
+    """Cache the result of a controller method post-render.
+
+    The request that renders a value holds its lock from the controller
+    method until after_render. If the method or its template raises,
+    after_render never runs: the root controller calls release_unrendered
+    in a finally around the dispatch, which includes the render.
+
+    """
 
     def default_key(self, func, args, kwargs):
         """Key is not used here"""
@@ -183,32 +326,71 @@ class cache_rendered(BaseCacheController):
         deco.register_hook('after_render', self.after_render)
         return controller_decorator(self._wrapper, func)
 
+    def get_entry(self, name, key):
+        cached = g.cache.hgetall(name)
+        if not cached.get('response'):
+            return None, None, 0
+        expires = cached.get('expires')
+        return (cached,
+                float(expires) if expires else None,
+                float(cached.get('delta') or 0))
+
+    def serve_cached(self, cached):
+        c._cache_response = False
+        override_template(self._wrapper, '')
+        if cached.get('content_type'):
+            response.content_type = cached['content_type']
+        return literal(cached['response'])
+
     def _wrapper(self, *args, **kwargs):
+        c._cache_response = False
         if not g.cache:
-            c._cache_response = False
             return self._func(*args, **kwargs)
 
         name, key = self.get_keyname(self._func, args=args, kwargs=kwargs)
-        cached = g.cache.hgetall(name)
-        if cached:
-            LOG.info('found cache val for %s: %s', name, cached)
-            c._cache_response = False
-            override_template(self._wrapper, '')
-            val = literal(cached['response'])
-            if cached.get('content_type'):
-                response.content_type = cached['content_type']
-        else:
-            LOG.info('no cache val for %s', name)
-            c._cache_response = name
-            val = self._func(*args, **kwargs)
-        return val
+        cached, expires, delta = self.get_entry(name, key)
+        if cached and self.is_fresh(expires, delta):
+            LOG.info('found cache val for %s', name)
+            return self.serve_cached(cached)
+
+        token = self.acquire_lock(name, key)
+        if token is None:
+            if not cached:
+                cached = self.wait_for_value(name, key)
+            if cached:
+                LOG.info('serving cache val for %s while it is refreshed',
+                         name)
+                return self.serve_cached(cached)
+        LOG.info('no cache val for %s', name)
+        c._cache_response = name
+        c._cache_lock = (self, key, token)
+        c._cache_started = time.time()
+        return self._func(*args, **kwargs)
+
+    @staticmethod
+    def release_unrendered():
+        """Release the lock of a response that was not rendered"""
+        name = getattr(c, '_cache_response', None)
+        if not name:
+            return
+        c._cache_response = False
+        deco, key, token = c._cache_lock
+        if token is not None:
+            deco.release_lock(name, key, token)
 
     def after_render(self, response):
         if c._cache_response:
             name = c._cache_response
+            c._cache_response = False
+            _, key, token = c._cache_lock
+            expires = self.get_expires()
             val = {
                 'response': response['response'],
-                'content_type': response.get('content_type', '')
+                'content_type': response.get('content_type', ''),
+                'expires': expires or '',
+                'delta': time.time() - c._cache_started
             }
-            g.cache.hmset(name, val, self.get_timeout())
-            LOG.info('setting cache val for %s to %s', name, response)
+            g.cache.hmset(name, val, self.get_storage_timeout())
+            if token is not None:
+                self.release_lock(name, key, token)
+            LOG.info('setting cache val for %s', name)
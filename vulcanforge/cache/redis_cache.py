@@ -1,10 +1,19 @@
 import logging
 import json
+from uuid import uuid4
 
 from redis import StrictRedis
 
 LOG = logging.getLogger(__name__)
 
+# deletes a lock only if it is still held by the given token
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 
 class RedisCache(object):
     """
@@ -20,6 +29,7 @@ class RedisCache(object):
             self.redis = StrictRedis(**kw)
         self.default_timeout = default_timeout
         self.prefix = prefix
+        self._release_lock = self.redis.register_script(_RELEASE_LOCK_SCRIPT)
 
     def make_keyname(self, name):
         return self.prefix + name
@@ -42,6 +52,44 @@ class RedisCache(object):
     def expire(self, name, seconds):
         return self.redis.expire(self.make_keyname(name), seconds)
 
+    def acquire_lock(self, name, timeout):
+        """Take a lock that expires after timeout seconds.
+
+        :returns: a token to release the lock with, or None if the lock is
+            held elsewhere
+
+        """
+        token = uuid4().hex
+        if self.redis.execute_command(
+                'SET', self.make_keyname(name), token, 'NX', 'EX', timeout):
+            return token
+        return None
+
+    def release_lock(self, name, token):
+        return self._release_lock(keys=[self.make_keyname(name)], args=[token])
+
+    def incr(self, name, amount=1):
+        return self.redis.incr(self.make_keyname(name), amount)
+
+    def mget(self, *names):
+        """Values of names, in one round trip"""
+        if not names:
+            return []
+        return self.redis.mget([self.make_keyname(name) for name in names])
+
+    def mset(self, mapping, expiration=None):
+        """Set every name of mapping to its value, in one round trip"""
+        if expiration is None:
+            expiration = self.default_timeout
+        pipe = self.redis.pipeline()
+        for name, value in mapping.iteritems():
+            name = self.make_keyname(name)
+            if expiration:
+                pipe.setex(name, expiration, value)
+            else:
+                pipe.set(name, value)
+        return pipe.execute()
+
     def exists(self, name):
         return self.redis.exists(self.make_keyname(name))
 
@@ -112,6 +160,19 @@ class RedisCache(object):
             result = self._from_json(','.join((name, key)), result)
         return result
 
+    def mget_json(self, *names):
+        return [self._from_json(name, value) if value else value
+                for name, value in zip(names, self.mget(*names))]
+
+    def mset_json(self, mapping, expiration=None):
+        try:
+            mapping = dict(
+                (name, json.dumps(value)) for name, value in mapping.iteritems())
+        except TypeError:
+            LOG.warn('Cannot cache to %s -- invalid json', mapping.keys())
+        else:
+            return self.mset(mapping, expiration=expiration)
+
     def hset_json(self, name, key, value, expiration=None):
         try:
             value_json = json.dumps(value)
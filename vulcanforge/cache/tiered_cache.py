@@ -0,0 +1,253 @@
+import logging
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from vulcanforge.cache.redis_cache import RedisCache
+
+LOG = logging.getLogger(__name__)
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe, in-process cache of redis values.
+
+    Entries are grouped by redis key name so that a name can be dropped in
+    one step; each name holds subkeys (None for a string value, a hash field,
+    or '*' for a whole hash) with their own expiration. The least recently
+    used names are evicted beyond max_size.
+
+    """
+    def __init__(self, max_size=1000, timeout=30):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, subkey=None):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                return MISSING
+            self._entries[name] = entry
+            expires, value = entry.get(subkey, (None, MISSING))
+            if expires is not None and expires < time.time():
+                del entry[subkey]
+                return MISSING
+            return value
+
+    def set(self, name, subkey, value, generation=None):
+        """Store a value, unless an invalidation happened since generation
+        was read, in which case value may already be stale.
+
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            entry = self._entries.pop(name, None) or {}
+            entry[subkey] = (time.time() + self.timeout, value)
+            self._entries[name] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, *names):
+        with self._lock:
+            self.generation += 1
+            for name in names:
+                self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+class TieredRedisCache(RedisCache):
+    """
+    RedisCache with an in-process LRU tier in front of it.
+
+    Reads of strings and hashes are served from the local tier when
+    possible. Writes go to redis and then drop the name locally and, over
+    redis pub/sub, in every other process using the same channel.
+    Invalidations missed while the subscription is down are covered by
+    clearing the local tier on (re)subscribe, and by the local timeout.
+
+    Only truthy values are kept locally, so misses always reach redis.
+
+    """
+    def __init__(self, local_size=1000, local_timeout=30,
+                 channel='cache.invalidate', **kw):
+        super(TieredRedisCache, self).__init__(**kw)
+        self.local = LRUCache(max_size=local_size, timeout=local_timeout)
+        self.channel = self.make_keyname(channel)
+        self.node_id = uuid4().hex
+        self.counts = dict(
+            local_hits=0,
+            local_misses=0,
+            redis_hits=0,
+            redis_misses=0,
+            invalidations_sent=0,
+            invalidations_received=0
+        )
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # the listener thread does not survive a fork, so check the pid
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.local.clear()
+            thread = threading.Thread(
+                target=self._listen, name='cache-invalidation')
+            thread.daemon = True
+            thread.start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                self.local.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._on_invalidation(message['data'])
+            except Exception:
+                LOG.exception('Cache invalidation subscription failed')
+                self.local.clear()
+                time.sleep(1)
+            finally:
+                try:
+                    pubsub.reset()
+                except Exception:
+                    pass
+
+    def _on_invalidation(self, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            LOG.warn('Invalid cache invalidation message %r', data)
+            return
+        if message.get('node') == self.node_id:
+            return
+        self.counts['invalidations_received'] += 1
+        names = message.get('names', [])
+        if '*' in names:
+            self.local.clear()
+        else:
+            self.local.discard(*names)
+
+    def invalidate(self, *names):
+        """Drop names from the local tier of every process"""
+        if '*' in names:
+            self.local.clear()
+        else:
+            self.local.discard(*names)
+        self.counts['invalidations_sent'] += 1
+        self.redis.publish(self.channel, json.dumps({
+            'node': self.node_id,
+            'names': list(names)
+        }))
+
+    def _cached(self, name, subkey, fetch):
+        self._ensure_listener()
+        value = self.local.get(name, subkey)
+        if value is not MISSING:
+            self.counts['local_hits'] += 1
+            return value
+        self.counts['local_misses'] += 1
+        generation = self.local.generation
+        value = fetch()
+        if value:
+            self.counts['redis_hits'] += 1
+            self.local.set(name, subkey, value, generation=generation)
+        else:
+            self.counts['redis_misses'] += 1
+        return value
+
+    def stats(self):
+        """Counts and hit rates of each tier"""
+        stats = dict(self.counts, local_size=len(self.local))
+        for tier in ('local', 'redis'):
+            total = stats[tier + '_hits'] + stats[tier + '_misses']
+            stats[tier + '_hit_rate'] = \
+                float(stats[tier + '_hits']) / total if total else 0.0
+        return stats
+
+    # reads
+
+    def get(self, name):
+        return self._cached(
+            name, None, lambda: super(TieredRedisCache, self).get(name))
+
+    def hget(self, name, key):
+        return self._cached(
+            name, key, lambda: super(TieredRedisCache, self).hget(name, key))
+
+    def hgetall(self, name):
+        value = self._cached(
+            name, '*', lambda: super(TieredRedisCache, self).hgetall(name))
+        return dict(value)
+
+    # writes
+
+    def set(self, name, value, expiration=None):
+        result = super(TieredRedisCache, self).set(
+            name, value, expiration=expiration)
+        self.invalidate(name)
+        return result
+
+    def mset(self, mapping, expiration=None):
+        result = super(TieredRedisCache, self).mset(
+            mapping, expiration=expiration)
+        if mapping:
+            self.invalidate(*mapping.keys())
+        return result
+
+    def delete(self, *names):
+        result = super(TieredRedisCache, self).delete(*names)
+        self.invalidate(*names)
+        return result
+
+    def expire(self, name, seconds):
+        result = super(TieredRedisCache, self).expire(name, seconds)
+        self.invalidate(name)
+        return result
+
+    def incr(self, name, amount=1):
+        result = super(TieredRedisCache, self).incr(name, amount)
+        self.invalidate(name)
+        return result
+
+    def hset(self, name, key, value, expiration=None):
+        result = super(TieredRedisCache, self).hset(
+            name, key, value, expiration=expiration)
+        self.invalidate(name)
+        return result
+
+    def hmset(self, name, mapping, expiration=None):
+        result = super(TieredRedisCache, self).hmset(
+            name, mapping, expiration=expiration)
+        self.invalidate(name)
+        return result
+
+    def hdel(self, name, *keys):
+        result = super(TieredRedisCache, self).hdel(name, *keys)
+        self.invalidate(name)
+        return result
+
+    def clear(self):
+        result = super(TieredRedisCache, self).clear()
+        self.invalidate('*')
+        return result
@@ -2,6 +2,7 @@ from base import Command
 from show_models import (ShowModelsCommand, ReindexCommand,
                          EnsureIndexCommand, ReindexGlobalsCommand,
                          ReindexNotifications)
+from reindex import ParallelReindexCommand
 from script import ScriptCommand, SetToolAccessCommand
 from smtp_server import SMTPServerCommand
 from create_neighborhood import CreateNeighborhoodCommand
@@ -5,10 +5,10 @@ cache
 
 @author: U{tannern<tannern@gmail.com>}
 """
-from pylons import app_globals as g
 #import tg
 
 from vulcanforge.command import base
+from vulcanforge.project import navdata
 
 
 class CleanupForApplicationStart(base.Command):
@@ -20,5 +20,4 @@ class CleanupForApplicationStart(base.Command):
 
     def command(self):
         self.basic_setup()
-        if g.cache and hasattr(g.cache, 'redis'):
-            g.cache.redis.expire('navdata', 0)
+        navdata.bump_global()
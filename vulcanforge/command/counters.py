@@ -0,0 +1,38 @@
+import time
+
+from vulcanforge.common.util.counts import reconcile_counters
+from vulcanforge.project.model import Project
+
+from . import base
+
+
+class ReconcileCountersCommand(base.Command):
+    """Rebuild the materialized artifact and member counters shown on the
+    dashboard and project home pages from the artifact collections.
+
+    """
+    min_args = 1
+    max_args = 1
+    usage = '<ini file>'
+    summary = 'Rebuild the artifact and member counters'
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('-p', '--project', dest='projects', action='append',
+                      default=[],
+                      help='shortname of a project to reconcile (repeatable, '
+                           'defaults to all projects)')
+
+    def command(self):
+        self.basic_setup()
+        project_ids = None
+        if self.options.projects:
+            project_ids = []
+            for shortname in self.options.projects:
+                project = Project.by_shortname(shortname)
+                if project is None:
+                    self.log.error('No such project: %s', shortname)
+                    return
+                project_ids.append(project._id)
+        start = time.time()
+        written, removed = reconcile_counters(project_ids)
+        self.log.info('Wrote %d counters and removed %d stale ones in %.1fs',
+                      written, removed, time.time() - start)
@@ -0,0 +1,243 @@
+import os
+import time
+from datetime import datetime
+from multiprocessing import Process
+
+from pylons import tmpl_context as c, app_globals as g
+from pymongo import UpdateOne, DeleteOne
+from ming.odm import ThreadLocalODMSession
+
+from vulcanforge.artifact.model import ArtifactReference, Shortlink
+from vulcanforge.artifact.util import iter_artifact_classes
+from vulcanforge.common.helpers import unescape_unicode
+from vulcanforge.common.model.index import ReindexCheckpoint
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.neighborhood.model import Neighborhood
+from vulcanforge.project.model import Project, AppConfig
+from vulcanforge.search.solr import solarize
+
+from . import base
+
+
+class ParallelReindexCommand(base.Command):
+    """Reindex artifacts across a pool of processes, one app config at a
+    time, checkpointing progress in mongo so an interrupted job can resume.
+
+    """
+    min_args = 1
+    max_args = 1
+    usage = '<ini file>'
+    summary = 'Reindex and re-shortlink artifacts in parallel, resumably'
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('-p', '--project', dest='project', default=None,
+                      help='project to reindex')
+    parser.add_option('-n', '--neighborhood', dest='neighborhood',
+                      default=None,
+                      help='neighborhood to reindex (e.g. p)')
+    parser.add_option('--processes', type='int', dest='processes',
+                      default=4, help='number of worker processes')
+    parser.add_option('--batch', type='int', dest='batch_size', default=500,
+                      help='artifacts written per round trip and checkpoint')
+    parser.add_option('--job', dest='job', default=None,
+                      help='name of the job (defaults to a timestamp)')
+    parser.add_option('--resume', action='store_true', dest='resume',
+                      help='resume the named job, or the latest unfinished '
+                           'one')
+    parser.add_option('--clear', action='store_true', dest='clear',
+                      help='delete solr documents of each tool before '
+                           'reindexing it')
+
+    def command(self):
+        self.basic_setup()
+        if self.options.resume:
+            job = self.resume_job(self.options.job)
+            if job is None:
+                self.log.error('No unfinished reindex job to resume')
+                return
+        else:
+            job = self.options.job or datetime.utcnow().strftime(
+                'reindex-%Y%m%d%H%M%S')
+            self.create_job(job)
+        total = ReindexCheckpoint.query.find({'job': job}).count()
+        self.log.info('Running reindex job %s: %d tools over %d processes',
+                      job, total, self.options.processes)
+
+        start = time.time()
+        ThreadLocalODMSession.close_all()
+        processes = []
+        for i in range(self.options.processes):
+            process = Process(target=self.worker, args=(job,))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+
+        counts = dict(
+            (state, ReindexCheckpoint.query.find(
+                {'job': job, 'state': state}).count())
+            for state in ('done', 'error', 'pending', 'busy'))
+        self.log.info('Reindex job %s finished in %.1fs: %r',
+                      job, time.time() - start, counts)
+        if counts['error']:
+            self.log.warn('Fix the failed tools and rerun with '
+                          '--resume --job %s', job)
+
+    def create_job(self, job):
+        if self.options.project:
+            q_project = dict(shortname=self.options.project)
+        elif self.options.neighborhood:
+            neighborhood_id = Neighborhood.by_prefix(
+                self.options.neighborhood)._id
+            q_project = dict(neighborhood_id=neighborhood_id)
+        else:
+            q_project = {}
+        project_ids = [p['_id'] for p in
+                       pymongo_db_collection(Project)[1].find(
+                           q_project, {'_id': 1})]
+        _, coll = pymongo_db_collection(ReindexCheckpoint)
+        ops = [UpdateOne({'job': job, 'app_config_id': ac['_id']},
+                         {'$setOnInsert': {'state': 'pending', 'count': 0,
+                                           'mod_date': datetime.utcnow()}},
+                         upsert=True)
+               for ac in pymongo_db_collection(AppConfig)[1].find(
+                   {'project_id': {'$in': project_ids}}, {'_id': 1})]
+        if ops:
+            coll.bulk_write(ops, ordered=False)
+
+    def resume_job(self, job=None):
+        query = {'state': {'$ne': 'done'}}
+        if job:
+            query['job'] = job
+        unfinished = ReindexCheckpoint.query.find(query).sort(
+            'mod_date', -1).first()
+        if unfinished is None:
+            return None
+        job = unfinished.job
+        # partitions left busy or failed by the interrupted run start over
+        # from their last checkpoint
+        ReindexCheckpoint.query.update(
+            {'job': job, 'state': {'$in': ['busy', 'error']}},
+            {'$set': {'state': 'pending', 'process': None}},
+            multi=True)
+        return job
+
+    def worker(self, job):
+        """Entry point of each worker process"""
+        # connections are not fork-safe; load the app again for fresh ones
+        self.basic_setup()
+        process = '%s pid %s' % (os.uname()[1], os.getpid())
+        while True:
+            checkpoint = ReindexCheckpoint.claim(job, process)
+            if checkpoint is None:
+                break
+            try:
+                self.reindex_tool(checkpoint)
+            except Exception as e:
+                self.log.exception('Error reindexing tool %s',
+                                   checkpoint.app_config_id)
+                checkpoint.finish('error', error=str(e))
+            else:
+                checkpoint.finish()
+            ThreadLocalODMSession.close_all()
+
+    def reindex_tool(self, checkpoint):
+        app_config = AppConfig.query.get(_id=checkpoint.app_config_id)
+        if app_config is None:
+            return
+        with g.context_manager.push(app_config_id=app_config._id):
+            self.log.info('Reindexing %s/%s (from %s %s)',
+                          c.project.shortname, app_config.options.mount_point,
+                          checkpoint.artifact_cls, checkpoint.last_id)
+            if self.options.clear and checkpoint.artifact_cls is None:
+                g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (
+                    c.project._id, app_config.options.mount_point))
+            skipping = checkpoint.artifact_cls is not None
+            for a_cls in iter_artifact_classes():
+                cls_path = '%s:%s' % (a_cls.__module__, a_cls.__name__)
+                query = {'app_config_id': app_config._id}
+                if skipping:
+                    if cls_path != checkpoint.artifact_cls:
+                        continue
+                    skipping = False
+                    if checkpoint.last_id is not None:
+                        query['_id'] = {'$gt': checkpoint.last_id}
+                self.reindex_artifacts(checkpoint, a_cls, cls_path, query)
+
+    def reindex_artifacts(self, checkpoint, a_cls, cls_path, query):
+        while True:
+            try:
+                artifacts = a_cls.query.find(query).sort('_id', 1).limit(
+                    self.options.batch_size).all()
+            except Exception:
+                self.log.exception("Unable to query artifacts of class '%s'",
+                                   a_cls.__name__)
+                return
+            if not artifacts:
+                return
+            self.index_batch(artifacts)
+            # the checkpoint only moves once the batch is written everywhere
+            g.solr_indexer.flush()
+            checkpoint.advance(cls_path, artifacts[-1]._id, len(artifacts))
+            query['_id'] = {'$gt': artifacts[-1]._id}
+            ThreadLocalODMSession.close_all()
+
+    def index_batch(self, artifacts):
+        """Bulk upsert references and shortlinks, then index in solr"""
+        ref_ops, link_ops, ref_link_ops, docs = [], [], [], []
+        now = datetime.utcnow()
+        for a in artifacts:
+            try:
+                index_id = a.index_id()
+                ref_ops.append(UpdateOne(
+                    {'_id': index_id},
+                    {'$set': {'artifact_reference': {
+                        'module': a.__module__,
+                        'classname': a.__class__.__name__,
+                        'project_id': a.app_config.project_id,
+                        'app_config_id': a.app_config._id,
+                        'artifact_id': a._id}},
+                     '$setOnInsert': {'references': []}},
+                    upsert=True))
+                link = a.shorthand_id()
+                if link is None:
+                    link_ops.append(DeleteOne({'ref_id': index_id}))
+                else:
+                    link_ops.append(UpdateOne(
+                        {'ref_id': index_id},
+                        {'$set': {
+                            'project_id': a.app_config.project_id,
+                            'project_shortname': a.project.shortname,
+                            'app_config_id': a.app_config._id,
+                            'app_mount': a.app_config.options.mount_point,
+                            'link': link,
+                            'url': a.url()}},
+                        upsert=True))
+                if a.link_content:
+                    l_ref_ids = g.artifact.find_shortlink_refs(
+                        unescape_unicode(a.link_content), upsert=True)
+                    for l_ref_id in filter(None, l_ref_ids):
+                        ref_link_ops.append(UpdateOne(
+                            {'_id': index_id,
+                             'references.index_id': {'$ne': l_ref_id}},
+                            {'$push': {'references': {
+                                'index_id': l_ref_id,
+                                'extra': None,
+                                'datetime': now}}}))
+                doc = solarize(a)
+                if doc:
+                    docs.append(doc)
+                    parent_doc = solarize(a.index_parent())
+                    if parent_doc:
+                        docs.append(parent_doc)
+            except Exception:
+                self.log.exception('Error reindexing %s', a)
+        # references must exist before links are pushed onto them
+        for cls, ops in ((ArtifactReference, ref_ops + ref_link_ops),
+                         (Shortlink, link_ops)):
+            if ops:
+                pymongo_db_collection(cls)[1].bulk_write(ops, ordered=True)
+        if docs:
+            g.solr_indexer.add(docs)
+        if self.options.verbose:
+            self.log.info('  indexed %d %s', len(artifacts),
+                          artifacts[0].__class__.__name__)
@@ -2,6 +2,8 @@ import os
 import signal
 from datetime import datetime, timedelta
 
+from paste.deploy.converters import asint
+
 from vulcanforge.common.tasks import index as index_tasks
 from vulcanforge.taskd import MonQTask
 from vulcanforge.taskd.util import test_running_taskd
@@ -19,18 +21,33 @@ class TaskdCommand(base.Command):
                       help='only handle tasks with a minimum priority higher '
                            'than or equal to this number. '
                            'The default priority is 1 which includes all tasks.')
+    parser.add_option('--concurrency', dest='concurrency', type='int',
+                      default=None,
+                      help='number of tasks to run at once on a thread pool '
+                           '(defaults to taskd.concurrency or 1)')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+                      default=None,
+                      help='maximum number of ready tasks to claim per '
+                           'round trip (defaults to taskd.batch_size or the '
+                           'concurrency)')
 
     def command(self):
         self.basic_setup()
         self.log.info('taskd pid %s starting', os.getpid())
         self.keep_running = True
         self.restart_when_done = False
+        concurrency = self.options.concurrency or \
+            asint(self.config.get('taskd.concurrency', 1))
+        batch_size = self.options.batch_size or \
+            asint(self.config.get('taskd.batch_size', concurrency))
         self.worker = TaskdWorker(
             self.args[0].split("#")[0],
             name='%s pid %s' % (os.uname()[1], os.getpid()),
             only=self.options.only,
             log=self.log,
-            min_priority=self.options.min_priority
+            min_priority=self.options.min_priority,
+            concurrency=concurrency,
+            batch_size=batch_size
         )
         signal.signal(signal.SIGHUP, self.worker.graceful_restart)
         signal.signal(signal.SIGTERM, self.worker.graceful_stop)
@@ -51,7 +68,8 @@ class TaskCommand(base.Command):
     parser.add_option('-s', '--state', dest='state', default='ready',
                       help='state of processes to examine')
     parser.add_option('-t', '--timeout', dest='timeout', type=int, default=60,
-                      help='timeout (in seconds) for busy tasks')
+                      help='timeout (in seconds) since the last heartbeat '
+                           'of busy tasks')
     min_args = 2
     max_args = None
     usage = '<ini file> [list|retry|purge|timeout|commit|test]'
@@ -96,12 +114,14 @@ class TaskCommand(base.Command):
             dict(state='complete', result_type='forget'))
 
     def _timeout(self):
-        """Reset tasks that have been busy too long to 'ready' state"""
+        """Requeue busy tasks whose worker has not heartbeat for too long"""
 
         self.log.info(
-            'Reset tasks stuck for %ss or more', self.options.timeout)
+            'Requeue tasks without a heartbeat for %ss or more',
+            self.options.timeout)
         cutoff = datetime.utcnow() - timedelta(seconds=self.options.timeout)
-        MonQTask.timeout_tasks(cutoff)
+        reaped = MonQTask.reap(cutoff)
+        self.log.info('Requeued %d tasks', len(reaped))
 
     def _test(self):
         """Run a test task with optional timeout"""
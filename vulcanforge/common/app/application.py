@@ -1,7 +1,9 @@
 import logging
 from cStringIO import StringIO
+from datetime import datetime
 import os
 
+from bson import ObjectId
 from ming.odm import session
 from ming.utils import LazyProperty
 import pkg_resources
@@ -201,10 +203,27 @@ class Application(object):
     @classmethod
     def artifact_counts_by_kind(cls, app_configs, app_visits, tool_name,
                                 trefs=[]):
+        """
+        Artifact counts of the tools of this kind among app_configs: all,
+        and new since the visit of each (an ObjectId, in app_visits by app
+        config id string). Tools count from their materialized counters
+        (see vulcanforge.artifact.model.ArtifactCounter) rather than
+        scanning their artifacts.
+
+        :param trefs: only count artifacts created in this time interval
+        :return: counts by app config id
+
+        """
         my_app_configs = {k: v for k, v in app_configs.items()
                           if v.tool_name == tool_name}
         return {x: dict(all=0, new=0) for x in my_app_configs}
 
+    @classmethod
+    def artifact_sizes(cls, app_configs):
+        """Storage used by the tools of this kind among app_configs, by app
+        config id, or None if the tool does not report its storage"""
+        return None
+
     def set_acl(self, acl_spec=None):
         """Install default acl. Note that we cannot modify the config acl
         directly, because ming does not note the change.
@@ -400,8 +419,21 @@ class Application(object):
     def get_global_navigation_data(self):
         raise NotImplementedError
 
+    @classmethod
+    def has_global_navigation_data(cls):
+        """Whether the app adds to the master navigation data, so that apps
+        need not be instantiated to find out"""
+        return cls.get_global_navigation_data.__func__ is not \
+            Application.get_global_navigation_data.__func__
+
     def artifact_counts(self, since=None):
-        return dict(
-            new=0,
-            all=0
-        )
+        app_configs = {self.config._id: self.config}
+        visits = {}
+        if isinstance(since, datetime):
+            visits[str(self.config._id)] = ObjectId.from_datetime(since)
+        counts = self.artifact_counts_by_kind(
+            app_configs, visits, self.config.tool_name)[self.config._id]
+        sizes = self.artifact_sizes(app_configs)
+        if sizes is not None:
+            counts['total_size'] = sizes.get(self.config._id, 0)
+        return counts
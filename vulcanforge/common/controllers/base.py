@@ -57,6 +57,7 @@ class WsgiDispatchController(BaseTGController):
         raise NotImplementedError('_cleanup_request')
 
     def __call__(self, environ, start_response):
+        from vulcanforge.cache.decorators import cache_rendered
         try:
             self._setup_request()
             response = super(WsgiDispatchController, self).__call__(
@@ -64,6 +65,9 @@ class WsgiDispatchController(BaseTGController):
             return self.cleanup_iterator(response)
         except exc.HTTPException as err:
             return err(environ, start_response)
+        finally:
+            # the response is rendered by now, or failed to render
+            cache_rendered.release_unrendered()
 
     def cleanup_iterator(self, response):
         for chunk in response:
@@ -63,6 +63,8 @@ class DebugUtilRootController(BaseController):
         result = {
             'keys': redis.keys('*')
         }
+        if hasattr(g.cache, 'stats'):
+            result['cache_stats'] = g.cache.stats()
         if key is not None:
             if redis.exists(key):
                 key_type = redis.type(key)
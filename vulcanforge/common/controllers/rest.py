@@ -11,18 +11,19 @@ https://B{<domain>}/rest/
 
 @undocumented
 """
+import hashlib
 import json
 import logging
 import urllib
 import oauth2 as oauth
 
+from collections import defaultdict
 from datetime import datetime
 
 from paste.util.converters import asbool
 from webob import exc
 from tg import expose, flash, redirect, config, TGController
 from pylons import tmpl_context as c, app_globals as g, request
-import pymongo
 from ming.odm import session
 from ming.utils import LazyProperty
 
@@ -47,7 +48,8 @@ from vulcanforge.common.util import (
 from vulcanforge.artifact.controllers import ArtifactRestController
 from vulcanforge.exchange.controllers.rest import GlobalExchangeRestController
 from vulcanforge.neighborhood.model import Neighborhood
-from vulcanforge.project.model import AppConfig, Project
+from vulcanforge.project import navdata
+from vulcanforge.project.model import AppConfig, AppConfigFile, Project
 from vulcanforge.websocket.controllers import WebSocketAPIController
 from vulcanforge.common.util.counts import (
     get_artifact_counts, get_exchange_counts
@@ -422,18 +424,23 @@ class WebAPIController(TGController):
     @expose('json')
     def navdata(self, **kwargs):
         if not g.cache:
-            return self._make_navdata()
-        cache_hash_name = 'navdata'
-        hash_key = c.user.username
-        cached = g.cache.hget_json(cache_hash_name, hash_key)
-        if cached:
-            return cached
-        new_navdata = self._make_navdata()
-        timeout = (10 * 60) if g.production_mode else 10
-        g.cache.hset_json(cache_hash_name, hash_key, new_navdata, timeout)
+            return self._make_navdata()[0]
+        cache_key = 'navdata.user.{}'.format(c.user._id)
+        cached = g.cache.get_json(cache_key)
+        if cached and \
+                navdata.get_versions(cached['versions']) == cached['versions']:
+            return cached['data']
+        new_navdata, versions = self._make_navdata()
+        g.cache.set_json(cache_key, {
+            'versions': versions,
+            'data': new_navdata
+        }, self._navdata_timeout())
         return new_navdata
 
-    def _make_navdata(self):
+    def _navdata_timeout(self):
+        return (10 * 60) if g.production_mode else 10
+
+    def _get_special_neighborhoods(self):
         """
         Special icons and labels configuration:
 
@@ -447,8 +454,8 @@ class WebAPIController(TGController):
                 }
             }
         """
-        SPECIAL_ICONS = {}
-        SPECIAL_LABELS = {}
+        special_icons = {}
+        special_labels = {}
         specials_key = 'masternav.special_neighborhoods'
         try:
             specials_config = json.loads(config.get(specials_key, '{}'))
@@ -458,75 +465,60 @@ class WebAPIController(TGController):
             for k, v in specials_config.items():
                 if 'icon' in v:
                     if v.get('icon_is_resource', False):
-                        SPECIAL_ICONS[k] = g.resource_manager.\
+                        special_icons[k] = g.resource_manager.\
                             absurl(v.get('icon'))
                     else:
-                        SPECIAL_ICONS[k] = v.get('icon')
+                        special_icons[k] = v.get('icon')
                 if 'label' in v:
-                    SPECIAL_LABELS[k] = v.get('label')
+                    special_labels[k] = v.get('label')
+        return special_icons, special_labels
 
-        hood_id_map = {}
-        project_id_map = {}
+    def _make_navdata(self):
+        """
+        Stitch the navdata of the current user together from the navdata
+        of each project, cached as fragments when redis is available.
 
-        hood_items = []
+        :returns: the navdata, and the versions of the navdata scopes it was
+            built from (see vulcanforge.project.navdata)
+
+        """
+        special_icons, special_labels = self._get_special_neighborhoods()
 
         hood_query_params = {
             'url_prefix': {'$nin': ['/u/', '//']}
         }
-        for hood in Neighborhood.query.find(hood_query_params):
-            if not g.security.has_access(hood, 'read'):
-                continue
-            project = hood.neighborhood_project
+        hoods = [hood for hood in Neighborhood.query.find(hood_query_params)
+                 if g.security.has_access(hood, 'read')]
+        hood_projects = [hood.neighborhood_project for hood in hoods]
+        projects = self._get_navdata_projects(
+            [hood._id for hood in hoods])
+
+        # read the versions before building anything from the scopes
+        scopes = [navdata.GLOBAL_SCOPE, navdata.user_scope(c.user._id)]
+        scopes.extend(navdata.project_scope(p._id)
+                      for p in hood_projects + projects)
+        versions = navdata.get_versions(scopes) if g.cache else {}
+        project_data = self._get_navdata_fragments(
+            hood_projects + projects, hoods, versions)
+
+        hood_id_map = {}
+        hood_items = []
+        for hood, project in zip(hoods, hood_projects):
             hood_data = {
-                'label': SPECIAL_LABELS.get(hood.url_prefix, hood.name),
+                'label': special_labels.get(hood.url_prefix, hood.name),
                 'url': hood.url(),
-                'icon': SPECIAL_ICONS.get(hood.url_prefix, hood.icon_url()),
+                'icon': special_icons.get(hood.url_prefix, hood.icon_url()),
                 'shortname': hood.url_prefix,
                 'children': [],
-                'tools': self._get_global_nav_tools_for_project(project),
+                'tools': project_data[project._id]['tools'],
                 'actions': self._get_global_nav_actions_for_hood(hood),
-                'specialIcon': hood.url_prefix in SPECIAL_ICONS
+                'specialIcon': hood.url_prefix in special_icons
             }
             hood_id_map[hood._id] = hood_data
             hood_items.append(hood_data)
-
-        # if authenticated, get projects using named roles
-        has_user = c.user is not None
-        if has_user:
-            project_cursor = []
-            for hood in hood_id_map:
-                project_cursor += c.user.my_projects(nbhd_id=hood)
-            project_cursor.sort(key=lambda x: x.sortable_name)
-        else:
-            project_query_params = {
-                'neighborhood_id': {
-                    '$in': hood_id_map.keys()
-                }
-            }
-            project_cursor = Project.query_find(project_query_params)
-            project_cursor.sort('sortable_name', pymongo.ASCENDING)
-        for project in project_cursor:
-            # if authenticated, avoid superfluous access checking
-            if has_user:
-                if project.deleted:
-                    continue
-            elif ( project.deleted and
-                    not g.security.has_access(project, 'write') or
-                    not g.security.has_access(project, 'read') or
-                    not project.first_mount('read')
-                ):
-                    continue
-            project_data = {
-                'label': project.name,
-                'url': project.url(),
-                'icon': project.icon_url,
-                'shortname': project.shortname,
-                'tools': self._get_global_nav_tools_for_project(project),
-                'actions': self._get_global_nav_actions_for_project(project)
-            }
-            project_id_map[project._id] = project_data
-            hood_id_map[project.neighborhood_id]['children'].\
-                append(project_data)
+        for project in projects:
+            hood_id_map[project.neighborhood_id]['children'].append(
+                project_data[project._id])
 
         root_item = self._get_global_nav_root_item()
         # compile output
@@ -539,7 +531,125 @@ class WebAPIController(TGController):
             "label": root_item['label'],
             "url": root_item['url'],
             "icon": root_item['icon']
+        }, versions
+
+    def _get_navdata_projects(self, hood_ids):
+        """Projects of the given neighborhoods in which the current user has
+        a named role, sorted by name"""
+        if c.user._id is None:
+            return []
+        credentials = g.security.credentials
+        user_roles = credentials.user_roles(c.user._id)
+        credentials.load_project_roles(
+            *set(role.project_id for role in user_roles))
+        project_ids = set(
+            role.project_id for role in user_roles.reaching_roles
+            if role.name)
+        if not project_ids:
+            return []
+        projects = Project.query_find({
+            '_id': {'$in': list(project_ids)},
+            'neighborhood_id': {'$in': hood_ids}
+        }).all()
+        projects = [project for project in projects if not project.deleted]
+        projects.sort(key=lambda x: x.sortable_name)
+        return projects
+
+    def _navdata_access_signature(self, project, hood_access):
+        """Identifies the access of the current user in project: users with
+        the same signature get the same navdata for it.
+
+        Built from the names of the roles the user reaches (including
+        *anonymous and *authenticated), not their ids: every member has a
+        role of their own, which would keep members from sharing fragments.
+
+        """
+        roles = g.security.credentials.user_roles(
+            user_id=c.user._id, project_id=project._id).reaching_roles
+        return hashlib.sha1(repr((
+            sorted(set(role.name for role in roles if role.name)),
+            hood_access.get(project.neighborhood_id)
+        ))).hexdigest()
+
+    def _get_navdata_fragments(self, projects, hoods, versions):
+        """
+        The navdata of each project for the current user, from the cache
+        when possible. Fragments are keyed by the project, the versions of
+        its scopes and the access signature of the user.
+
+        :returns: dict mapping project_id to navdata
+
+        """
+        project_ids = list(set(project._id for project in projects))
+        credentials = g.security.credentials
+        credentials.load_project_roles(*project_ids)
+        credentials.load_user_roles(c.user._id, *project_ids)
+        # has_access falls back to neighborhood admin and overseer roles
+        hood_access = dict(
+            (hood._id, (g.security.has_access(hood, 'admin'),
+                        g.security.has_access(hood, 'overseer')))
+            for hood in hoods)
+
+        result = {}
+        keys = {}
+        if g.cache:
+            for project in projects:
+                keys[project._id] = 'navdata.project.{}.{}.{}.{}'.format(
+                    project._id,
+                    versions[navdata.GLOBAL_SCOPE],
+                    versions[navdata.project_scope(project._id)],
+                    self._navdata_access_signature(project, hood_access))
+            for project_id, data in zip(
+                    keys.keys(), g.cache.mget_json(*keys.values())):
+                if data is not None:
+                    result[project_id] = data
+
+        missing = dict((project._id, project) for project in projects
+                       if project._id not in result)
+        built = self._get_global_nav_data_for_projects(missing.values())
+        result.update(built)
+        if g.cache and built:
+            g.cache.mset_json(
+                dict((keys[project_id], data)
+                     for project_id, data in built.iteritems()),
+                expiration=self._navdata_timeout())
+        return result
+
+    def _get_global_nav_data_for_projects(self, projects):
+        """Navdata of each project, loading their tools and icons in bulk
+
+        :returns: dict mapping project_id to navdata
+
+        """
+        if not projects:
+            return {}
+        project_ids = [project._id for project in projects]
+        app_configs = defaultdict(list)
+        for app_config in AppConfig.query.find({
+                'project_id': {'$in': project_ids}}).sort('options.ordinal'):
+            app_configs[app_config.project_id].append(app_config)
+        icon_query = {
+            'app_config_id': {'$in': [
+                ac._id for acs in app_configs.itervalues() for ac in acs]},
+            'category': 'icon',
+            'size': 32
         }
+        custom_icons = set(
+            icon.app_config_id
+            for icon in AppConfigFile.query.find(icon_query))
+        icon_urls = Project.icon_urls(projects)
+        result = {}
+        for project in projects:
+            result[project._id] = {
+                'label': project.name,
+                'url': project.url(),
+                'icon': icon_urls[project._id],
+                'shortname': project.shortname,
+                'tools': self._get_global_nav_tools_for_project(
+                    project, app_configs[project._id], custom_icons),
+                'actions': self._get_global_nav_actions_for_project(project)
+            }
+        return result
 
     def _get_global_nav_children(self):
         items = self._get_global_nav_exchanges()
@@ -602,31 +712,46 @@ class WebAPIController(TGController):
             })
         return actions
 
-    def _get_global_nav_tools_for_project(self, project):
+    def _get_global_nav_tools_for_project(self, project, app_configs=None,
+                                          custom_icons=None):
+        """
+        :param app_configs: the app configs of project, if already loaded
+        :param custom_icons: ids of the app configs with a custom icon, if
+            already known
+
+        """
         tools = []
         i = 0
-        for mount in project.ordered_mounts():
+        for mount in project.ordered_mounts(app_configs):
             i += 1
             if i == 1:  # skip the first mount for listing
                 continue
             app_config = mount.get('ac', None)
             if app_config is None or not app_config.is_visible_to(c.user):
                 continue
+            if custom_icons is None:
+                icon_url = app_config.icon_url(32)
+            else:
+                icon_url = app_config.icon_url(
+                    32, skip_lookup=app_config._id not in custom_icons)
             app_config_data = {
                 'label': app_config.options.mount_label,
                 'url': app_config.url(),
-                'icon': app_config.icon_url(32),
+                'icon': icon_url,
                 'shortname': app_config.options.mount_point,
                 'actions': [],
                 'children': []
             }
-            try:
-                app_instance = app_config.instantiate()
-                app_nav_data = app_instance.get_global_navigation_data()
-            except:
-                pass
-            else:
-                app_config_data.update(app_nav_data)
+            # only apps that add navigation data are instantiated
+            if app_config.load().has_global_navigation_data():
+                try:
+                    app_instance = app_config.instantiate()
+                    app_nav_data = app_instance.get_global_navigation_data()
+                except Exception:
+                    LOG.exception('Error getting navigation data of %s',
+                                  app_config.url())
+                else:
+                    app_config_data.update(app_nav_data)
             # special behavior for "home" mount point
             if app_config.options.get('mount_point', None) == 'home':
                 tools.insert(0, app_config_data)
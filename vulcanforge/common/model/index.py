@@ -1,5 +1,6 @@
 from pprint import pformat
 import logging
+from datetime import datetime
 from cPickle import dumps, loads
 
 import bson
@@ -64,6 +65,56 @@ class GlobalObjectReference(BaseMappedClass):
             LOG.exception('Error loading object for %s: %r', self._id, oref)
 
 
+class ReindexCheckpoint(BaseMappedClass):
+    """Progress of one partition (an app config) of a resumable reindex job.
+
+    `artifact_cls` and `last_id` record the last artifact whose references,
+    shortlinks and solr document were written, so an interrupted partition
+    picks up after it.
+
+    """
+    class __mongometa__:
+        session = main_orm_session
+        name = 'reindex_checkpoint'
+        indexes = [('job', 'state')]
+        unique_indexes = [('job', 'app_config_id')]
+
+    _id = FieldProperty(S.ObjectId)
+    job = FieldProperty(str)
+    app_config_id = FieldProperty(S.ObjectId)
+    state = FieldProperty(
+        S.OneOf('pending', 'busy', 'done', 'error'), if_missing='pending')
+    process = FieldProperty(str, if_missing=None)
+    artifact_cls = FieldProperty(str, if_missing=None)
+    last_id = FieldProperty(S.Anything, if_missing=None)
+    count = FieldProperty(int, if_missing=0)
+    error = FieldProperty(str, if_missing=None)
+    mod_date = FieldProperty(datetime, if_missing=datetime.utcnow)
+
+    @classmethod
+    def claim(cls, job, process):
+        """Lock the next pending partition of `job` to `process`"""
+        return cls.query.find_and_modify(
+            query={'job': job, 'state': 'pending'},
+            update={'$set': {'state': 'busy', 'process': process,
+                             'mod_date': datetime.utcnow()}},
+            new=True)
+
+    def advance(self, artifact_cls, last_id, count):
+        self.query.update({'$set': {
+            'artifact_cls': artifact_cls,
+            'last_id': last_id,
+            'mod_date': datetime.utcnow()
+        }, '$inc': {'count': count}})
+
+    def finish(self, state='done', error=None):
+        self.query.update({'$set': {
+            'state': state,
+            'error': error,
+            'mod_date': datetime.utcnow()
+        }})
+
+
 class SOLRIndexed(BaseMappedClass):
     """
     The base class for SOLR indexed objects. Objects can extend this just like
@@ -41,23 +41,86 @@ class VFSessionExtension(SessionExtension):
         self.objects_deleted = []
 
 
+def flushed_counter_values(obj):
+    """What the last flushed document of a counted artifact adds to the
+    counter of its tool.
+
+    Ming sets original_document only when a document is loaded (to an empty
+    one for new objects), so the values are kept in the object state after
+    each flush.
+
+    """
+    st = state(obj)
+    try:
+        return st.extra_state['counter_values']
+    except KeyError:
+        return obj.__class__.counter_values(st.original_document)
+
+
 class ArtifactSessionExtension(VFSessionExtension):
 
+    def __init__(self, session):
+        super(ArtifactSessionExtension, self).__init__(session)
+        self.counter_deltas = {}
+        self.flushed_values = []
+
+    def before_flush(self, obj=None):
+        super(ArtifactSessionExtension, self).before_flush(obj)
+        self.counter_deltas = {}
+        self.flushed_values = []
+        changes = []
+        for obj in self.objects_added + self.objects_modified:
+            changes.append((obj, state(obj).document))
+        for obj in self.objects_deleted:
+            changes.append((obj, None))
+        for obj, new in changes:
+            cls = obj.__class__
+            if not getattr(cls, 'counted', False):
+                continue
+            new_values = cls.counter_values(new)
+            self.flushed_values.append((obj, new_values))
+            if obj.app_config_id not in self.counter_deltas:
+                self.counter_deltas[obj.app_config_id] = (obj, {})
+            delta = self.counter_deltas[obj.app_config_id][1]
+            for name, value in flushed_counter_values(obj).iteritems():
+                delta[name] = delta.get(name, 0) - value
+            for name, value in new_values.iteritems():
+                delta[name] = delta.get(name, 0) + value
+
+    def update_counters(self):
+        """Apply the changes of the flush to the counters of its tools"""
+        from vulcanforge.artifact.model import ArtifactCounter
+        for obj, values in self.flushed_values:
+            state(obj).extra_state['counter_values'] = values
+        self.flushed_values = []
+        for app_config_id, (obj, delta) in self.counter_deltas.iteritems():
+            try:
+                app_config = obj.app_config
+                if app_config is not None:
+                    ArtifactCounter.increment(
+                        app_config.project_id, app_config_id, **delta)
+            except Exception:
+                LOG.exception('Error updating the artifact counter of %s',
+                              app_config_id)
+        self.counter_deltas = {}
+
     def index_deleted(self, deleted_specs):
         """deleted_specs should be a list of dictionaries with keys
         ref_id, index_parent_ref_id
 
         """
         from vulcanforge.artifact.tasks import del_artifacts
-        del_artifacts.post(deleted_specs)
+        del_artifacts.post(deleted_specs, taskd_coalesce=True)
 
     def index_new(self, new_ref_ids, mod_dates=None):
         """Added or modified"""
         from vulcanforge.artifact.tasks import add_artifacts
-        add_artifacts.post(new_ref_ids, mod_dates=mod_dates)
+        add_artifacts.post(new_ref_ids, mod_dates=mod_dates,
+                           taskd_coalesce=True)
 
     def after_flush(self, obj=None):
         """Update artifact references, and add/update this artifact to solr"""
+        self.update_counters()
         if not getattr(self.session, 'disable_artifact_index', False):
             from vulcanforge.artifact.model import ArtifactReference, Shortlink
             from vulcanforge.exchange.model import ExchangeableArtifact, \
@@ -144,9 +207,10 @@ class SOLRSessionExtension(VFSessionExtension):
         if self.objects_deleted:
             del_global_objs.post([
                 obj.index_id() for obj in self.objects_deleted
-            ])
+            ], taskd_coalesce=True)
         if refs:
-            add_global_objs.post([ref._id for ref in refs])
+            add_global_objs.post([ref._id for ref in refs],
+                                 taskd_coalesce=True)
 
         super(SOLRSessionExtension, self).after_flush(obj)
 
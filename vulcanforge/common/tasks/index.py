@@ -88,6 +88,7 @@ def reindex_tool(app_config_id=None):
 
 @task
 def commit():
+    g.solr_indexer.flush()
     g.solr.commit()
 
 
@@ -128,7 +129,7 @@ def add_global_objs(ref_ids):
             exceptions.append(sys.exc_info())
 
     if global_docs:
-        g.solr.add(global_docs)
+        g.solr_indexer.add(global_docs)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
@@ -140,6 +141,5 @@ def add_global_objs(ref_ids):
 def del_global_objs(ref_ids):
     from vulcanforge.common.model.index import GlobalObjectReference
     LOG.info('del_global_objs')
-    for ref_id in ref_ids:
-        g.solr.delete(id=ref_id)
+    g.solr_indexer.delete(ref_ids)
     GlobalObjectReference.query.remove(dict(_id={'$in': ref_ids}))
@@ -1,14 +1,21 @@
-from bson import ObjectId
-from bson.code import Code
+import logging
+from collections import defaultdict
 from datetime import datetime
 
-from ming.odm.odmsession import ThreadLocalODMSession
-from pylons import app_globals as g, tmpl_context as c
+from bson import ObjectId
+from pylons import app_globals as g
+from pymongo import UpdateOne, DeleteMany
 
+from vulcanforge.artifact.model import ArtifactCounter
+from vulcanforge.artifact.util import iter_artifact_classes
 from vulcanforge.auth.model import AppVisit, ToolsInfo
+from vulcanforge.common.app import Application
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.exchange.model import ExchangeVisit
 from vulcanforge.exchange.solr import exchange_access_filter
-from vulcanforge.project.model import Project, AppConfig
+from vulcanforge.project.model import Project, AppConfig, ProjectRole
+
+LOG = logging.getLogger(__name__)
 
 
 def get_exchange_counts(user, xchng_name):
@@ -127,10 +134,17 @@ def get_exchange_counts(user, xchng_name):
     }
 
 
+def _counts_by_instance(app_cls):
+    """Whether an app only counts its artifacts per instance"""
+    return (app_cls.artifact_counts.__func__ is not
+            Application.artifact_counts.__func__ and
+            app_cls.artifact_counts_by_kind.__func__ is
+            Application.artifact_counts_by_kind.__func__)
+
+
 def get_artifact_counts(user, project_shortname=None, permission="read",
                         project_ids=None):
     """Returns tool information for user's projects, or a specific project"""
-    tools = []
     av_query = {"user_id": user._id}
     if project_shortname:
         project = Project.by_shortname(project_shortname)
@@ -150,26 +164,54 @@ def get_artifact_counts(user, project_shortname=None, permission="read",
     for app_visit in app_visits:
         visit_times[app_visit.app_config_id] = app_visit.last_visit
 
-    for ac in AppConfig.query.find(ac_query):
-        if ac.has_access(permission, user):
-            try:
-                app = ac.instantiate()
-                last_visit = visit_times.get(ac._id, None)
-                artifact_counts = app.artifact_counts(since=last_visit)
-                if last_visit is None:
-                    artifact_counts['new'] = 0
-                tools.append({
-                    "url": ac.url(),
-                    "id": str(ac._id),
-                    "tool_name": ac.tool_name,
-                    "mount_label": ac.options.mount_label,
-                    "project_shortname": ac.project.shortname,
-                    "project_name": ac.project.name,
-                    "artifact_counts": artifact_counts,
-                    "last_visited": visit_times.get(ac._id, None)
-                })
-            except:
-                pass
+    app_configs = [ac for ac in AppConfig.query.find(ac_query)
+                   if ac.has_access(permission, user)]
+    visits = {str(ac._id): ObjectId.from_datetime(visit_times[ac._id])
+              for ac in app_configs if visit_times.get(ac._id)}
+    by_tool = defaultdict(dict)
+    for ac in app_configs:
+        by_tool[ac.tool_name][ac._id] = ac
+
+    # count by kind from the counters, without instantiating the apps
+    counts = {}
+    for tool_name, tool_app_configs in by_tool.items():
+        tool = g.tool_manager.tools.get(tool_name.lower())
+        if tool is None:
+            continue
+        app_cls = tool['app']
+        try:
+            if _counts_by_instance(app_cls):
+                for ac in tool_app_configs.values():
+                    counts[ac._id] = ac.instantiate().artifact_counts(
+                        since=visit_times.get(ac._id))
+                continue
+            counts.update(app_cls.artifact_counts_by_kind(
+                tool_app_configs, visits, tool_name))
+            sizes = app_cls.artifact_sizes(tool_app_configs)
+            if sizes is not None:
+                for ac_id in tool_app_configs:
+                    counts[ac_id]['total_size'] = sizes.get(ac_id, 0)
+        except Exception:
+            LOG.exception('Error counting the artifacts of %s tools',
+                          tool_name)
+
+    tools = []
+    for ac in app_configs:
+        if ac._id not in counts:
+            continue
+        artifact_counts = counts[ac._id]
+        if ac._id not in visit_times:
+            artifact_counts['new'] = 0
+        tools.append({
+            "url": ac.url(),
+            "id": str(ac._id),
+            "tool_name": ac.tool_name,
+            "mount_label": ac.options.mount_label,
+            "project_shortname": ac.project.shortname,
+            "project_name": ac.project.name,
+            "artifact_counts": artifact_counts,
+            "last_visited": visit_times.get(ac._id, None)
+        })
 
     return {'tools': tools}
 
@@ -189,115 +231,187 @@ def get_time_references(time_range):
     return {}
 
 
-def get_home_info(role_coll, app_configs, app_visits, tool_name, trefs=[]):
-    my_app_configs = {k: v for k, v in app_configs.items()
-                      if v.tool_name == tool_name}
-    my_app_visits = {str(x.project_id): app_visits[str(x._id)]
-                     for x in my_app_configs.values()}
-    project_ids = {x.project_id: x for x in my_app_configs.values()}
-
-    base_query = {"project_id": {"$in": project_ids.keys()},
-                  "user_id": {"$ne": None},
-                  "roles": {"$ne": []}}
+def _tool_app_configs(app_configs, tool_name):
+    return {k: v for k, v in app_configs.items() if v.tool_name == tool_name}
+
+
+def count_new(coll, key_field, visits, query=None, trefs=None,
+              distinct_field=None):
+    """
+    Count the documents of each key created since its visit, in one
+    aggregation.
+
+    :param key_field: field of the keys, e.g. app_config_id
+    :param visits: ObjectId of the time of the last visit, by key
+    :param distinct_field: count the distinct values of this field instead
+    :return: counts by key
+
+    """
+    clauses = [{key_field: key, "_id": {"$gt": visit}}
+               for key, visit in visits.items() if visit is not None]
+    if not clauses:
+        return {}
+    match = dict(query or {})
+    match["$or"] = clauses
     # time reference interval
     if trefs:
-        base_query.update(get_time_references(trefs))
-    reducer = Code("""
-                    function(obj, gcounts) {
-                        var visits = %s;
-                        gcounts.all++;
-                        var ac = obj.project_id.str;
-                        if (obj._id > visits[ac]) {
-                            gcounts.new++;
-                        }
-                    }
-                    """ % my_app_visits)
-    # perform query
-    result = role_coll.group(key=["project_id"],
-                             condition=base_query,
-                             initial=dict(all=0, new=0),
-                             reduce=reducer)
-    # restructure
-    retval = {x: dict(all=0, new=0) for x in my_app_configs}
-    for item in result:
-        ac_id = project_ids[item['project_id']]._id
-        retval[ac_id] = {x: int(item[x]) for x in ('all', 'new')}
-    return retval
+        match.update(get_time_references(trefs))
+    pipeline = [{"$match": match}]
+    group_id = "$" + key_field
+    if distinct_field:
+        pipeline.append({"$group": {"_id": {
+            "key": group_id, "distinct": "$" + distinct_field}}})
+        group_id = "$_id.key"
+    pipeline.append({"$group": {"_id": group_id, "new": {"$sum": 1}}})
+    return {item["_id"]: item["new"] for item in coll.aggregate(pipeline)}
+
+
+def _visits_by_app_config(app_configs, app_visits):
+    return {ac_id: app_visits[str(ac_id)]
+            for ac_id in app_configs if app_visits.get(str(ac_id))}
+
+
+def get_home_info(role_coll, app_configs, app_visits, tool_name, trefs=[]):
+    """member counts of the projects of home tools, by app config"""
+    my_app_configs = _tool_app_configs(app_configs, tool_name)
+    project_acs = {x.project_id: x._id for x in my_app_configs.values()}
+    counters = ArtifactCounter.for_projects(project_acs.keys())
+    visits = _visits_by_app_config(my_app_configs, app_visits)
+    new = count_new(
+        role_coll, "project_id",
+        {pid: visits.get(ac_id) for pid, ac_id in project_acs.items()},
+        {"user_id": {"$ne": None}, "roles": {"$ne": []}},
+        trefs)
+    return {ac_id: dict(all=counters.get(pid, {}).get('all', 0),
+                        new=new.get(pid, 0))
+            for pid, ac_id in project_acs.items()}
 
 
 def get_info(artifact_coll, app_configs, app_visits, tool_name,
              size_item, has_deleted=True, trefs=[]):
-    """returns tool info for user's projects for tools by kind"""
-    my_app_configs = {k: v for k, v in app_configs.items()
-                      if v.tool_name == tool_name }
-    my_app_visits = {k: v for k, v in app_visits.items()
-                     if ObjectId(k) in my_app_configs}
-    base_query = {"app_config_id": {"$in": my_app_configs.keys()}}
-    if has_deleted:
-        base_query["deleted"] = False
-    # time reference interval
-    if trefs:
-        base_query.update(get_time_references(trefs))
-    reducer = Code("""
-                    function(obj, gcounts) {
-                        var visits = %s;
-                        gcounts.all++;
-                        gcounts.total += obj.%s;
-                        var ac = obj.app_config_id.str;
-                        if (obj._id > visits[ac]) {
-                            gcounts.new++;
-                        }
-                    }
-                    """ % (my_app_visits, size_item))
-    #perform query
-    result = artifact_coll.group(key=["app_config_id"],
-                                 condition=base_query,
-                                 initial=dict(all=0, new=0, total=0),
-                                 reduce=reducer)
-    # restructure
-    counts = ["all", "new"]
-    if size_item:
-        counts.append("total")
-    retval = {x: {y: 0 for y in counts} for x in my_app_configs}
-    for item in result:
-        retval[item['app_config_id']] = {x: int(item[x]) for x in counts}
+    """returns tool info for user's projects for tools by kind
+
+    all (and the total size if size_item is given) come from the artifact
+    counters, new from artifact_coll
+
+    """
+    my_app_configs = _tool_app_configs(app_configs, tool_name)
+    counters = ArtifactCounter.for_app_configs(my_app_configs.keys())
+    query = {"deleted": False} if has_deleted else {}
+    new = count_new(
+        artifact_coll, "app_config_id",
+        _visits_by_app_config(my_app_configs, app_visits), query, trefs)
+    retval = {}
+    for ac_id in my_app_configs:
+        counter = counters.get(ac_id, {})
+        retval[ac_id] = dict(all=counter.get('all', 0), new=new.get(ac_id, 0))
+        if size_item:
+            retval[ac_id]['total'] = counter.get('total_size', 0)
     return retval
 
 
 def get_history_info(artifact_coll, app_configs, app_visits, tool_name,
                      trefs=[]):
-    """returns tool info for user's projects for tools by kind"""
-    my_app_configs = {k: v for k, v in app_configs.items()
-                      if v.tool_name == tool_name }
-    my_app_visits = {k: v for k, v in app_visits.items()
-                     if ObjectId(k) in my_app_configs}
-    base_query = {"app_config_id": {"$in": my_app_configs.keys()}}
-    # time reference interval
-    if trefs:
-        base_query.update(get_time_references(trefs))
-    reducer = Code("""
-                    function(obj, gcounts) {
-                        var visits = %s;
-                        gcounts.all++;
-                        var ac = obj.app_config_id.str;
-                        if (obj._id > visits[ac]) {
-                            gcounts.new++;
-                        }
-                    }
-                    """ % my_app_visits)
-    #perform query
-    result = artifact_coll.group(key=["app_config_id", "artifact_id"],
-                                 condition=base_query,
-                                 initial=dict(all=0, new=0),
-                                 reduce=reducer)
-    # restructure
-    retval = {x: dict(all=0, new=0) for x in my_app_configs}
-    for item in result:
-        ac_id = item['app_config_id']
-        retval[ac_id]['all'] += 1
-        if item['new']:
-            retval[ac_id]['new'] += 1
-    return retval
+    """returns tool info for user's projects for tools by kind
+
+    all comes from the artifact counters, new counts the artifacts with
+    history in artifact_coll since the visit
+
+    """
+    my_app_configs = _tool_app_configs(app_configs, tool_name)
+    counters = ArtifactCounter.for_app_configs(my_app_configs.keys())
+    new = count_new(
+        artifact_coll, "app_config_id",
+        _visits_by_app_config(my_app_configs, app_visits), trefs=trefs,
+        distinct_field="artifact_id")
+    return {ac_id: dict(all=counters.get(ac_id, {}).get('all', 0),
+                        new=new.get(ac_id, 0))
+            for ac_id in my_app_configs}
+
+
+def get_counter_sizes(app_configs):
+    """total size of the counted artifacts of each of app_configs"""
+    counters = ArtifactCounter.for_app_configs(app_configs)
+    return {ac_id: counters.get(ac_id, {}).get('total_size', 0)
+            for ac_id in app_configs}
+
+
+def get_attachment_sizes(attachment_cls, app_configs):
+    """total size of the attachments of each of app_configs"""
+    _, coll = pymongo_db_collection(attachment_cls)
+    return {item["_id"]: item["total_size"] for item in coll.aggregate([
+        {"$match": {"app_config_id": {"$in": list(app_configs)}}},
+        {"$group": {"_id": "$app_config_id",
+                    "total_size": {"$sum": "$length"}}}])}
+
+
+def reconcile_counters(project_ids=None):
+    """
+    Rebuild the artifact and member counters of the projects (all by
+    default) from their collections. Changes made while it runs may be lost
+    or counted twice.
+
+    :return: number of counters written, number of stale counters removed
+
+    """
+    _, ac_coll = pymongo_db_collection(AppConfig)
+    _, counter_coll = pymongo_db_collection(ArtifactCounter)
+    ac_query = {}
+    counter_query = {}
+    if project_ids is not None:
+        ac_query["project_id"] = {"$in": list(project_ids)}
+        counter_query["project_id"] = {"$in": list(project_ids)}
+    project_by_ac = {ac["_id"]: ac["project_id"] for ac in ac_coll.find(
+        ac_query, {"project_id": 1})}
+
+    # one class per collection, the most general
+    counted = {}
+    for a_cls in iter_artifact_classes():
+        if a_cls.counted:
+            db, coll = pymongo_db_collection(a_cls)
+            counted.setdefault((db.name, coll.name), (a_cls, coll))
+
+    counts = {}
+    for a_cls, coll in counted.values():
+        match = a_cls.counter_query()
+        if project_ids is not None:
+            match["app_config_id"] = {"$in": project_by_ac.keys()}
+        group = {"_id": "$app_config_id", "all": {"$sum": 1}}
+        if a_cls.counter_size_field:
+            group["total_size"] = {"$sum": "$" + a_cls.counter_size_field}
+        for item in coll.aggregate([{"$match": match}, {"$group": group}],
+                                   allowDiskUse=True):
+            project_id = project_by_ac.get(item["_id"])
+            if project_id is None:  # tool uninstalled
+                continue
+            values = counts.setdefault(
+                (project_id, item["_id"]), dict(all=0, total_size=0))
+            values["all"] += item["all"]
+            values["total_size"] += item.get("total_size") or 0
+
+    _, role_coll = pymongo_db_collection(ProjectRole)
+    match = {"user_id": {"$ne": None}, "roles": {"$ne": []}}
+    match.update(counter_query)
+    for item in role_coll.aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$project_id", "all": {"$sum": 1}}}],
+            allowDiskUse=True):
+        counts[(item["_id"], None)] = dict(all=item["all"], total_size=0)
+
+    ops = [UpdateOne({"project_id": project_id, "app_config_id": ac_id},
+                     {"$set": values}, upsert=True)
+           for (project_id, ac_id), values in counts.iteritems()]
+    stale_ids = [
+        counter["_id"] for counter in counter_coll.find(
+            counter_query, {"project_id": 1, "app_config_id": 1})
+        if (counter["project_id"], counter.get("app_config_id"))
+        not in counts]
+    if stale_ids:
+        ops.append(DeleteMany({"_id": {"$in": stale_ids}}))
+    if ops:
+        counter_coll.bulk_write(ops, ordered=False)
+    return len(counts), len(stale_ids)
+
 
 def get_tools_info(user, project_ids, permission="read", auth_user=None):
     timestamp = datetime.utcnow()
@@ -335,7 +449,10 @@ def get_tools_info(user, project_ids, permission="read", auth_user=None):
                     item['new'] = results[tool_name][id]['new']
                 else:
                     item['new'] += results[tool_name][id]['new']
-                item['all'] += results[tool_name][id]['all']
+                # the counts other than new are current totals
+                for key, value in results[tool_name][id].iteritems():
+                    if key != 'new':
+                        item[key] = value
             else:
                 item = results[tool_name][id]
             info[sid] = dict(item)
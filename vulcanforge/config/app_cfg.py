@@ -36,6 +36,7 @@ from vulcanforge.auth.authentication_provider import (
 from vulcanforge.auth.security_manager import SecurityManager
 from vulcanforge.auth.visibility_mode import VisibilityModeHandler
 from vulcanforge.cache.redis_cache import RedisCache
+from vulcanforge.cache.tiered_cache import TieredRedisCache
 from vulcanforge.common.helpers import slugify, split_subdomain
 from vulcanforge.common.util.debug import (
     profile_before_call,
@@ -53,7 +54,7 @@ from .tool_manager import ToolManager
 from .context_manager import ContextManager
 from vulcanforge.exchange.api import ExchangeManager
 from vulcanforge.s3.auth import SwiftAuthorizer
-from vulcanforge.search.solr import SolrSearch
+from vulcanforge.search.solr import SolrSearch, SolrIndexer
 from vulcanforge.search.util import MockSOLR
 from vulcanforge.taskd.queue import RedisQueue
 from vulcanforge.visualize.api import (
@@ -268,6 +269,19 @@ class ForgeConfig(AppConfig):
 
         config['pylons.app_globals'].solr = solr
         config['pylons.app_globals'].search = SolrSearch(solr)
+        if solr is not None:
+            # the mock indexes synchronously so tests see their documents
+            default_delay = 0 if isinstance(solr, MockSOLR) else 1.0
+            solr_indexer = SolrIndexer(
+                solr,
+                batch_size=asint(config.get('solr.index.batch_size', 100)),
+                max_delay=float(
+                    config.get('solr.index.max_delay', default_delay)),
+                commit_within=asint(
+                    config.get('solr.index.commit_within', 1000)))
+        else:  # pragma no cover
+            solr_indexer = None
+        config['pylons.app_globals'].solr_indexer = solr_indexer
 
     def setup_object_store(self):
         # Setup S3 connection
@@ -314,13 +328,22 @@ class ForgeConfig(AppConfig):
                 default_timeout = asint(config['redis.timeout'])
             else:
                 default_timeout = None
-            cache = RedisCache(
+            cache_kwargs = dict(
                 host=config['redis.host'],
                 port=asint(config.get('redis.port', 6379)),
                 db=asint(config.get('redis.db', 0)),
                 prefix=config.get('redis.prefix', ''),
                 default_timeout=default_timeout
             )
+            if asbool(config.get('redis.local_cache', True)):
+                cache = TieredRedisCache(
+                    local_size=asint(
+                        config.get('redis.local_cache.size', 1000)),
+                    local_timeout=asint(
+                        config.get('redis.local_cache.timeout', 30)),
+                    **cache_kwargs)
+            else:
+                cache = RedisCache(**cache_kwargs)
         else:
             cache = None
 
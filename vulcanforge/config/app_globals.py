@@ -13,9 +13,6 @@ import hashlib
 import posixpath
 
 import markdown
-import pygments
-import pygments.lexers
-import pygments.formatters
 from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c, request
 from tg import config, session
@@ -33,6 +30,12 @@ from vulcanforge.auth.widgets import Avatar
 from vulcanforge.config.render.markdown_ext.mdx_datasort_table import \
     DataSortTableExtension
 from vulcanforge.config.render.markdown_ext.mdx_forge import ForgeExtension
+from vulcanforge.config.render.highlight import Highlighter
+from vulcanforge.config.render.markdown_pool import (
+    MarkdownPool,
+    MarkdownCache,
+    MarkdownRenderer
+)
 import vulcanforge.events.tasks
 from vulcanforge.events.model import Event
 from vulcanforge.project.model import Project
@@ -86,9 +89,10 @@ class ForgeAppGlobals(object):
             'show_register_on_login', 'true'))
 
         # Setup pygments
-        self.pygments_formatter = pygments.formatters.HtmlFormatter(
-            cssclass='codehilite',
-            linenos='inline')
+        self.pygments_options = dict(cssclass='codehilite', linenos='inline')
+        self.highlight_cache_enabled = asbool(
+            config.get('highlight.cache', True))
+        self._highlighter = None
 
         # Setup analytics
         ga_account = config.get('ga.account', None)
@@ -267,6 +271,17 @@ class ForgeAppGlobals(object):
         # Specify in seconds
         self.s3_url_expires_in = asint(config.get('s3.url_expires_in', 30*60))
         self.s3_encryption = asbool(config.get('s3.encryption', False))
+        self.s3_serve_chunk_size = asint(
+            config.get('s3.serve_chunk_size', 64*1024))
+
+        # Markdown
+        self.markdown_pool = MarkdownPool(
+            self.forge_markdown,
+            max_idle=asint(config.get('markdown.pool_size', 8)))
+        self.markdown_cache_enabled = asbool(config.get('markdown.cache', True))
+        self.markdown_cache_timeout = asint(
+            config.get('markdown.cache_timeout', 86400))
+        self._markdown_cache = None
 
         # Clam AV
         self.clamav_enabled = asbool(config.get('antivirus.enabled', False))
@@ -485,30 +500,48 @@ class ForgeAppGlobals(object):
             classes += ' mountpoint-%s' % c.app.config.options.mount_point
         return classes
 
+    @property
+    def highlighter(self):
+        """Highlights in cached chunks, once redis is available"""
+        if self._highlighter is None:
+            cache = None
+            if self.highlight_cache_enabled:
+                cache = getattr(self, 'cache', None)
+                if not cache:
+                    return Highlighter()
+            self._highlighter = Highlighter(
+                cache=cache,
+                chunk_lines=asint(config.get('highlight.chunk_lines', 1000)),
+                time_budget=asint(
+                    config.get('highlight.time_budget', 1000)) / 1000.0,
+                max_entry_size=asint(
+                    config.get('highlight.cache_max_size', 256 * 1024)),
+                timeout=asint(config.get('highlight.cache_timeout', 86400)))
+        return self._highlighter
+
     def highlight(self, text, lexer=None, filename=None, no_text='Empty File'):
         if not text:
             return h.html.literal('<em>{}</em>'.format(no_text))
+        options = self.pygments_options
         if lexer == 'diff':
-            formatter = pygments.formatters.HtmlFormatter(
-                cssclass='codehilite', linenos=False)
-        else:
-            formatter = self.pygments_formatter
+            options = dict(options, linenos=False)
+        highlighter = self.highlighter
         if lexer is None:
-            try:
-                lexer = pygments.lexers.get_lexer_for_filename(
-                    filename, encoding='chardet')
-            except pygments.util.ClassNotFound:
+            lexer = highlighter.lexers.for_filename(filename)
+            if lexer is None:
                 # no highlighting, just escape
                 text = h.really_unicode(text)
                 text = cgi.escape(text)
                 return h.html.literal(u'<pre>' + text + u'</pre>')
         else:
-            lexer = pygments.lexers.get_lexer_by_name(
-                lexer, encoding='chardet')
-        return h.html.literal(pygments.highlight(text, lexer, formatter))
+            lexer = highlighter.lexers.by_name(lexer)
+        return highlighter.highlight(text, lexer, **options)
 
     def forge_markdown(self, **kwargs):
-        """return a markdown.Markdown object on which you can call convert"""
+        """return a new markdown.Markdown object on which you can call
+        convert. Prefer markdown_renderer, which reuses converters.
+
+        """
         extensions = [
             'codehilite',
             ForgeExtension(**kwargs),
@@ -522,18 +555,41 @@ class ForgeAppGlobals(object):
                                  extension_configs=extension_configs,
                                  output_format='html5')
 
+    @property
+    def markdown_cache(self):
+        """Cache of rendered markdown, if enabled and redis is available"""
+        if self._markdown_cache is None and self.markdown_cache_enabled \
+                and getattr(self, 'cache', None):
+            self._markdown_cache = MarkdownCache(
+                self.cache, timeout=self.markdown_cache_timeout)
+        return self._markdown_cache
+
+    def markdown_renderer(self, **kwargs):
+        """return an object with the convert method of a markdown.Markdown
+        object with the same options, using pooled converters and the
+        rendered markdown cache
+
+        """
+        return MarkdownRenderer(
+            self.markdown_pool, self.markdown_cache, **kwargs)
+
+    def invalidate_shortlinks(self, *tags):
+        """Drop rendered markdown that resolved the given shortlink tags"""
+        if self.markdown_cache is not None:
+            self.markdown_cache.invalidate(*tags)
+
     @property
     def markdown(self):
-        return self.forge_markdown()
+        return self.markdown_renderer()
 
     @property
     def markdown_wiki(self):
         project = getattr(c, 'project', None)
         if project is not None and project.shortname == '--init--':
-            return self.forge_markdown(wiki=True,
-                                       macro_context='neighborhood-wiki')
+            return self.markdown_renderer(wiki=True,
+                                          macro_context='neighborhood-wiki')
         else:
-            return self.forge_markdown(wiki=True)
+            return self.markdown_renderer(wiki=True)
 
     @property
     def production_mode(self):
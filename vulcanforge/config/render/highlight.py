@@ -0,0 +1,278 @@
+"""
+Syntax highlighting with memoized lexer lookups and a shared cache of
+highlighted output.
+
+Text is lexed as a whole and its token stream split into chunks of lines,
+each cached in redis by a hash of the text, the chunk, the lexer and the
+formatter options. A text that cannot be lexed within the time budget of
+a view is remembered as such, and from then on its chunks are lexed
+separately and cached by their own content: each view highlights chunks
+until its time budget runs out and shows the rest escaped, without
+highlighting, and later views pick up from the cached chunks. Only then
+may a construct spanning a chunk boundary (a long comment or string) be
+highlighted wrongly after it.
+
+"""
+import cgi
+import os
+import re
+import threading
+import time
+from fnmatch import translate
+from hashlib import sha1
+
+import pygments
+import pygments.lexers
+import pygments.formatters
+import pygments.util
+from webhelpers import html
+
+from vulcanforge.common.helpers import really_unicode
+
+# lexer options; leading blank lines of a chunk must be kept for its line
+# numbers to be right
+LEXER_OPTIONS = {'stripnl': False}
+
+
+class LexerMemo(object):
+    """
+    Lexers looked up by filename, memoized by extension.
+
+    Filenames that match a lexer pattern other than *.ext (Makefile,
+    CMakeLists.txt, *.html.twig...) are memoized by their whole name.
+
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lexers = {}
+        self._named_re = None
+        self._lock = threading.Lock()
+
+    def _named(self):
+        if self._named_re is None:
+            patterns = set()
+            for _, _, _, filenames, _ in pygments.lexers.LEXERS.itervalues():
+                patterns.update(p for p in filenames
+                                if not re.match(r'^\*\.[^.*?\[\]]+$', p))
+            self._named_re = re.compile(
+                '|'.join(translate(p) for p in patterns))
+        return self._named_re
+
+    def _memoized(self, key, lookup):
+        try:
+            return self._lexers[key]
+        except KeyError:
+            pass
+        try:
+            lexer = lookup()
+        except pygments.util.ClassNotFound:
+            lexer = None
+        with self._lock:
+            if len(self._lexers) >= self.max_size:
+                self._lexers.clear()
+            self._lexers[key] = lexer
+        return lexer
+
+    def for_filename(self, filename):
+        """The lexer of filename, or None if no lexer matches"""
+        if not filename:
+            return None
+        basename = os.path.basename(filename)
+        ext = os.path.splitext(basename)[1]
+        if ext and not self._named().match(basename):
+            key = ('ext', ext)
+        else:
+            key = ('filename', basename)
+        return self._memoized(key, lambda: pygments.lexers.
+                              get_lexer_for_filename(filename, **LEXER_OPTIONS))
+
+    def by_name(self, name):
+        """The lexer named name; raises ClassNotFound if there is none"""
+        lexer = self._memoized(
+            ('name', name),
+            lambda: pygments.lexers.get_lexer_by_name(name, **LEXER_OPTIONS))
+        if lexer is None:
+            raise pygments.util.ClassNotFound('no lexer for alias {!r}'.format(
+                name))
+        return lexer
+
+
+# shared by every user of lexer lookups
+lexers = LexerMemo()
+
+
+class ChunkFormatter(pygments.formatters.HtmlFormatter):
+    """HtmlFormatter output of a chunk of lines, without the div and pre"""
+
+    def wrap(self, source, *args):
+        return source
+
+
+class Highlighter(object):
+    """Highlights text in cached chunks; see the module docstring"""
+
+    key_prefix = 'highlight.'
+
+    def __init__(self, cache=None, chunk_lines=1000, time_budget=1.0,
+                 max_entry_size=256 * 1024, timeout=86400):
+        self.cache = cache
+        self.chunk_lines = chunk_lines
+        self.time_budget = time_budget
+        self.max_entry_size = max_entry_size
+        self.timeout = timeout
+        self.lexers = lexers
+        self.counts = dict(hits=0, misses=0, plain=0, oversize=0)
+
+    def make_key(self, chunk, lexer, options, context=None):
+        digest = sha1(repr((lexer.__class__.__name__, sorted(options.items()),
+                            context)))
+        digest.update(chunk.encode('utf-8'))
+        return self.key_prefix + digest.hexdigest()
+
+    def _format(self, chunk, lexer, options):
+        return pygments.highlight(chunk, lexer, ChunkFormatter(**options))
+
+    def _get_cached(self, key):
+        if self.cache is None:
+            return None
+        result = self.cache.get(key)
+        if result is None:
+            return None
+        self.counts['hits'] += 1
+        return result.decode('utf-8')
+
+    def _set_cached(self, key, result):
+        if self.cache is None:
+            return
+        encoded = result.encode('utf-8')
+        if len(encoded) <= self.max_entry_size:
+            self.cache.set(key, encoded, expiration=self.timeout)
+        else:
+            self.counts['oversize'] += 1
+
+    def _line_chunks(self, tokens):
+        """Split a token stream into lists of tokens of chunk_lines lines"""
+        chunk = []
+        lines = 0
+        for ttype, value in tokens:
+            start = 0
+            end = value.find(u'\n')
+            while end >= 0:
+                lines += 1
+                if lines == self.chunk_lines:
+                    chunk.append((ttype, value[start:end + 1]))
+                    yield chunk
+                    chunk = []
+                    lines = 0
+                    start = end + 1
+                end = value.find(u'\n', end + 1)
+            if start < len(value):
+                chunk.append((ttype, value[start:]))
+        if chunk:
+            yield chunk
+
+    def _plain(self, chunk, options):
+        """A chunk escaped, with the line numbers of HtmlFormatter but none
+        of its (much slower) token formatting"""
+        lines = cgi.escape(chunk).split(u'\n')
+        if options.get('linenos') in ('inline', 2):
+            start = options['linenostart']
+            width = len(str(start + len(lines) - 1))
+            lines = [u'<span class="lineno">{:>{}} </span>{}'.format(
+                start + i, width, line) for i, line in enumerate(lines)]
+        return u'\n'.join(lines) + u'\n'
+
+    def _highlight_chunk(self, chunk, lexer, options, render=True):
+        """The highlighted chunk, from the cache if it is there. Otherwise
+        None unless render is true."""
+        if self.cache is None:
+            return self._format(chunk, lexer, options) if render else None
+        key = self.make_key(chunk, lexer, options)
+        result = self._get_cached(key)
+        if result is not None or not render:
+            return result
+        self.counts['misses'] += 1
+        result = self._format(chunk, lexer, options)
+        self._set_cached(key, result)
+        return result
+
+    def _highlight_stream(self, text, chunks, lexer, options, deadline):
+        """
+        The chunks highlighted from one token stream of the whole text, from
+        the cache where they are there.
+
+        Stops at the first chunk that is not cached once the deadline has
+        passed, and then remembers that the text does not fit the time
+        budget.
+
+        @return: the highlighted chunks, from the first; fewer than chunks
+        if the deadline passed
+
+        """
+        context = sha1(text.encode('utf-8')).hexdigest()
+        slow_key = self.make_key(u'', lexer, options, ('slow', context))
+        if self.cache is not None and self.cache.get(slow_key):
+            return []
+        keys = [self.make_key(chunk, lexer, dict(options, linenostart=start),
+                              context)
+                for start, chunk in chunks]
+        parts = [self._get_cached(key) for key in keys]
+        if None not in parts:
+            return parts
+        if time.time() >= deadline:
+            return []
+        token_chunks = self._line_chunks(lexer.get_tokens(text))
+        for i, tokens in enumerate(token_chunks):
+            if i == len(parts):
+                break
+            if parts[i] is not None:
+                continue
+            if time.time() >= deadline:
+                if self.cache is not None:
+                    self.cache.set(slow_key, '1', expiration=self.timeout)
+                break
+            formatter = ChunkFormatter(
+                **dict(options, linenostart=chunks[i][0]))
+            parts[i] = pygments.format(tokens, formatter)
+            if self.cache is not None:
+                self.counts['misses'] += 1
+                self._set_cached(keys[i], parts[i])
+        if None in parts:
+            return parts[:parts.index(None)]
+        return parts
+
+    def highlight(self, text, lexer, **options):
+        """
+        Highlight text with lexer and HtmlFormatter options.
+
+        @return: html of the formatted text, in a div of the formatter's
+        cssclass
+
+        """
+        # line ends as the lexers see them
+        text = really_unicode(text).replace(u'\r\n', u'\n').replace(
+            u'\r', u'\n')
+        if text.endswith(u'\n'):
+            text = text[:-1]
+        lines = text.split(u'\n')
+        chunks = [
+            (start + 1, u'\n'.join(lines[start:start + self.chunk_lines]))
+            for start in xrange(0, len(lines), self.chunk_lines)]
+        deadline = time.time() + self.time_budget
+        parts = self._highlight_stream(text, chunks, lexer, options, deadline)
+        for linenostart, chunk in chunks[len(parts):]:
+            chunk_options = dict(options, linenostart=linenostart)
+            part = self._highlight_chunk(
+                chunk, lexer, chunk_options, render=time.time() < deadline)
+            if part is None:
+                self.counts['plain'] += 1
+                part = self._plain(chunk, chunk_options)
+            parts.append(part)
+        return html.literal(u'<div class="{}"><pre>{}</pre></div>'.format(
+            options.get('cssclass', 'highlight'), u''.join(parts)))
+
+    def stats(self):
+        stats = dict(self.counts)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+        return stats
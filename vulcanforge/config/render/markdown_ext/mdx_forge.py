@@ -21,6 +21,7 @@ from vulcanforge.artifact.model import Shortlink
 from vulcanforge.artifact.widgets import ArtifactLink
 from vulcanforge.common.helpers import urlquote
 
+from vulcanforge.config.render.markdown_pool import shortlink_tag
 from . import markdown_macro
 from .mdx_stash import StashProcessor, StashPattern
 from vulcanforge.visualize.markdown_ext import (
@@ -48,6 +49,7 @@ class ForgeExtension(OEmbedExtension):
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
+        md.forge_extension = self
         md.preprocessors['fenced-code'] = FencedCodeProcessor()
         md.preprocessors['comments'] = CommentProcessor()
         md.parser.blockprocessors.add('readmore',
@@ -67,6 +69,7 @@ class ForgeExtension(OEmbedExtension):
         self.oembed_consumer = self.prepare_oembed_consumer()
 
         # Visualizer Guy (must be after sanitize html and before link eater)
+        self.stash_processor = None
         if not self._simple_links:
             self.stash_processor = StashProcessor(
                 markdown=md,
@@ -98,6 +101,24 @@ class ForgeExtension(OEmbedExtension):
 
     def reset(self):
         self.forge_processor.reset()
+        if self.stash_processor is not None:
+            self.stash_processor.reset()
+
+    def is_cacheable(self):
+        """Whether the last conversion can be reused for the same text.
+        Macros and embedded visualizers and media render live content.
+
+        """
+        if self.forge_processor.stash['macro']:
+            return False
+        if self.stash_processor is not None and \
+                self.stash_processor.postprocessor.store:
+            return False
+        return True
+
+    def shortlink_tags(self):
+        """Tags of the shortlinks resolved by the last conversion"""
+        return self.forge_processor.shortlink_tags
 
 
 class OEmbedStashedPattern(StashPattern, OEmbedLinkPattern):
@@ -193,8 +214,17 @@ class ForgeProcessor(object):
 
     def compile(self):
         if self.stash['artifact'] or self.stash['link']:
-            self.alinks = Shortlink.from_links(*self.stash['artifact'])
-            self.alinks.update(Shortlink.from_links(*self.stash['link']))
+            links = self.stash['artifact'] + self.stash['link']
+            self.alinks = Shortlink.from_links(*links)
+            for link in links:
+                parsed = g.artifact.parse_shortlink(link)
+                if parsed:
+                    self.shortlink_tags.add(shortlink_tag(
+                        parsed['project'], parsed['artifact']))
+            if not self._simple_alinks:
+                self.artifacts = g.artifact.get_artifacts_by_index_ids([
+                    self.alinks[link].ref_id for link in self.stash['artifact']
+                    if self.alinks.get(link)])
         self.stash['artifact'] = map(self._expand_alink,
                                      self.stash['artifact'])
         self.stash['link'] = map(self._expand_link, self.stash['link'])
@@ -207,6 +237,8 @@ class ForgeProcessor(object):
             macro=[],
             link=[])
         self.alinks = {}
+        self.artifacts = {}
+        self.shortlink_tags = set()
         self.compiled = False
 
     def _de_escape_link(self, link):
@@ -218,8 +250,7 @@ class ForgeProcessor(object):
         if new_link:
             link_html = None
             if not self._simple_alinks:
-                artifact = g.artifact.get_artifact_by_index_id(
-                    new_link.ref_id)
+                artifact = self.artifacts.get(new_link.ref_id)
                 try:
                     link_html = self.artifact_link.display(
                         value=artifact, tag="span")
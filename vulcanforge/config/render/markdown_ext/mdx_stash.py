@@ -63,6 +63,9 @@ class StashProcessor(object):
     def register_match(self, placeholder, converted):
         self.postprocessor.store_match(placeholder, converted)
 
+    def reset(self):
+        self.postprocessor.store.clear()
+
 
 class StashPostProcessor(markdown.postprocessors.Postprocessor):
 
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Reusable markdown converters and a shared cache of their output.
+
+Building a forge markdown converter loads every extension and compiles
+their patterns, so converters are kept in a pool per configuration and
+reset between uses instead.
+
+Rendered html is cached in redis keyed by a hash of the text, the converter
+configuration and the context shortlinks are resolved in. Each entry is
+tagged with the shortlinks it resolved; changing a shortlink bumps the
+version of its tag, which invalidates only the entries that used it.
+
+"""
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from hashlib import sha1
+
+from pylons import tmpl_context as c, request
+from webhelpers import html
+
+LOG = logging.getLogger(__name__)
+
+
+class MarkdownPool(object):
+    """Idle markdown converters of each configuration, made by factory"""
+
+    def __init__(self, factory, max_idle=8):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.counts = dict(created=0, reused=0)
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def config_key(kwargs):
+        return tuple(sorted(kwargs.items()))
+
+    @contextmanager
+    def converter(self, **kwargs):
+        with self._lock:
+            idle = self._idle[self.config_key(kwargs)]
+            md = idle.pop() if idle else None
+            self.counts['reused' if md else 'created'] += 1
+        if md is None:
+            md = self.factory(**kwargs)
+        try:
+            yield md
+        finally:
+            try:
+                md.reset()
+            except Exception:
+                LOG.exception('Error resetting markdown converter')
+            else:
+                with self._lock:
+                    if len(idle) < self.max_idle:
+                        idle.append(md)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts,
+                        idle=sum(len(i) for i in self._idle.itervalues()))
+
+
+def shortlink_tag(project_shortname, link):
+    return u'{}:{}'.format(project_shortname, link)
+
+
+class MarkdownCache(object):
+    """Rendered markdown in a RedisCache, tagged by shortlink"""
+
+    key_prefix = 'markdown.html.'
+    tag_prefix = 'markdown.tag.'
+
+    def __init__(self, cache, timeout=86400):
+        self.cache = cache
+        self.timeout = timeout
+        self.counts = dict(hits=0, misses=0, stale=0, uncacheable=0)
+
+    def make_key(self, source, config_key):
+        try:
+            path_info = request.path_info
+        except TypeError:  # no request global registered
+            path_info = None
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        context = (
+            config_key,
+            getattr(project, '_id', None),
+            getattr(getattr(app, 'config', None), '_id', None),
+            # relative links are only rewritten on paths ending in /
+            path_info.endswith('/') if path_info is not None else None
+        )
+        digest = sha1(repr(context))
+        digest.update(source.encode('utf-8'))
+        return self.key_prefix + digest.hexdigest()
+
+    def _tag_name(self, tag):
+        return self.tag_prefix + sha1(tag.encode('utf-8')).hexdigest()
+
+    def _tag_version(self, tag):
+        return int(self.cache.get(self._tag_name(tag)) or 0)
+
+    def get(self, key):
+        entry = self.cache.get_json(key)
+        if entry is None:
+            self.counts['misses'] += 1
+            return None
+        for tag, version in entry['tags']:
+            if self._tag_version(tag) != version:
+                self.counts['stale'] += 1
+                return None
+        self.counts['hits'] += 1
+        return html.literal(entry['html'])
+
+    def set(self, key, rendered, tags):
+        # a shortlink changed while rendering can leave a wrong entry until
+        # it times out
+        self.cache.set_json(key, {
+            'html': unicode(rendered),
+            'tags': [(tag, self._tag_version(tag)) for tag in tags]
+        }, expiration=self.timeout)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.cache.incr(self._tag_name(tag))
+
+    def stats(self):
+        stats = dict(self.counts)
+        total = stats['hits'] + stats['misses'] + stats['stale']
+        stats['hit_rate'] = float(stats['hits']) / total if total else 0.0
+        return stats
+
+
+class MarkdownRenderer(object):
+    """
+    Stands in for a markdown.Markdown of the given configuration: convert
+    borrows a converter from the pool, and goes through the cache when one
+    is given.
+
+    """
+    def __init__(self, pool, cache=None, **kwargs):
+        self.pool = pool
+        self.cache = cache
+        self.kwargs = kwargs
+
+    def convert(self, source):
+        if not source:
+            source = u''
+        elif not isinstance(source, unicode):
+            source = source.decode('utf-8')
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(
+                source, self.pool.config_key(self.kwargs))
+            rendered = self.cache.get(key)
+            if rendered is not None:
+                return rendered
+        with self.pool.converter(**self.kwargs) as md:
+            rendered = md.convert(source)
+            if key is not None:
+                if all(ext.is_cacheable() for ext in md.registeredExtensions
+                       if hasattr(ext, 'is_cacheable')):
+                    self.cache.set(
+                        key, rendered, md.forge_extension.shortlink_tags())
+                else:
+                    self.cache.counts['uncacheable'] += 1
+        return rendered
+
+    def reset(self):
+        return self
@@ -0,0 +1,30 @@
+import logging
+
+from vulcanforge.migration.base import BaseMigration
+from vulcanforge.tools.downloads.model import ForgeDownloadsFile
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AddZipManifestHeaderOffsets(BaseMigration):
+
+    def run(self):
+        self.write_output('Adding header offsets to zip manifests...')
+        cursor = ForgeDownloadsFile.query.find({
+            'filename': {'$regex': '.zip'},
+            'deleted': False
+        })
+        count = 0
+        for f in cursor:
+            manifest = f.zip_manifest
+            if manifest and not all(
+                    'header_offset' in entry
+                    for entry in manifest.itervalues()):
+                f._populate_zip_manifest()
+                f.flush_self()
+                count += 1
+
+        self.write_output(
+            'Finished adding header offsets to {} zip manifests.'.format(
+                count))
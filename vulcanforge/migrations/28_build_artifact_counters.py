@@ -0,0 +1,15 @@
+import logging
+
+from vulcanforge.common.util.counts import reconcile_counters
+from vulcanforge.migration.base import BaseMigration
+
+
+LOG = logging.getLogger(__name__)
+
+
+class BuildArtifactCounters(BaseMigration):
+
+    def run(self):
+        self.write_output('Building artifact and member counters...')
+        written, removed = reconcile_counters()
+        self.write_output('Finished building {} counters.'.format(written))
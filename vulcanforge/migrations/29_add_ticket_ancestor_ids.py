@@ -0,0 +1,67 @@
+import logging
+
+from pymongo import UpdateOne
+
+from vulcanforge.common.util.model import pymongo_db_collection
+from vulcanforge.migration.base import BaseMigration
+from vulcanforge.tools.tickets.model import Globals, Ticket
+from vulcanforge.tools.tickets.model.rollup import coerce_sums
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AddTicketAncestorIds(BaseMigration):
+
+    def run(self):
+        self.write_output('Adding ancestor paths to subtickets...')
+        db, coll = pymongo_db_collection(Ticket)
+        super_ids = {}
+        current = {}
+        cursor = coll.find({'super_id': {'$ne': None}},
+                           {'super_id': 1, 'ancestor_ids': 1})
+        for doc in cursor:
+            super_ids[doc['_id']] = doc['super_id']
+            current[doc['_id']] = doc.get('ancestor_ids')
+
+        paths = {}
+
+        def path_of(ticket_id):
+            chain = []
+            while ticket_id in super_ids and ticket_id not in paths:
+                if ticket_id in chain:
+                    LOG.warning('Subticket cycle at ticket %s', ticket_id)
+                    break
+                chain.append(ticket_id)
+                ticket_id = super_ids[ticket_id]
+            path = [] if ticket_id in chain else paths.get(ticket_id, [])
+            for ticket_id in reversed(chain):
+                path = path + [super_ids[ticket_id]]
+                paths[ticket_id] = path
+            return path
+
+        requests = []
+        for ticket_id in super_ids:
+            path = path_of(ticket_id)
+            if current[ticket_id] != path:
+                requests.append(UpdateOne(
+                    {'_id': ticket_id}, {'$set': {'ancestor_ids': path}}))
+        if requests:
+            coll.bulk_write(requests, ordered=False)
+        self.write_output(
+            'Finished adding ancestor paths to {} subtickets.'.format(
+                len(requests)))
+
+        # sums are aggregated with $sum, which ignores strings
+        self.write_output('Converting numeric strings in sum fields...')
+        globals_db, globals_coll = pymongo_db_collection(Globals)
+        converted = 0
+        cursor = globals_coll.find({'custom_fields.type': 'sum'},
+                                   {'app_config_id': 1, 'custom_fields': 1})
+        for doc in cursor:
+            fields = [cf['name'] for cf in doc['custom_fields']
+                      if cf.get('type') == 'sum']
+            converted += coerce_sums(
+                coll, {'app_config_id': doc['app_config_id']}, fields)
+        self.write_output(
+            'Finished converting {} sum field values.'.format(converted))
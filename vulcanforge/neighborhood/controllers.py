@@ -32,6 +32,7 @@ from vulcanforge.auth.tasks import remove_workspacetabs
 from vulcanforge.neighborhood.marketplace.controllers import (
     NeighborhoodMarketplaceController)
 from vulcanforge.project.validators import MOUNTPOINT_VALIDATOR
+from vulcanforge.project import navdata
 from vulcanforge.project.model import (
     ProjectRole,
     ProjectFile
@@ -164,6 +165,7 @@ class NeighborhoodAdminController(BaseController):
                 icon.filename, icon.file, content_type=icon.type,
                 square=True, thumbnail_size=(48, 48),
                 thumbnail_meta=dict(neighborhood_id=hood._id, category="icon"))
+        navdata.bump_global()
 
     @vardec
     @expose()
@@ -441,7 +443,7 @@ class NeighborhoodController(BaseTGController):
                 thumbnail_size=(64, 64),
                 thumbnail_meta=dict(project_id=project._id, category='icon'))
             session(ProjectFile).flush()
-            g.cache.redis.expire('navdata', 0)
+            navdata.bump_project(project._id)
             if state(project).status != "dirty":
                 add_global_objs.post([project.index_id()])
 
@@ -18,8 +18,10 @@ Notifications are also available for use in feeds
 import cgi
 
 import logging
+import time
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import islice
 
 from bson import ObjectId
 import pymongo
@@ -33,7 +35,7 @@ from ming.odm import (
 )
 from ming.odm.declarative import MappedClass
 from ming.utils import LazyProperty
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 from webhelpers import feedgenerator as FG
 from webhelpers.text import truncate
 from pylons import tmpl_context as c, app_globals as g
@@ -43,6 +45,7 @@ import jinja2
 from vulcanforge.common.model.index import SOLRIndexed
 from vulcanforge.common.model.session import main_orm_session
 from vulcanforge.common.util import nonce
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.common.helpers import absurl
 from vulcanforge.artifact.model import ArtifactReference
 from vulcanforge.auth.model import User
@@ -57,6 +60,33 @@ LOG = logging.getLogger(__name__)
 MAILBOX_QUIESCENT = None  # Re-enable with [#1384]: timedelta(minutes=10)
 
 
+class MailBatch(object):
+    """
+    Collects direct notification emails while mailboxes are fired, so that
+    a notification going to many users is posted as a single sendmail task
+    whose recipients share SMTP transactions.
+
+    """
+    def __init__(self):
+        self.messages = {}
+        self.destinations = defaultdict(list)
+
+    def add(self, message_id, destination, **kwargs):
+        self.messages.setdefault(message_id, kwargs)
+        self.destinations[message_id].append(destination)
+
+    def flush(self):
+        for message_id, kwargs in self.messages.iteritems():
+            sendmail.post(destinations=self.destinations[message_id],
+                          message_id=message_id, **kwargs)
+        if self.messages:
+            LOG.info('Posted %d direct emails to %d recipients',
+                     len(self.messages),
+                     sum(len(d) for d in self.destinations.itervalues()))
+        self.messages.clear()
+        self.destinations.clear()
+
+
 class Notification(SOLRIndexed):
     class __mongometa__:
         name = 'notification'
@@ -227,7 +257,8 @@ class Notification(SOLRIndexed):
         n = cls._make_notification(artifact, topic, **kw)
         if n:
             session(n).flush(n)
-            notify.post(n._id, artifact.index_id(), topic)
+            notify.post([n._id], artifact.index_id(), topic,
+                        taskd_coalesce=True)
         return n
 
     @classmethod
@@ -427,23 +458,26 @@ class Notification(SOLRIndexed):
             image_dict.update(self.artifact.app.mime_image_dict)
         return image_dict
 
-    def send_direct(self, user_id):
+    def send_direct(self, user_id, batch=None):
         from_address = '"{} Notification" <{}>'.format(
             g.forge_name,
             g.forgemail_return_path)
-        sendmail.post(
-            destinations=[str(user_id)],
+        kwargs = dict(
             fromaddr=from_address,
             reply_to=self.reply_to_address,
             subject=self.subject,
             title_html=self.title_html,
-            message_id=self._id,
             in_reply_to=self.in_reply_to,
             text=self.text,
             artifact_html=self.artifact_html,
             footer_html=self.footer_html,
             mime_images=self.mime_images
         )
+        if batch is None:
+            sendmail.post(
+                destinations=[str(user_id)], message_id=self._id, **kwargs)
+        else:
+            batch.add(self._id, str(user_id), **kwargs)
 
     @classmethod
     def default_footer_html(cls):
@@ -760,12 +794,14 @@ class Mailbox(MappedClass):
         return cls.query.get(**query_params)
 
     @classmethod
-    def deliver(cls, nid, artifact_index_id, topic):
+    def deliver(cls, nids, artifact_index_id, topic):
         """Called in the notification message handler to deliver notification
         IDs to the appropriate  mailboxes.  Atomically appends the nids
         to the appropriate mailboxes.
 
         """
+        if not isinstance(nids, (list, tuple)):
+            nids = [nids]
         query = {
             'artifact_index_id': {'$in': [None, artifact_index_id]},
             'topic': {'$in': [None, topic]}
@@ -777,13 +813,38 @@ class Mailbox(MappedClass):
             })
         elif getattr(c, 'exchange', None):
             query['exchange_uri'] = c.exchange.config['uri']
-        for mbox in cls.query.find(query):
-            if mbox.user and mbox.user.active():
-                mbox.query.update(
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow())})
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
+        start = time.time()
+        chunk_size = asint(config.get('notification.deliver_chunk_size', 1000))
+        _, mbox_coll = pymongo_db_collection(cls)
+        _, user_coll = pymongo_db_collection(User)
+        update = {'$push': dict(queue={'$each': list(nids)}),
+                  '$set': dict(last_modified=datetime.utcnow())}
+        found = delivered = ops = 0
+        cursor = mbox_coll.find(query, {'_id': 1, 'user_id': 1}).batch_size(
+            chunk_size)
+        ops += 1
+        while True:
+            chunk = list(islice(cursor, chunk_size))
+            if not chunk:
+                break
+            found += len(chunk)
+            # one query for the mailbox owners that are active users
+            active_ids = set(u['_id'] for u in user_coll.find({
+                '_id': {'$in': list(set(m['user_id'] for m in chunk))},
+                'disabled': {'$ne': True},
+                'username': {'$nin': list(User.NOT_REAL_USERNAMES)}
+            }, {'_id': 1}))
+            mbox_ids = [m['_id'] for m in chunk
+                        if m['user_id'] in active_ids]
+            ops += 1
+            if mbox_ids:
+                mbox_coll.update_many({'_id': {'$in': mbox_ids}}, update)
+                delivered += len(mbox_ids)
+                ops += 1
+        LOG.info('Delivered %d notifications for %s %s to %d of %d mailboxes '
+                 'in %d mongo operations, %.0fms', len(nids),
+                 artifact_index_id, topic, delivered, found, ops,
+                 (time.time() - start) * 1000)
 
     @classmethod
     def fire_ready(cls):
@@ -801,12 +862,17 @@ class Mailbox(MappedClass):
         q_digest = dict(
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
-        for mbox in cls.query.find(q_direct):
-            mbox = cls.query.find_and_modify(
-                query=dict(_id=mbox._id),
-                update={'$set': dict(queue=[])},
-                new=False)
-            mbox.fire(now)
+        batch = MailBatch()
+        try:
+            for mbox in cls.query.find(q_direct):
+                mbox = cls.query.find_and_modify(
+                    query=dict(_id=mbox._id),
+                    update={'$set': dict(queue=[])},
+                    new=False)
+                mbox.fire(now, batch=batch)
+        finally:
+            # the queues of the mailboxes fired so far are already emptied
+            batch.flush()
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
             if mbox.frequency.unit == 'hour':
@@ -825,7 +891,7 @@ class Mailbox(MappedClass):
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    def fire(self, now, batch=None):
         # break out early if notifications are disabled for this project
         if self.project and self.project.disable_notification_emails:
             return
@@ -837,7 +903,7 @@ class Mailbox(MappedClass):
             ngroups = defaultdict(list)
             for n in notifications:
                 if n.topic == 'message':
-                    n.send_direct(self.user_id)
+                    n.send_direct(self.user_id, batch=batch)
                     # Messages must be sent individually so they can be replied
                     # to individually
                 else:
@@ -852,7 +918,7 @@ class Mailbox(MappedClass):
             for (subject, from_address, reply_to_address, author_id), ns \
                     in ngroups.iteritems():
                 if len(ns) == 1:
-                    n.send_direct(self.user_id)
+                    ns[0].send_direct(self.user_id, batch=batch)
                 else:
                     Notification.send_digest(
                         self.user_id,
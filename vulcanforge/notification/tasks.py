@@ -1,14 +1,17 @@
+import hashlib
 import logging
 import os
 
 import email
 import jinja2
 from BeautifulSoup import BeautifulSoup
+from paste.deploy.converters import asint
 from tg import config
 from pylons import tmpl_context as c, app_globals as g
 from bson import ObjectId
 from email.mime.image import MIMEImage
 
+from vulcanforge.cache.tiered_cache import LRUCache, MISSING
 from vulcanforge.common.util import push_config
 from vulcanforge.common.util.filesystem import module_resource_path
 from vulcanforge.taskd import task
@@ -36,6 +39,9 @@ _LOG_MSG = """
 """
 
 smtp_client = SMTPClient()
+_email_templates = {}
+_rendered_emails = None
+
 class LogoSingleton(object):
     mime_images = {}
 
@@ -61,6 +67,76 @@ def branding_logo():
             setattr(LogoSingleton, 'branding_logo', None)
 
 
+def email_templates():
+    """The jinja environment of email templates, built once per process"""
+    template_dir = config.get('notification.templates',
+                              'vulcanforge.notification')
+    templates = _email_templates.get(template_dir)
+    if templates is None:
+        templates = _email_templates[template_dir] = jinja2.Environment(
+            loader=jinja2.PackageLoader(template_dir, 'templates'))
+    return templates
+
+
+def email_markdown():
+    """A markdown converter for emails"""
+    return g.markdown_renderer(email=True)
+
+
+def rendered_emails():
+    """LRU cache of rendered email bodies, created on first use"""
+    global _rendered_emails
+    if _rendered_emails is None:
+        _rendered_emails = LRUCache(
+            max_size=asint(config.get('notification.render_cache_size', 200)),
+            timeout=asint(
+                config.get('notification.render_cache_timeout', 600)))
+    return _rendered_emails
+
+
+def render_email(text, html_text=None, title_html=None, artifact_html='',
+                 footer_html=''):
+    """Render the html and plain text bodies of an email.
+
+    Results are cached by content and context, so a digest or notification
+    sent to many recipients is rendered once.
+
+    :returns: full html, plain text
+
+    """
+    key = hashlib.sha1(repr((
+        text, html_text, title_html, artifact_html, footer_html,
+        g.context_manager.get_project_id(),
+        g.context_manager.get_app_config_id()
+    ))).hexdigest()
+    rendered = rendered_emails().get(key)
+    if rendered is not MISSING:
+        return rendered
+
+    if html_text is None:
+        html_text = email_markdown().convert(text)
+    try:
+        email_template = email_templates().get_template('mail/email.html')
+        context = {
+            'branding_logo': branding_logo(),
+            'title_html': title_html,
+            'body_html': html_text,
+            'artifact_html': email_markdown().convert(artifact_html),
+            'footer_html': email_markdown().convert(footer_html)
+        }
+        full_email_html = email_template.render(context)
+        # Remove unnecessary white spaces
+        full_email_html = os.linesep.join(
+            [s.strip() for s in full_email_html.splitlines() if s.strip()])
+    except Exception:
+        full_email_html = html_text
+
+    plain_text = ''.join(BeautifulSoup(html_text).findAll(text=True))
+    rendered = full_email_html, plain_text
+    rendered_emails().set(key, None, rendered)
+    return rendered
+
+
 def mime_image(cid, path):
     if LogoSingleton.mime_images.has_key(cid):
         return LogoSingleton.mime_images[cid]
@@ -81,9 +157,24 @@ def mime_image(cid, path):
             LogoSingleton.mime_images[cid] = None
 
 @task
-def notify(n_id, ref_id, topic):
+def notify(n_ids, ref_id, topic):
+    """Deliver notifications to mailboxes. `n_ids` may be a single
+    notification id or a list, so posts for the same artifact and topic can
+    be coalesced into a single task.
+
+    """
+    from vulcanforge.notification.model import Mailbox
+    Mailbox.deliver(n_ids, ref_id, topic)
+    Mailbox.fire_ready()
+
+
+@task
+def fire_mailboxes():
+    """Fire ready digest and summary mailboxes. Run as a recurring task so
+    digests go out on schedule even when no new notifications arrive.
+
+    """
     from vulcanforge.notification.model import Mailbox
-    Mailbox.deliver(n_id, ref_id, topic)
     Mailbox.fire_ready()
 
 
@@ -191,30 +282,8 @@ def sendmail(fromaddr, destinations, text, reply_to, subject, message_id,
         h = email.header.Header()
         h.append(g.forgemail_return_path)
         reply_to = h
-    if html_text is None:
-        html_text = g.forge_markdown(email=True).convert(text)
-
-    try:
-        template_dir = config.get('notification.templates',
-                                  'vulcanforge.notification')
-        templates = jinja2.Environment(
-            loader=jinja2.PackageLoader(template_dir, 'templates'))
-        email_template = templates.get_template('mail/email.html')
-        context = {
-            'branding_logo': branding_logo(),
-            'title_html': title_html,
-            'body_html': html_text,
-            'artifact_html': g.forge_markdown(email=True).convert(artifact_html),
-            'footer_html': g.forge_markdown(email=True).convert(footer_html)
-        }
-        full_email_html = email_template.render(context)
-        # Remove unnecessary white spaces
-        full_email_html = os.linesep.join(
-            [s.strip() for s in full_email_html.splitlines() if s.strip()])
-    except Exception:
-        full_email_html = html_text
-
-    plain_text = ''.join(BeautifulSoup(html_text).findAll(text=True))
+    full_email_html, plain_text = render_email(
+        text, html_text, title_html, artifact_html, footer_html)
     plain_msg = encode_email_part(plain_text, 'plain')
     html_msg = encode_email_part(full_email_html, 'html')
 
@@ -231,18 +300,15 @@ def sendmail(fromaddr, destinations, text, reply_to, subject, message_id,
     msg_parts = [plain_msg, html_msg, images]
     multi_msg = make_multipart_message(*msg_parts)
 
-    if addrs_multi:
+    # html readers get the multipart message too, so send them together
+    if addrs_multi or addrs_html:
         smtp_client.sendmail(
-            addrs_multi, fromaddr, reply_to, subject, message_id, in_reply_to,
-            multi_msg)
+            addrs_multi + addrs_html, fromaddr, reply_to, subject, message_id,
+            in_reply_to, multi_msg)
     if addrs_plain:
         smtp_client.sendmail(
             addrs_plain, fromaddr, reply_to, subject, message_id,
             in_reply_to, plain_msg)
-    if addrs_html:
-        smtp_client.sendmail(
-            addrs_html, fromaddr, reply_to, subject, message_id, in_reply_to,
-            multi_msg)
 
     log_emails = False
     if log_emails:
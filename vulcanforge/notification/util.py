@@ -1,6 +1,10 @@
 import re
+import time
+import socket
 import logging
 import smtplib
+import threading
+from contextlib import contextmanager
 import email.feedparser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -175,10 +179,235 @@ def isvalid(addr):
         return False
 
 
+class SMTPConnectionPool(object):
+    """
+    Authenticated SMTP connections kept open and shared between the sends of
+    a process.
+
+    At most `size` connections are open at once; callers beyond that wait
+    for one to be returned. Connections idle for longer than `idle_timeout`
+    seconds are closed rather than reused, since servers drop them anyway.
+
+    """
+    def __init__(self, host='localhost', port=25, ssl=False, tls=False,
+                 user=None, password=None, size=4, idle_timeout=60,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.counts = dict(
+            connects=0,
+            reuses=0,
+            discards=0,
+            sends=0,
+            recipients=0,
+            refused=0,
+            send_time=0.0,
+            max_waiting=0
+        )
+        self.waiting = 0
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config):
+        ssl = asbool(config.get('smtp_ssl', False))
+        return cls(
+            host=config.get('smtp_server', 'localhost'),
+            port=asint(config.get('smtp_port', 25 if ssl else 465)),
+            ssl=ssl,
+            tls=asbool(config.get('smtp_tls', False)),
+            user=config.get('smtp_user', None),
+            password=config.get('smtp_password', None),
+            size=asint(config.get('smtp.pool_size', 4)),
+            idle_timeout=asint(config.get('smtp.pool_idle', 60)),
+            timeout=asint(config.get('smtp.timeout', 30)))
+
+    def _connect(self):
+        if self.ssl:
+            smtp_client = smtplib.SMTP_SSL(
+                self.host, self.port, timeout=self.timeout)
+        else:
+            smtp_client = smtplib.SMTP(
+                self.host, self.port, timeout=self.timeout)
+        if self.user:
+            smtp_client.login(self.user, self.password)
+        if self.tls:
+            smtp_client.starttls()
+        with self._cond:
+            self.counts['connects'] += 1
+        return smtp_client
+
+    def _close(self, smtp_client):
+        try:
+            smtp_client.quit()
+        except (smtplib.SMTPException, socket.error):
+            smtp_client.close()
+
+    def get(self):
+        expired = []
+        with self._cond:
+            while True:
+                while self._idle:
+                    last_used, smtp_client = self._idle.pop()
+                    if last_used + self.idle_timeout > time.time():
+                        self.counts['reuses'] += 1
+                        break
+                    expired.append(smtp_client)
+                    self._open -= 1
+                else:
+                    smtp_client = None
+                if smtp_client is not None or self._open < self.size:
+                    break
+                self.waiting += 1
+                self.counts['max_waiting'] = max(
+                    self.counts['max_waiting'], self.waiting)
+                try:
+                    self._cond.wait()
+                finally:
+                    self.waiting -= 1
+            if smtp_client is None:
+                self._open += 1
+        for old_client in expired:
+            self._close(old_client)
+        if smtp_client is None:
+            try:
+                smtp_client = self._connect()
+            except Exception:
+                self._release()
+                raise
+        return smtp_client
+
+    def _release(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def put(self, smtp_client, discard=False):
+        if discard:
+            with self._cond:
+                self.counts['discards'] += 1
+            self._release()
+            smtp_client.close()
+            return
+        with self._cond:
+            self._idle.append((time.time(), smtp_client))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """A pooled connection, discarded if the server went away and reset
+        if a transaction was left half done.
+
+        """
+        smtp_client = self.get()
+        try:
+            yield smtp_client
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.put(smtp_client, discard=True)
+            raise
+        except Exception:
+            try:
+                smtp_client.rset()
+            except (smtplib.SMTPException, socket.error):
+                self.put(smtp_client, discard=True)
+            else:
+                self.put(smtp_client)
+            raise
+        else:
+            self.put(smtp_client)
+
+    def send(self, smtp_client, from_addr, to_addrs, msg):
+        """Send one transaction, returning the refused recipients"""
+        start = time.time()
+        try:
+            refused = smtp_client.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        with self._cond:
+            self.counts['sends'] += 1
+            self.counts['recipients'] += len(to_addrs) - len(refused)
+            self.counts['refused'] += len(refused)
+            self.counts['send_time'] += time.time() - start
+        return refused
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for last_used, smtp_client in idle:
+            self._close(smtp_client)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counts,
+                         open=self._open,
+                         idle=len(self._idle),
+                         waiting=self.waiting)
+        stats['avg_send_ms'] = 1000 * stats['send_time'] / stats['sends'] \
+            if stats['sends'] else 0.0
+        return stats
+
+
 class SMTPClient(object):
+    """
+    Sends messages through a SMTPConnectionPool.
 
-    def __init__(self):
-        self._client = None
+    By default each recipient gets a transaction of its own with its address
+    in the To header. With a batch_size above 1, recipients are grouped up to
+    batch_size per transaction under the To header batch_to instead.
+
+    """
+    def __init__(self, pool=None, batch_size=None, batch_to=None,
+                 return_path=None):
+        self._pool = pool
+        self._batch_size = batch_size
+        self._batch_to = batch_to
+        self._return_path = return_path
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = SMTPConnectionPool.from_config(tg.config)
+        return self._pool
+
+    @property
+    def batch_size(self):
+        if self._batch_size is None:
+            return asint(tg.config.get('smtp.batch_size', 1))
+        return self._batch_size
+
+    @property
+    def batch_to(self):
+        if self._batch_to is None:
+            return tg.config.get('smtp.batch_to', 'undisclosed-recipients:;')
+        return self._batch_to
+
+    @property
+    def return_path(self):
+        return self._return_path or config.return_path
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+    def _set_header(self, message, name, value, charset):
+        del message[name]
+        message[name] = Header(value, charset)
 
     def sendmail(self, addresses, addrfrom, reply_to, subject, message_id,
                  in_reply_to, message):
@@ -187,15 +416,16 @@ class SMTPClient(object):
         charset = message.get_charset()
         if charset is None:
             charset = 'iso-8859-1'
-        message['From'] = Header(addrfrom, charset)
-        message['Reply-To'] = Header(reply_to, charset)
-        message['Subject'] = Header(subject, charset)
-        message['Message-ID'] = Header('<' + message_id + '>', charset)
+        self._set_header(message, 'From', addrfrom, charset)
+        self._set_header(message, 'Reply-To', reply_to, charset)
+        self._set_header(message, 'Subject', subject, charset)
+        self._set_header(
+            message, 'Message-ID', '<' + message_id + '>', charset)
         if in_reply_to:
             if isinstance(in_reply_to, basestring):
                 in_reply_to = [ in_reply_to ]
             in_reply_to = ','.join(('<' + irt + '>') for irt in in_reply_to)
-            message['In-Reply-To'] = Header(in_reply_to, charset)
+            self._set_header(message, 'In-Reply-To', in_reply_to, charset)
 
         def iter_smtp_addresses():
             for address in addresses:
@@ -207,28 +437,35 @@ class SMTPClient(object):
             LOG.warning('No valid addrs in %s, so not sending mail',
                 map(unicode, addresses))
             return
-        self._connect()
-        send_errors = {}
-        for address, smtp_address in smtp_addresses:
-            message['To'] = Header(address, charset)
-            send_response = self._client.sendmail(config.return_path,
-                                                  [smtp_address],
-                                                  message.as_string())
-            send_errors.update(send_response)
-        self._client.quit()
-        return send_errors
 
-    def _connect(self):
-        if asbool(tg.config.get('smtp_ssl', False)):
-            smtp_client = smtplib.SMTP_SSL(
-                tg.config.get('smtp_server', 'localhost'),
-                asint(tg.config.get('smtp_port', 25)))
+        batch_size = self.batch_size
+        if batch_size > 1:
+            pending = [
+                (self.batch_to,
+                 [smtp_address for address, smtp_address
+                  in smtp_addresses[i:i + batch_size]])
+                for i in range(0, len(smtp_addresses), batch_size)]
         else:
-            smtp_client = smtplib.SMTP(
-                tg.config.get('smtp_server', 'localhost'),
-                asint(tg.config.get('smtp_port', 465)))
-        if tg.config.get('smtp_user', None):
-            smtp_client.login(tg.config['smtp_user'], tg.config['smtp_password'])
-        if asbool(tg.config.get('smtp_tls', False)):
-            smtp_client.starttls()
-        self._client = smtp_client
+            pending = [(address, [smtp_address])
+                       for address, smtp_address in smtp_addresses]
+        pending.reverse()
+
+        send_errors = {}
+        reconnected = False
+        while pending:
+            try:
+                with self.pool.connection() as smtp_client:
+                    while pending:
+                        to, rcpts = pending[-1]
+                        self._set_header(message, 'To', to, charset)
+                        send_errors.update(self.pool.send(
+                            smtp_client, self.return_path, rcpts,
+                            message.as_string()))
+                        pending.pop()
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # pooled connections may have been dropped by the server
+                if reconnected:
+                    raise
+                reconnected = True
+                LOG.info('SMTP connection lost, reconnecting')
+        return send_errors
@@ -34,7 +34,9 @@ from vulcanforge.common.util import title_sort, push_config
 from vulcanforge.common.util.exception import exceptionless
 from vulcanforge.auth.schema import ACL, ACE, EVERYONE
 from vulcanforge.common.util.diff import get_dict_diff_have_keys_changed
+from vulcanforge import websocket
 from vulcanforge.neighborhood.model import Neighborhood
+from vulcanforge.project import navdata
 from vulcanforge.project.tasks import (
     unindex_project,
     reindex_project,
@@ -52,38 +54,120 @@ class ImproperRoleException(ForgeError):
     pass
 
 
+def publish_authorization_change(role=None):
+    """Tell websocket connections to authorize their channels again: those
+    of the role's user, or all of them when no user is concerned.
+
+    """
+    if not g.cache or not g.websocket_enabled:
+        return
+    username = None
+    if role is not None and role.user_id:
+        user = role.user
+        if user is None:
+            return
+        username = user.username
+    try:
+        websocket.publish_authorization_change(g.cache.redis, username)
+    except Exception:
+        LOG.exception('Error publishing authorization change')
+
+
+def bump_role_navdata(role):
+    """A user role changes the projects of its user, a named role the
+    access of its members in its project"""
+    if role.user_id:
+        navdata.bump_user(role.user_id)
+    else:
+        navdata.bump_project(role.project_id)
+
+
 class ProjectExtension(MapperExtension):
     def after_delete(self, instance, state, sess):
-        g.cache.redis.expire('navdata', 0)
+        navdata.bump_project(instance._id)
 
     def after_insert(self, instance, state, sess):
-        g.cache.redis.expire('navdata', 0)
+        navdata.bump_project(instance._id)
 
     def after_update(self, instance, state, sess):
-        changed = get_dict_diff_have_keys_changed(
-            state.original_document, state.document,
-            ('name',),
-            ('acl',)
-        )
-        if changed:
-            g.cache.redis.expire('navdata', 0)
+        acl_changed = get_dict_diff_have_keys_changed(
+            state.original_document, state.document, ('acl',))
+        if acl_changed:
+            g.security.invalidate_access_cache()
+            publish_authorization_change()
+        if acl_changed or get_dict_diff_have_keys_changed(
+                state.original_document, state.document,
+                ('name', 'shortname', 'deleted', 'neighborhood_id')):
+            navdata.bump_project(instance._id)
 
 
 class AppConfigExtension(MapperExtension):
     def after_delete(self, instance, state, sess):
-        g.cache.redis.expire('navdata', 0)
+        navdata.bump_project(instance.project_id)
 
     def after_insert(self, instance, state, sess):
-        g.cache.redis.expire('navdata', 0)
+        navdata.bump_project(instance.project_id)
 
     def after_update(self, instance, state, sess):
-        changed = get_dict_diff_have_keys_changed(
-            state.original_document, state.document,
-            ('options',),
-            ('acl',)
-        )
-        if changed:
-            g.cache.redis.expire('navdata', 0)
+        acl_changed = get_dict_diff_have_keys_changed(
+            state.original_document, state.document, ('acl',))
+        if acl_changed:
+            g.security.invalidate_access_cache()
+            publish_authorization_change()
+        if acl_changed or get_dict_diff_have_keys_changed(
+                state.original_document, state.document,
+                ('options', 'visible_to_role')):
+            navdata.bump_project(instance.project_id)
+
+
+def is_member_role(doc):
+    """Whether a project role document makes its user a member"""
+    return bool(doc and doc.get('user_id') and doc.get('roles'))
+
+
+def count_members(project_id, state, new_doc):
+    """Keep the member counter of a project up to date.
+
+    Whether the role made its user a member when it was last flushed is
+    kept in its state: Ming sets original_document only when a document is
+    loaded.
+
+    """
+    from vulcanforge.artifact.model import ArtifactCounter
+    try:
+        was_member = state.extra_state['is_member']
+    except KeyError:
+        was_member = is_member_role(state.original_document)
+    is_member = state.extra_state['is_member'] = is_member_role(new_doc)
+    delta = int(is_member) - int(was_member)
+    if delta:
+        try:
+            ArtifactCounter.increment(project_id, all=delta)
+        except Exception:
+            LOG.exception('Error updating the member counter of %s',
+                          project_id)
+
+
+class ProjectRoleExtension(MapperExtension):
+    def after_delete(self, instance, state, sess):
+        g.security.invalidate_access_cache()
+        publish_authorization_change(instance)
+        bump_role_navdata(instance)
+        count_members(instance.project_id, state, None)
+
+    def after_insert(self, instance, state, sess):
+        g.security.invalidate_access_cache()
+        # a new named role has no members yet
+        if instance.user_id:
+            publish_authorization_change(instance)
+            bump_role_navdata(instance)
+            count_members(instance.project_id, state, state.document)
+
+    def after_update(self, instance, state, sess):
+        g.security.invalidate_access_cache()
+        publish_authorization_change(instance)
+        bump_role_navdata(instance)
+        count_members(instance.project_id, state, state.document)
 
 
 class ProjectFile(File):
@@ -813,11 +897,13 @@ class Project(SOLRIndexed):
             'tool_name': entrypoint_name
         })
 
-    def ordered_mounts(self):
+    def ordered_mounts(self, app_configs=None):
         """
         Returns an array of a projects mounts (tools and sub-projects) in
         toolbar order.
 
+        :param app_configs: the project's app configs, if already loaded
+
         """
         result = []
         # NOTE: commented for speed because we do not allow subprojects
@@ -827,7 +913,9 @@ class Project(SOLRIndexed):
         #        'sub': sub,
         #        'rank': 1
         #    })
-        for ac in self.app_configs:
+        if app_configs is None:
+            app_configs = self.app_configs
+        for ac in app_configs:
             ordinal = ac.options.get('ordinal', 0)
             rank = 0 if ac.options.get('mount_point', None) == 'home' \
                    else 1
@@ -1505,6 +1593,7 @@ class ProjectRole(BaseMappedClass):
         name = 'project_role'
         unique_indexes = [('user_id', 'project_id', 'name')]
         indexes = [('user_id',), ('project_id',), ('roles',)]
+        extensions = [ProjectRoleExtension]
 
     user_id = ForeignIdProperty('User', if_missing=None)
     project_id = ForeignIdProperty(Project, if_missing=None)
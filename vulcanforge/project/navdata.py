@@ -0,0 +1,60 @@
+"""
+Version stamps of the cached navigation data (the master navigation menu).
+
+Navdata is cached in fragments per project and neighborhood, and stitched
+together per user. Each fragment is stored under the versions of the
+scopes it was built from, so bumping a scope orphans the fragments and the
+per-user navdata built from it:
+
+- global: every fragment, e.g. after neighborhood or configuration changes
+- project.<project_id>: a project's tools, icon, name or permissions
+- user.<user_id>: the projects a user is a member of
+
+"""
+import logging
+
+from pylons import app_globals as g
+
+LOG = logging.getLogger(__name__)
+
+GLOBAL_SCOPE = 'global'
+VERSION_PREFIX = 'navdata.version.'
+
+
+def project_scope(project_id):
+    return 'project.{}'.format(project_id)
+
+
+def user_scope(user_id):
+    return 'user.{}'.format(user_id)
+
+
+def get_versions(scopes):
+    """Current version of each scope, in one round trip"""
+    scopes = list(scopes)
+    values = g.cache.mget(*[VERSION_PREFIX + scope for scope in scopes])
+    return dict((scope, int(value or 0))
+                for scope, value in zip(scopes, values))
+
+
+def bump(*scopes):
+    """Orphan the navdata built from the given scopes"""
+    if not g.cache:
+        return
+    for scope in scopes:
+        try:
+            g.cache.incr(VERSION_PREFIX + scope)
+        except Exception:
+            LOG.exception('Error bumping navdata version of %s', scope)
+
+
+def bump_project(project_id):
+    bump(project_scope(project_id))
+
+
+def bump_user(user_id):
+    bump(user_scope(user_id))
+
+
+def bump_global():
+    bump(GLOBAL_SCOPE)
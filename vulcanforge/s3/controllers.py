@@ -12,6 +12,11 @@ from vulcanforge.common.util.controller import get_remainder_path
 from vulcanforge.common.util.filesystem import guess_mime_type
 
 from vulcanforge.exchange.model import ExchangeNode
+from vulcanforge.s3.stream import (
+    SERVED_STATUSES,
+    get_s3_object,
+    serve_s3_object
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -30,7 +35,8 @@ class BucketController(BaseRestController):
     @expose()
     def get_one(self, *args, **kwargs):
         """
-        Get the contents of a key.
+        Get the contents of a key, streamed from S3. Range and conditional
+        requests are answered by S3.
 
         """
         keyname = get_remainder_path(map(urlunquote, args))
@@ -51,8 +57,8 @@ class BucketController(BaseRestController):
         LOG.debug('S3 Proxy GET Request to %s', keyname)
 
         not_found = False
-        resp = g.s3.make_request("GET", self.bucket, urlquote(keyname))
-        if resp.status != 200:
+        resp = get_s3_object(self.bucket, urlquote(keyname))
+        if resp.status not in SERVED_STATUSES:
             not_found = True
 
             # FIX:
@@ -63,14 +69,15 @@ class BucketController(BaseRestController):
                 part_2_rev = urlquote(parts[1])
                 rev_keyname = "#".join([parts[0], part_2_rev])
 
-                resp = g.s3.make_request("GET", self.bucket, urlquote(rev_keyname))
-                if resp.status == 200:
+                resp.close()
+                resp = get_s3_object(self.bucket, urlquote(rev_keyname))
+                if resp.status in SERVED_STATUSES:
                     not_found = False
 
         if not_found:
             # Try again with the
+            resp.close()
             raise exc.HTTPNotFound(keyname)
-        headers = dict(resp.getheaders())
 
         #content_type = headers.get('content-type', Key.DefaultContentType)
         #if content_type == Key.DefaultContentType:
@@ -78,11 +85,10 @@ class BucketController(BaseRestController):
 
         # guess_mime_type is more reliable than trusting that content_type
         # is properly set for S3 keys, at the expense of processing time.
-        headers['content-type'] = guess_mime_type(keyname).encode('utf-8')
+        response.headers['content-type'] = \
+            guess_mime_type(keyname).encode('utf-8')
 
-        for header, val in headers.iteritems():
-            response.headers[header] = val
-        return resp.read()
+        return serve_s3_object(resp, chunk_size=g.s3_serve_chunk_size)
 
     # @expose()  DISABLED FOR NOW
     def post(self, *args, **kwargs):
@@ -2,7 +2,6 @@
 import logging
 import os
 from contextlib import contextmanager
-from cStringIO import StringIO
 from datetime import datetime
 
 from PIL import Image
@@ -12,11 +11,17 @@ from ming.odm import FieldProperty
 from ming.odm.declarative import MappedClass
 from ming.utils import LazyProperty
 from pylons import app_globals as g
+from webob import exc
 
 from vulcanforge.common.model.session import project_orm_session
 from vulcanforge.common.model.base import BaseMappedClass
 from vulcanforge.common.util import set_download_headers, set_cache_headers
 from vulcanforge.common.util.filesystem import guess_mime_type, temporary_file
+from vulcanforge.s3.stream import (
+    SERVED_STATUSES,
+    get_s3_object,
+    serve_s3_object
+)
 from vulcanforge.virusscan.model import S3VirusScannableMixin
 
 LOG = logging.getLogger(__name__)
@@ -240,22 +245,15 @@ class File(BaseMappedClass, S3VirusScannableMixin):
         set_download_headers(self.filename, str(self.content_type))
         # enable caching
         set_cache_headers(self._id.generation_time)
-        in_memory_file = StringIO()
-        in_memory_file.write(self.key.read())
-        return in_memory_file.getvalue()
+        key = self.key
+        resp = get_s3_object(key.bucket, key.name)
+        if resp.status not in SERVED_STATUSES:
+            resp.close()
+            raise exc.HTTPNotFound()
+        return serve_s3_object(resp, chunk_size=g.s3_serve_chunk_size)
 
     def iter_serve(self, *args, **kwargs):
-        """
-        Sets the response headers and serves as a wsgi iter
-
-        NOTE: it is generally better to provide a url directly to the s3 key
-        (via the url method) than serving via this method
-
-        """
-        set_download_headers(self.filename, str(self.content_type))
-        # enable caching
-        set_cache_headers(self._id.generation_time)
-        return iter(self.key)
+        return self.serve(*args, **kwargs)
 
     @staticmethod
     def file_is_image(filename=None, content_type=None):
@@ -0,0 +1,106 @@
+"""
+Streams S3 objects to the client without buffering them in the worker.
+
+Range and conditional headers of the client request are forwarded to S3, so
+partial (206) and not modified (304) responses come straight from S3 and
+only the requested bytes are transferred.
+
+"""
+import logging
+
+from webob import Response
+from tg import request, response
+from tg.controllers.util import use_wsgi_app
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# statuses of an S3 GET that are passed on to the client as they are
+SERVED_STATUSES = (200, 206, 304, 412, 416)
+
+REQUEST_HEADERS = (
+    'Range',
+    'If-Range',
+    'If-None-Match',
+    'If-Modified-Since',
+)
+
+RESPONSE_HEADERS = (
+    'Content-Length',
+    'Content-Range',
+    'Accept-Ranges',
+    'ETag',
+    'Last-Modified',
+)
+
+
+class S3BodyIter(object):
+    """WSGI app_iter reading an S3 response body in fixed size chunks"""
+
+    def __init__(self, s3_response, chunk_size=CHUNK_SIZE):
+        self.s3_response = s3_response
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = self.s3_response.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.s3_response.close()
+
+
+def conditional_headers(headers=None):
+    """The Range and conditional headers of the current request"""
+    if headers is None:
+        headers = {}
+    for name in REQUEST_HEADERS:
+        value = request.headers.get(name)
+        if value:
+            headers[name] = value
+    return headers
+
+
+def get_s3_object(bucket, keyname, headers=None):
+    """Open a streaming GET of keyname, forwarding the Range and
+    conditional headers of the current request.
+
+    The status of the returned response is in SERVED_STATUSES unless the
+    object could not be read.
+
+    """
+    return bucket.connection.make_request(
+        'GET', bucket, keyname, headers=conditional_headers(headers))
+
+
+def serve_s3_object(s3_response, chunk_size=CHUNK_SIZE):
+    """
+    Serve an S3 GET response from get_s3_object to the client as a WSGI
+    iterator, along with the headers already set on the current response.
+
+    Returns the body iterator, to be returned by the controller.
+
+    """
+    s3_headers = dict(
+        (name.lower(), value) for name, value in s3_response.getheaders())
+    passed = set(name.lower() for name in RESPONSE_HEADERS)
+    headerlist = []
+    for name, value in response.headerlist:
+        lname = name.lower()
+        # Set-Cookie and X- headers are added again by the controller
+        if lname == 'set-cookie' or lname.startswith('x-') or lname in passed:
+            continue
+        headerlist.append((name, value))
+    for name in RESPONSE_HEADERS:
+        value = s3_headers.get(name.lower())
+        if value:
+            headerlist.append((name, value))
+    stream = Response(
+        status='{} {}'.format(s3_response.status, s3_response.reason),
+        headerlist=headerlist,
+        app_iter=S3BodyIter(s3_response, chunk_size),
+        conditional_response=False)
+    return use_wsgi_app(stream)
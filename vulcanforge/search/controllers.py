@@ -1,18 +1,37 @@
 import logging
+from hashlib import sha1
 from bson import ObjectId
 import itertools
 
 from formencode.validators import StringBool, UnicodeString
+from paste.deploy.converters import asint
 from pylons import app_globals as g, tmpl_context as c
+from tg import config
 from tg.decorators import expose, validate, with_trailing_slash
 
+from vulcanforge.cache.tiered_cache import LRUCache, MISSING
 from vulcanforge.common.controllers import BaseController
 from vulcanforge.common.helpers import slugify
 from vulcanforge.project.model import Project
+from vulcanforge.search.solr import get_max_score
 
 LOG = logging.getLogger(__name__)
 TEMPLATE_DIR = 'jinja:vulcanforge:search/templates/'
 
+_facet_cache = None
+# type names by slug, as seen in facet counts
+_type_names = {}
+
+
+def facet_cache():
+    """LRU cache of search facet counts, created on first use"""
+    global _facet_cache
+    if _facet_cache is None:
+        _facet_cache = LRUCache(
+            max_size=asint(config.get('search.facet_cache_size', 1000)),
+            timeout=asint(config.get('search.facet_cache_timeout', 30)))
+    return _facet_cache
+
 
 class AutocompleteController(BaseController):
     """
@@ -131,6 +150,18 @@ class AutocompleteController(BaseController):
 
 
 class SearchController(BaseController):
+    """
+    Global search.
+
+    A search is a single solr request returning the rows, the type facet
+    counts and the maximum score. Access control and type restrictions are
+    filter queries in a stable order, so solr's filterCache reuses them
+    across searches. Facet counts of the read role sets shared by most
+    visitors (anonymous, authenticated) are cached in process for a short
+    time, and left out of the request when cached.
+
+    """
+    type_tag = 'type'
 
     def _get_excluded_types(self):
         return (
@@ -143,45 +174,86 @@ class SearchController(BaseController):
             ""
         )
 
-    def _x_searchable_types(self, q):
-        params = {
-            "q": q,
+    def _get_filter_queries(self, read_roles, history=False, type_names=None):
+        fq = [
+            '-type_s:("%s")' % '" OR "'.join(self._get_excluded_types()),
+            '-deleted_b:true',
+            'is_history_b:%s' % history,
+            'read_roles:("%s")' % '" OR "'.join(sorted(read_roles))
+        ]
+        if type_names is not None:
+            fq.append('{!tag=%s}type_s:("%s")' % (
+                self.type_tag, '" OR "'.join(sorted(type_names))))
+        return fq
+
+    def _facet_params(self):
+        return {
             "facet": "on",
-            "facet.field": "type_s",
-            "rows": 0
+            # counts of every type, whichever types are filtered on
+            "facet.field": "{!ex=%s}type_s" % self.type_tag,
+            "facet.mincount": 1
         }
-        result = g.search(**params)
+
+    def _facet_cache_name(self, q, history, read_roles):
+        """Counts depend on the read roles alone, not on who has them"""
+        return sha1(repr((q, history, sorted(set(read_roles))))).hexdigest()
+
+    def _parse_facets(self, result):
+        facets = getattr(result, 'facets', None) or {}
+        counts = facets.get('facet_fields', {}).get('type_s', [])
         # iterate in chunks of 2 (type_s, count)
-        if result is not None:
-            facet_iter = iter(result.facets['facet_fields']['type_s'])
-            for type_s, count in zip(facet_iter, facet_iter):
-                if count and type_s not in self._get_excluded_types():
-                    yield {
-                        "name": type_s,
-                        "count": count
-                    }
-
-    def _get_searchable_type_dicts(self, q):
+        facet_iter = iter(counts)
+        type_counts = [(type_s, count) for type_s, count
+                       in zip(facet_iter, facet_iter) if count]
+        _type_names.update(
+            (slugify(type_s), type_s) for type_s, _ in type_counts)
+        return type_counts
+
+    def _get_type_names(self, fieldnames):
+        """Type names of the filter.<slug> fields of the sidebar form"""
+        slugs = [f[len('filter.'):] for f in fieldnames
+                 if f.startswith('filter.')]
+        if any(slug not in _type_names for slug in slugs):
+            # typically searched in another process; learn every type
+            self._parse_facets(g.search(
+                '*:*', rows=0, facet='on', **{
+                    'facet.field': 'type_s',
+                    'facet.mincount': 1,
+                    'facet.limit': -1
+                }))
+        return [_type_names[slug] for slug in slugs if slug in _type_names]
+
+    def _get_searchable_type_dicts(self, type_counts, enabled=None):
+        excluded = self._get_excluded_types()
         return [{
-                    "name": type['name'],
-                    "enabled": True,
-                    "count": type['count'],
-                    "fieldname": "filter.%s" % slugify(type['name']),
-                    }
-                for type in sorted(self._x_searchable_types(q),
-            key=lambda t: t['name'])]
-
-    def _get_complete_query(self, q, history=False):
-        return q + ' AND %s' % (
-            ' AND '.join((
-                'NOT type_s:("%s")' % '" OR "'.join(
-                    self._get_excluded_types()),
-                'read_roles:("%s")' % '" OR "'.join(
-                    g.security.get_user_read_roles()),
-                'NOT deleted_b:true',
-                'is_history_b:%s' % history
-                ))
-            )
+            "name": name,
+            "enabled": enabled is None or name in enabled,
+            "count": count,
+            "fieldname": "filter.%s" % slugify(name),
+        } for name, count in sorted(type_counts) if name not in excluded]
+
+    def _search(self, q, history=False, type_names=None, **params):
+        """
+        One solr request for q, with type facet counts unless cached.
+
+        :return: solr results (None on error), type counts
+
+        """
+        read_roles = g.security.get_user_read_roles()
+        cache_name = self._facet_cache_name(q, history, read_roles)
+        type_counts = facet_cache().get(cache_name)
+        if type_counts is MISSING:
+            params.update(self._facet_params())
+        params['fq'] = self._get_filter_queries(
+            read_roles, history, type_names)
+        results = g.search(q, **params)
+        if type_counts is MISSING:
+            if results is None:
+                type_counts = []
+            else:
+                type_counts = self._parse_facets(results)
+                facet_cache().set(cache_name, None, type_counts)
+        return results, type_counts
 
     @expose(TEMPLATE_DIR + 'index.html')
     @validate(dict(
@@ -191,9 +263,8 @@ class SearchController(BaseController):
     @with_trailing_slash
     def index(self, q='', history=False, limit=25, page=0, **kw):
         if q:
-            types = self._get_searchable_type_dicts(
-                self._get_complete_query(q, history)
-            )
+            type_counts = self._search(q, history, rows=0)[1]
+            types = self._get_searchable_type_dicts(type_counts)
         else:
             types = []
         search_uri = '/search/search'
@@ -208,44 +279,25 @@ class SearchController(BaseController):
     @expose('json')
     def search(self, q=u'', startPos=0, mode='simple', page=None, limit=25,
                history=False, **kw):
+        results_list = []
+        count = 0
+        types = []
         if q:
-            complete_q = self._get_complete_query(q, history)
-            types = self._get_searchable_type_dicts(complete_q)
-            params = {
-                "q": complete_q,
-                "start": startPos,
-                "rows": limit,
-                "fl": '*,score'
-            }
+            type_names = None
             if mode == 'advanced':
-                for type in types:
-                    type['enabled'] = type['enabled'] and\
-                                      type['fieldname'] in kw
-                params['fq'] = 'type_s:("%s")' % (
-                    '" OR "'.join([type['name']
-                                   for type in types if type['enabled']])
-                    )
-            results = g.search(**params)
+                type_names = self._get_type_names(kw)
+            results, type_counts = self._search(
+                q, history, type_names,
+                start=startPos, rows=limit, fl='*,score')
+            types = self._get_searchable_type_dicts(type_counts, type_names)
             if results:
                 count = results.hits
-                results_list = []
-                max_params = params.copy()
-                max_params.update({
-                    'rows': 1,
-                    'start': 0,
-                    'fl': 'score'
-                })
-                max_score = g.search(**max_params).docs[0]['score']
+                max_score = get_max_score(results)
                 for doc in results.docs:
-                    doc['rel_score'] = 10. * doc['score'] / max_score
+                    if max_score:
+                        doc['rel_score'] = 10. * doc['score'] / max_score
                     results_list.append(doc)
-            else:
-                results_list = []
-                count = 0
-        else:
-            results_list = []
-            count = 0
-        return dict(q=q, results=results_list,
+        return dict(q=q, results=results_list, types=types,
             count=count, page=page, limit=limit)
 
     @expose()
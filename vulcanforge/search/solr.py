@@ -1,3 +1,7 @@
+import time
+import atexit
+import threading
+from collections import OrderedDict
 from logging import getLogger
 
 from pylons import tmpl_context as c, app_globals as g
@@ -21,6 +25,22 @@ def dictify_facet_list(facet_list):
     return dict(zip(list_iter, list_iter))
 
 
+def get_max_score(results):
+    """
+    maxScore of the results of a search requesting the score field.
+
+    Falls back on the highest score of the returned docs for clients that do
+    not expose the raw response (exact on the first page of a search sorted
+    by score).
+
+    """
+    raw = getattr(results, 'raw_response', None) or {}
+    max_score = raw.get('response', {}).get('maxScore')
+    if max_score is None:
+        max_score = max([doc.get('score', 0) for doc in results.docs] or [0])
+    return max_score
+
+
 class SolrSearch(object):
 
     dynamic_postfixes = [
@@ -37,11 +57,30 @@ class SolrSearch(object):
 
     def __init__(self, solr):
         self.solr = solr
+        self._indexed_fields = {}
 
     @exceptionless(None, log=LOG)
     def __call__(self, q, **kw):
         return self.solr.search(q, **kw)
 
+    def indexed_fields(self, atype):
+        """Names of the fields a sample artifact of atype indexes, and its
+        type_s; None if there are no instances of atype.
+
+        Memoized per artifact class, so searches do not load (and index) a
+        sample artifact each time.
+
+        """
+        fields = self._indexed_fields.get(atype)
+        if fields is None:
+            a = atype.query.find().first()
+            if a is None:
+                return None
+            doc = a.index()
+            fields = self._indexed_fields[atype] = (
+                frozenset(doc), doc['type_s'])
+        return fields
+
     def search_artifact(self, atype, q, history=False, rows=10, fq_dict=None,
                         **kw):
         """Performs SOLR search.
@@ -49,22 +88,187 @@ class SolrSearch(object):
         Raises ValueError if SOLR returns an error.
 
         """
-        # first, grab an artifact and get the fields that it indexes
-        a = atype.query.find().first()
-        if a is None:
+        # first, get the fields that an artifact of atype indexes
+        indexed = self.indexed_fields(atype)
+        if indexed is None:
             return  # if there are no instance of atype, we won't find anything
-        fields = a.index()
+        fields, type_s = indexed
         # Now, we'll translate all the fld:
         q = atype.translate_query(q, fields)
         if fq_dict is None:
             fq_dict = dict()
         fq1 = dict(
-            type_s=fields['type_s'],
+            type_s=type_s,
             project_id_s=c.project._id,
             mount_point_s=c.app.config.options.mount_point
         )
         if not history:
             fq1['is_history_b'] = 'False'
         fq1.update(fq_dict)
-        fq = ['{}:({})'.format(k, v) for k, v in fq1.iteritems()]
+        # in a stable order, for solr's filter cache
+        fq = ['{}:({})'.format(k, v) for k, v in sorted(fq1.iteritems())]
         return self(q, fq=fq, rows=rows, **kw)
+
+
+def quote_id(doc_id):
+    """Quote a document id for use in a solr query"""
+    return '"{}"'.format(
+        unicode(doc_id).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class SolrIndexer(object):
+    """Buffers solr adds and deletes across tasks and sends them in batches.
+
+    Pending operations are keyed by document id, so a later add or delete of
+    a document replaces the earlier one and repeated adds (e.g. of a shared
+    index parent) are sent once. A batch is sent when `batch_size` operations
+    are pending or the oldest has waited `max_delay` seconds, with
+    `commitWithin` rather than forcing a flush and new searcher per batch.
+
+    Producers that fill a batch send it themselves, waiting on any send in
+    progress, so a slow solr slows indexing tasks down rather than letting
+    the buffer grow. Batches that fail to send are put back in the buffer;
+    after a failed background send, the next producer sends the backlog
+    before queueing anything, so a solr outage fails indexing tasks rather
+    than silently dropping their updates.
+
+    """
+    def __init__(self, solr, batch_size=100, max_delay=1.0,
+                 commit_within=1000, max_pending=10000):
+        self.solr = solr
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.commit_within = commit_within
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._flusher = None
+        # counters
+        self.docs_added = 0
+        self.docs_deleted = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_error = None
+        self.send_time = 0.0
+        self.last_latency = None
+        self.max_latency = 0.0
+        atexit.register(self.flush, raise_errors=False)
+
+    def add(self, docs):
+        self._queue((doc['id'], doc) for doc in docs if doc)
+
+    def delete(self, ids):
+        self._queue((doc_id, None) for doc_id in ids)
+
+    def _queue(self, ops):
+        if self.last_error is not None:
+            self.flush()
+        with self._lock:
+            for doc_id, doc in ops:
+                self._pending.pop(doc_id, None)
+                self._pending[doc_id] = doc
+            if self._pending and self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._pending) >= self.batch_size
+        if full or self.max_delay <= 0:
+            self.flush()
+        else:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name='solr-indexer')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.max_delay)
+            with self._lock:
+                due = self._oldest is not None and \
+                    time.time() - self._oldest >= self.max_delay
+            if due:
+                self.flush(raise_errors=False)
+
+    def flush(self, raise_errors=True):
+        """Send everything pending, in batches of `batch_size`"""
+        with self._send_lock:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._oldest = None
+                        self.last_error = None
+                        return
+                    batch = OrderedDict()
+                    while self._pending and len(batch) < self.batch_size:
+                        doc_id, doc = self._pending.popitem(last=False)
+                        batch[doc_id] = doc
+                try:
+                    self._send(batch)
+                    self.last_error = None
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = e
+                    self._requeue(batch)
+                    if raise_errors:
+                        raise
+                    LOG.exception('Error sending %d docs to solr', len(batch))
+                    return
+
+    def _requeue(self, batch):
+        """Put a failed batch back, unless superseded by newer operations"""
+        with self._lock:
+            if len(self._pending) + len(batch) > self.max_pending:
+                LOG.error('solr indexing buffer full; dropping %d operations',
+                          len(batch))
+                return
+            pending = self._pending
+            self._pending = OrderedDict(
+                (k, v) for k, v in batch.iteritems() if k not in pending)
+            self._pending.update(pending)
+            if self._oldest is None:
+                self._oldest = time.time()
+
+    def _send(self, batch):
+        adds = [doc for doc in batch.itervalues() if doc is not None]
+        deletes = [doc_id for doc_id, doc in batch.iteritems() if doc is None]
+        start = time.time()
+        if deletes:
+            # adds sent with commitWithin commit pending deletes too
+            self.solr.delete(
+                q='id:({})'.format(' OR '.join(map(quote_id, deletes))),
+                commit=False, softCommit=not adds)
+        if adds:
+            self.solr.add(adds, commit=False, commitWithin=self.commit_within)
+        latency = time.time() - start
+        self.batches += 1
+        self.docs_added += len(adds)
+        self.docs_deleted += len(deletes)
+        self.send_time += latency
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        LOG.debug('sent %d adds, %d deletes to solr in %.3fs',
+                  len(adds), len(deletes), latency)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def stats(self):
+        docs = self.docs_added + self.docs_deleted
+        return {
+            'docs_added': self.docs_added,
+            'docs_deleted': self.docs_deleted,
+            'batches': self.batches,
+            'failures': self.failures,
+            'last_error': repr(self.last_error) if self.last_error else None,
+            'pending': self.pending,
+            'docs_per_second': docs / self.send_time if self.send_time else 0,
+            'avg_batch_latency':
+                self.send_time / self.batches if self.batches else 0,
+            'last_batch_latency': self.last_latency,
+            'max_batch_latency': self.max_latency
+        }
@@ -1,3 +1,4 @@
+import re
 import shlex
 
 
@@ -15,12 +16,12 @@ class MockSOLR(object):
     def __init__(self):
         self.db = {}
 
-    def add(self, objects):
+    def add(self, objects, **kw):
         for o in objects:
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
 
-    def commit(self):
+    def commit(self, **kw):
         pass
 
     def search(self, q, fq=None, **kw):
@@ -61,6 +62,10 @@ class MockSOLR(object):
             self.db = {}
         elif kwargs.get('id', None):
             del self.db[kwargs['id']]
+        elif kwargs.get('q', '').startswith('id:('):
+            for doc_id in re.findall(r'"((?:[^"\\]|\\.)*)"', kwargs['q']):
+                doc_id = re.sub(r'\\(.)', r'\1', doc_id)
+                self.db.pop(doc_id, None)
         elif kwargs.get('q', None):
             for doc in self.search(kwargs['q']):
                 self.delete(id=doc['id'])
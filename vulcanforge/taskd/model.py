@@ -1,13 +1,15 @@
 import sys
 import time
+import calendar
 import traceback
 import logging
-from datetime import datetime
-from bson import son
+from datetime import datetime, timedelta
+from bson import son, ObjectId
 
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from paste.deploy.converters import asint
+from tg import config
 
 import ming
 from ming.utils import LazyProperty
@@ -21,13 +23,19 @@ from vulcanforge.common.model.session import main_orm_session
 LOG = logging.getLogger(__name__)
 
 
+def _timestamp(dt):
+    """Unix timestamp for a naive utc datetime"""
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
 class MonQTask(MappedClass):
     """Task to be executed by the taskd daemon.
 
     Properties
 
         - _id - bson.ObjectId() for this task
-        - state - 'ready', 'busy', 'error', or 'complete' task status
+        - state - 'scheduled', 'ready', 'busy', 'error', or 'complete' task
+        status
         - priority - integer priority, higher is more priority
         - result_type - either 'keep' or 'forget', what to do with the task
         when
@@ -37,6 +45,17 @@ class MonQTask(MappedClass):
         - time_stop - time taskd stopped working on the task
         - task_name - full dotted name of the task function to run
         - process - identifier for which taskd process is working on the task
+        - lease - token shared by tasks claimed together in one batch
+        - coalesce_key - ready tasks sharing this key (and function and
+        context) merge their arguments rather than queueing a new task
+        - coalesced - number of posts merged into this task
+        - run_at - for scheduled tasks, the earliest time to run
+        - recurrence - if set, seconds between runs of a recurring task
+        - recurring_key - held by the pending run of a recurring task posted
+        by ensure_recurring, unique so that it is posted once
+        - heartbeat - last time the worker running a busy task checked in
+        - retries - number of times the task was requeued after its worker
+        stopped heartbeating
         - context - values used to set c.project, c.app, c.user for the task
         - args - *args to be sent to the task function
         - kwargs - **kwargs to be sent to the task function
@@ -44,8 +63,12 @@ class MonQTask(MappedClass):
         the traceback.
 
     """
-    states = ('ready', 'busy', 'error', 'complete')
+    states = ('scheduled', 'ready', 'busy', 'error', 'complete')
     result_types = ('keep', 'forget')
+    context_fields = ('project_id', 'app_config_id', 'user_id')
+    claim_sort = son.SON([
+        ('priority', ming.DESCENDING),
+        ('time_queue', ming.ASCENDING)])
 
     class __mongometa__:
         session = main_orm_session
@@ -59,6 +82,20 @@ class MonQTask(MappedClass):
                 'state',
                 'time_queue'
             ],
+            'lease',
+            [
+                ('coalesce_key', ming.ASCENDING),
+                ('state', ming.ASCENDING),
+            ], [
+                ('state', ming.ASCENDING),
+                ('run_at', ming.ASCENDING),
+            ], [
+                ('state', ming.ASCENDING),
+                ('heartbeat', ming.ASCENDING),
+            ],
+        ]
+        custom_indexes = [
+            dict(fields=('recurring_key',), unique=True, sparse=True),
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -71,6 +108,15 @@ class MonQTask(MappedClass):
 
     task_name = FieldProperty(str)
     process = FieldProperty(str)
+    lease = FieldProperty(str, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
+    coalesced = FieldProperty(int, if_missing=0)
+    run_at = FieldProperty(datetime, if_missing=None)
+    recurrence = FieldProperty(int, if_missing=None)
+    # left out of documents that do not hold it, for the sparse index
+    recurring_key = FieldProperty(str)
+    heartbeat = FieldProperty(datetime, if_missing=None)
+    retries = FieldProperty(int, if_missing=0)
     context = FieldProperty({
         'project_id': S.ObjectId,
         'app_config_id': S.ObjectId,
@@ -108,6 +154,14 @@ class MonQTask(MappedClass):
         """
         Create a new task object based on the current context.
 
+        Pass `taskd_coalesce` (True to key on the function name, or a string
+        key) to merge into an equivalent ready task instead of creating a new
+        one; see L{MonQTask.coalesce}.
+
+        Pass `taskd_run_at` (a utc datetime) or `taskd_delay` (seconds) to
+        schedule the task for later, and `taskd_recur` (seconds) to run it
+        again at that interval after each run.
+
         @type function: function
         @type args: None, list, tuple
         @type kwargs: None, dict
@@ -122,14 +176,20 @@ class MonQTask(MappedClass):
         result_type = kwargs.pop('taskd_result_type', 'forget')
         priority = kwargs.pop('taskd_priority', 10)
         state = kwargs.pop('taskd_state', 'ready')
+        coalesce_key = kwargs.pop('taskd_coalesce', None)
+        run_at = kwargs.pop('taskd_run_at', None)
+        delay = kwargs.pop('taskd_delay', None)
+        recurrence = kwargs.pop('taskd_recur', None)
+        recurring_key = kwargs.pop('taskd_recurring_key', None)
+        if delay:
+            run_at = datetime.utcnow() + timedelta(seconds=delay)
+        if run_at and run_at > datetime.utcnow() and state == 'ready':
+            state = 'scheduled'
 
         task_name = '%s.%s' % (
             function.__module__,
             function.__name__)
-        context = dict(
-            project_id=None,
-            app_config_id=None,
-            user_id=None)
+        context = dict.fromkeys(cls.context_fields)
         if getattr(c, 'project', None):
             context['project_id'] = c.project._id
         if getattr(c, 'app', None):
@@ -138,6 +198,15 @@ class MonQTask(MappedClass):
             context['app_config_id'] = c.app_config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        if coalesce_key is True:
+            coalesce_key = task_name
+        if coalesce_key and state == 'ready':
+            obj = cls.coalesce(coalesce_key, task_name, context, args, kwargs,
+                               priority=priority, result_type=result_type)
+            if obj:
+                # the merged task is already on the queue
+                LOG.debug('coalesced %s into %s', task_name, obj._id)
+                return obj
         obj = cls.post_task(
             state=state,
             priority=priority,
@@ -147,22 +216,252 @@ class MonQTask(MappedClass):
             kwargs=kwargs,
             process=None,
             result=None,
-            context=context
+            context=context,
+            coalesce_key=coalesce_key or None,
+            run_at=run_at,
+            recurrence=recurrence,
+            recurring_key=recurring_key
         )
         if obj:
-            try:
+            cls._enqueue(obj)
+        return obj
+
+    @classmethod
+    def _enqueue(cls, obj):
+        """Put a ready task on the task queue, or hold a scheduled task in
+        the queue's schedule until it is due. Queues without a schedule fall
+        back to the Mongo sweep in L{MonQTask.promote_due}.
+
+        """
+        try:
+            if obj.state == 'scheduled':
+                if hasattr(g.task_queue, 'schedule'):
+                    LOG.debug('scheduling %s for %s', obj._id, obj.run_at)
+                    g.task_queue.schedule(str(obj._id), _timestamp(obj.run_at))
+            else:
                 LOG.debug('putting %s in the task queue', obj._id)
                 g.task_queue.put(str(obj._id))
-            except Exception:
-                LOG.exception('Error putting to task queue')
+        except Exception:
+            LOG.exception('Error putting to task queue')
+
+    @classmethod
+    def promote(cls, task_ids):
+        """Make the given scheduled tasks ready and put them on the task
+        queue. Called with ids popped from the queue's schedule once due.
+
+        """
+        if not task_ids:
+            return
+        cls.query.update(
+            {'_id': {'$in': [ObjectId(i) for i in task_ids]},
+             'state': 'scheduled'},
+            {'$set': {'state': 'ready'}},
+            multi=True)
+        for task_id in task_ids:
+            g.task_queue.put(str(task_id))
+
+    @classmethod
+    def promote_due(cls, now=None):
+        """Make every scheduled task that is due ready. This queries Mongo,
+        so it is used at worker startup and when no scheduling queue is
+        available, not on every wait.
+
+        """
+        if now is None:
+            now = datetime.utcnow()
+        cls.query.update(
+            {'state': 'scheduled', 'run_at': {'$lte': now}},
+            {'$set': {'state': 'ready'}},
+            multi=True)
+
+    @classmethod
+    def reschedule_pending(cls):
+        """Make sure every scheduled task is held in the queue's schedule
+        (e.g. after the redis schedule was lost). Scheduling is idempotent.
+
+        """
+        for obj in cls.query.find({'state': 'scheduled'}):
+            cls._enqueue(obj)
+
+    @classmethod
+    def _collection(cls):
+        return session(cls).impl.bind.db[cls.__mongometa__.name]
+
+    @classmethod
+    def ensure_recurring(cls, function, interval, args=None, kwargs=None):
+        """Post a recurring task unless one for this function is already
+        pending. If the pending one has a different interval, it is updated.
+
+        The pending run holds the function name in the unique
+        recurring_key, so workers starting together post it once; the
+        loser of a race finds the winner's run on its next attempt.
+
+        """
+        task_name = '%s.%s' % (function.__module__, function.__name__)
+        coll = cls._collection()
+        for attempt in range(3):
+            doc = coll.find_one({'recurring_key': task_name})
+            if doc is not None and doc['state'] in ('error', 'complete'):
+                # the run that held the key did not schedule the next one
+                # (e.g. it was given up on by the reaper); release the key
+                coll.update_one(
+                    {'_id': doc['_id'], 'state': doc['state']},
+                    {'$unset': {'recurring_key': 1}})
+                continue
+            if doc is None:
+                # a run posted before recurring keys
+                doc = coll.find_one({
+                    'task_name': task_name,
+                    'recurrence': {'$ne': None},
+                    'state': {'$in': ['scheduled', 'ready', 'busy']}})
+                if doc is not None and doc['state'] == 'scheduled':
+                    try:
+                        adopted = coll.update_one(
+                            {'_id': doc['_id'], 'state': 'scheduled',
+                             'recurring_key': {'$exists': False}},
+                            {'$set': {'recurring_key': task_name}})
+                    except pymongo.errors.DuplicateKeyError:
+                        continue
+                    if not adopted.modified_count:
+                        continue
+            if doc is not None:
+                if doc.get('recurrence') != interval:
+                    coll.update_one({'_id': doc['_id']},
+                                    {'$set': {'recurrence': interval}})
+                return cls.query.get(_id=doc['_id'])
+            kw = dict(kwargs or {}, taskd_recur=interval,
+                      taskd_recurring_key=task_name)
+            try:
+                return cls.post(function, args, kw)
+            except pymongo.errors.DuplicateKeyError:
+                LOG.debug('%s was posted by another worker', task_name)
+        LOG.warn('Could not ensure recurring task %s', task_name)
+
+    def schedule_next(self):
+        """Post the next run of a recurring task, handing on its
+        recurring_key"""
+        now = datetime.utcnow()
+        run_at = (self.run_at or self.time_start or now) + \
+            timedelta(seconds=self.recurrence)
+        if run_at < now:
+            run_at = now
+        recurring_key = state(self).document.pop('recurring_key', None)
+        if recurring_key:
+            self._collection().update_one(
+                {'_id': self._id}, {'$unset': {'recurring_key': 1}})
+        try:
+            obj = self.post_task(
+                state='scheduled',
+                priority=self.priority,
+                result_type=self.result_type,
+                task_name=self.task_name,
+                args=list(self.args),
+                kwargs=dict(self.kwargs),
+                process=None,
+                result=None,
+                context=dict(
+                    project_id=self.context.project_id,
+                    app_config_id=self.context.app_config_id,
+                    user_id=self.context.user_id),
+                run_at=run_at,
+                recurrence=self.recurrence,
+                recurring_key=recurring_key
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # a starting worker posted a run while the key was released
+            LOG.info('Next run of %s was already posted', self.task_name)
+            return None
+        self._enqueue(obj)
         return obj
 
+    @classmethod
+    def coalesce(cls, coalesce_key, task_name, context, args, kwargs,
+                 priority=10, result_type='forget'):
+        """Merge a posted call into a ready, unclaimed task with the same
+        coalescing key, function and context.
+
+        List arguments (positional or keyword) are unioned into the queued
+        task's lists, dict keyword arguments are updated key by key, and all
+        other arguments must be equal for the tasks to merge. Lists are
+        capped at monq.coalesce_limit entries so one task never grows without
+        bound. Context fields missing from context must be null in the
+        queued task.
+
+        Returns the merged task, or None if there was nothing to merge into.
+
+        """
+        limit = asint(config.get('monq.coalesce_limit', 500))
+        query = {
+            'state': 'ready',
+            'coalesce_key': coalesce_key,
+            'task_name': task_name,
+            'priority': priority,
+            'result_type': result_type,
+            'args.%d' % len(args): {'$exists': False}
+        }
+        # every field, so a call without (say) a user never merges into a
+        # task that runs as one
+        for name in cls.context_fields:
+            query['context.' + name] = context.get(name)
+        add_to_set, set_ = {}, {}
+
+        def merge(path, value):
+            if isinstance(value, (list, tuple)):
+                query['%s.%d' % (path, max(limit - len(value), 0))] = {
+                    '$exists': False}
+                add_to_set[path] = {'$each': list(value)}
+            elif isinstance(value, dict) and all(
+                    '.' not in key and not key.startswith('$')
+                    for key in value):
+                query[path] = {'$type': 3}  # embedded document
+                for key, item in value.items():
+                    set_['%s.%s' % (path, key)] = item
+            else:
+                query[path] = value
+
+        for i, arg in enumerate(args):
+            merge('args.%d' % i, arg)
+        for name, value in kwargs.items():
+            merge('kwargs.' + name, value)
+
+        update = {'$inc': {'coalesced': 1}}
+        if add_to_set:
+            update['$addToSet'] = add_to_set
+        if set_:
+            update['$set'] = set_
+        try:
+            return cls.query.find_and_modify(
+                query=query, update=update, new=True)
+        except pymongo.errors.OperationFailure as exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+
     @classmethod
     def post_task(cls, **kw):
+        if kw.get('recurring_key') is None:
+            kw.pop('recurring_key', None)
         obj = cls(**kw)
-        session(obj).flush(obj)
+        try:
+            session(obj).flush(obj)
+        except pymongo.errors.DuplicateKeyError:
+            # a recurring task posted by another worker; do not retry the
+            # insert on the next flush
+            session(obj).expunge(obj)
+            raise
         return obj
 
+    @classmethod
+    def _claim_query(cls, state='ready', only=None, min_priority=None):
+        query = {'state': state}
+        if only:
+            query['task_name'] = {'$in': only}
+        if min_priority:
+            try:
+                query['priority'] = {'$gte': asint(min_priority)}
+            except:
+                pass
+        return query
+
     @classmethod
     def get(cls, process='worker', state='ready', only=None, min_priority=None):
         """Get the highest-priority, oldest, ready task and lock it to the
@@ -173,34 +472,57 @@ class MonQTask(MappedClass):
 
         """
         obj = None
-        sort = son.SON([
-            ('priority', ming.DESCENDING),
-            ('time_queue', ming.ASCENDING)])
         try:
-            query = {'state': state}
-            if only:
-                query['task_name'] = {'$in': only}
-            if min_priority:
-                try:
-                    query['priority'] = {'$gte': asint(min_priority)}
-                except:
-                    pass
             obj = cls.query.find_and_modify(
-                query=query,
+                query=cls._claim_query(state, only, min_priority),
                 update={
                     '$set': {
                         'state': 'busy',
-                        'process': process
+                        'process': process,
+                        'heartbeat': datetime.utcnow()
                     }
                 },
                 new=True,
-                sort=sort)
+                sort=cls.claim_sort)
         except pymongo.errors.OperationFailure as exc:
             if 'No matching object found' not in exc.args[0]:
                 raise
 
         return obj
 
+    @classmethod
+    def get_batch(cls, limit, process='worker', state='ready', only=None,
+                  min_priority=None):
+        """Claim up to `limit` of the highest-priority, oldest, ready tasks
+        for the current process in a single round of queries.
+
+        Candidate tasks are stamped with a fresh lease token; only the tasks
+        that still matched the claim query at update time carry the token, so
+        concurrent workers never claim the same task twice.
+
+        @rtype: list of C{MonQTask}
+
+        """
+        query = cls._claim_query(state, only, min_priority)
+        sess = session(cls)
+        coll = sess.impl.bind.db[cls.__mongometa__.name]
+        sort = cls.claim_sort.items()
+        candidates = [doc['_id'] for doc in
+                      coll.find(query, {'_id': 1}).sort(sort).limit(limit)]
+        if not candidates:
+            return []
+        lease = str(ObjectId())
+        query['_id'] = {'$in': candidates}
+        cls.query.update(query, {
+            '$set': {
+                'state': 'busy',
+                'process': process,
+                'lease': lease,
+                'heartbeat': datetime.utcnow()
+            }
+        }, multi=True)
+        return cls.query.find({'lease': lease}).sort(sort).all()
+
     @classmethod
     def event_loop(cls, waitfunc=None, process='worker', **kwargs):
         """Async event_loop that picks up tasks. Wait strategy determined by
@@ -254,11 +576,85 @@ class MonQTask(MappedClass):
     @classmethod
     def timeout_tasks(cls, older_than):
         """Mark all busy tasks older than a certain datetime as 'ready' again.
-        Used to retry 'stuck' tasks."""
+        Used to retry 'stuck' tasks.
+
+        This resets slow but live tasks too; prefer L{MonQTask.reap}.
+
+        """
         spec = dict(state='busy')
         spec['time_start'] = {'$lt': older_than}
         cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
 
+    @classmethod
+    def beat(cls, task_ids, process):
+        """Record that `process` is still working on the given busy tasks"""
+        if not task_ids:
+            return
+        cls.query.update(
+            {'_id': {'$in': list(task_ids)}, 'state': 'busy',
+             'process': process},
+            {'$set': {'heartbeat': datetime.utcnow()}},
+            multi=True)
+
+    @classmethod
+    def reap(cls, older_than, max_retries=None, backoff=None):
+        """Requeue busy tasks whose worker has not heartbeat since
+        `older_than`, presumably because it died.
+
+        Each reaped task is rescheduled with exponential backoff
+        (`backoff` * 2 ** retries seconds); tasks already retried
+        `max_retries` times are put in the error state instead. Tasks are
+        reaped with find_and_modify guarded on the stale heartbeat, so a
+        late beat wins and concurrent reapers never requeue a task twice.
+
+        Returns the list of reaped tasks.
+
+        """
+        if max_retries is None:
+            max_retries = asint(config.get('taskd.max_retries', 3))
+        if backoff is None:
+            backoff = asint(config.get('taskd.retry_backoff', 30))
+        coll = cls._collection()
+        stale = coll.find({'state': 'busy', '$or': [
+            {'heartbeat': {'$lt': older_than}},
+            {'heartbeat': None, 'time_start': {'$lt': older_than}}
+        ]}, {'heartbeat': 1, 'retries': 1, 'process': 1})
+        reaped = []
+        for doc in stale:
+            retries = doc.get('retries') or 0
+            if retries >= max_retries:
+                update = {'$set': {
+                    'state': 'error',
+                    'result': 'Worker {} stopped responding; gave up after '
+                              '{} retries'.format(doc.get('process'), retries)
+                }}
+            else:
+                run_at = datetime.utcnow() + timedelta(
+                    seconds=backoff * 2 ** retries)
+                update = {
+                    '$set': {'state': 'scheduled', 'run_at': run_at,
+                             'process': None, 'lease': None},
+                    '$inc': {'retries': 1}
+                }
+            try:
+                obj = cls.query.find_and_modify(
+                    query={'_id': doc['_id'], 'state': 'busy',
+                           'heartbeat': doc.get('heartbeat')},
+                    update=update,
+                    new=True)
+            except pymongo.errors.OperationFailure as exc:
+                if 'No matching object found' not in exc.args[0]:
+                    raise
+                continue
+            if obj is None:
+                continue
+            LOG.warn('reaped task %s from %s (%s)', obj._id,
+                     doc.get('process'), obj.state)
+            if obj.state == 'scheduled':
+                cls._enqueue(obj)
+            reaped.append(obj)
+        return reaped
+
     @classmethod
     def clear_complete(cls):
         """Delete the task objects for complete tasks"""
@@ -321,6 +717,11 @@ class MonQTask(MappedClass):
         finally:
             self.time_stop = datetime.utcnow()
             session(self.__class__).flush(self)
+            if self.recurrence:
+                try:
+                    self.schedule_next()
+                except Exception:
+                    LOG.exception('Error scheduling next run of %r', self)
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
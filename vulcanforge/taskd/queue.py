@@ -1,3 +1,4 @@
+import time
 import logging
 from functools import wraps
 
@@ -19,6 +20,17 @@ def convert_conn_error(func):
     return wrapper
 
 
+# atomically pop members of a sorted set scored at or below ARGV[1]
+_POP_DUE_SCRIPT = """
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1],
+                         'LIMIT', 0, ARGV[2])
+if #items > 0 then
+    redis.call('zrem', KEYS[1], unpack(items))
+end
+return items
+"""
+
+
 class RedisQueue(object):
     """Simple Queue with Redis Backend
 
@@ -26,6 +38,9 @@ class RedisQueue(object):
     http://peter-hoffmann.com/2012/python-simple-queue-redis-queue.html
       (if found, please return)
 
+    Items may also be scheduled for later: they are held in a sorted set
+    scored by unix timestamp until popped with `pop_due`.
+
     """
     def __init__(self, name, namespace='taskd', conn=None, **redis_kwargs):
         """The default connection parameters are:
@@ -37,6 +52,8 @@ class RedisQueue(object):
         else:
             self.__db = redis.StrictRedis(**redis_kwargs)
         self.key = '%s:%s' % (namespace, name)
+        self.schedule_key = '%s:scheduled' % self.key
+        self._pop_due = self.__db.register_script(_POP_DUE_SCRIPT)
 
     @convert_conn_error
     def qsize(self):
@@ -77,3 +94,34 @@ class RedisQueue(object):
     @convert_conn_error
     def clear(self):
         self.__db.delete(self.key)
+        self.__db.delete(self.schedule_key)
+
+    @convert_conn_error
+    def schedule(self, item, timestamp):
+        """Hold item until the given unix timestamp"""
+        self.__db.zadd(self.schedule_key, timestamp, item)
+
+    @convert_conn_error
+    def unschedule(self, item):
+        self.__db.zrem(self.schedule_key, item)
+
+    @convert_conn_error
+    def scheduled_size(self):
+        return self.__db.zcard(self.schedule_key)
+
+    @convert_conn_error
+    def next_scheduled(self):
+        """Unix timestamp of the earliest scheduled item, or None"""
+        items = self.__db.zrange(self.schedule_key, 0, 0, withscores=True)
+        if items:
+            return items[0][1]
+
+    @convert_conn_error
+    def pop_due(self, now=None, limit=100):
+        """Remove and return up to `limit` scheduled items that are due.
+        Each item is returned to exactly one caller.
+
+        """
+        if now is None:
+            now = time.time()
+        return self._pop_due(keys=[self.schedule_key], args=[now, limit])
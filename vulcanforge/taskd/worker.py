@@ -2,22 +2,84 @@ import os
 import sys
 import time
 import logging
+import threading
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from ming.odm import ThreadLocalODMSession
 
 from webob import Request
 from paste.deploy import loadapp
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, aslist
 import pylons
 from tg import config
+from vulcanforge.common.util.filesystem import import_object
 from vulcanforge.taskd import MonQTask
 
 from vulcanforge.taskd.exceptions import QueueConnectionError, TaskdException
 
 
+class TaskdStats(object):
+    """Throughput counters for a taskd worker.
+
+    A "drain" starts when the worker claims a task after finding the queue
+    empty and ends the next time a claim comes back empty.
+
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.drain_started = None
+        self.drain_count = 0
+        self.last_drain_time = None
+        self._lock = threading.Lock()
+
+    def task_done(self, success=True):
+        with self._lock:
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+            if self.drain_started is not None:
+                self.drain_count += 1
+
+    def claimed(self, count):
+        if count and self.drain_started is None:
+            self.drain_started = time.time()
+            self.drain_count = 0
+
+    def drained(self):
+        """Close the current drain, returning (task count, seconds)"""
+        if self.drain_started is None:
+            return None
+        with self._lock:
+            elapsed = time.time() - self.drain_started
+            count = self.drain_count
+            self.drain_started = None
+        self.last_drain_time = elapsed
+        return count, elapsed
+
+    @property
+    def tasks_per_second(self):
+        elapsed = time.time() - self.started
+        if not elapsed:
+            return 0.0
+        return (self.completed + self.failed) / elapsed
+
+    def __str__(self):
+        return '%d complete, %d failed, %.2f tasks/sec, last drain %s' % (
+            self.completed, self.failed, self.tasks_per_second,
+            '%.2fs' % self.last_drain_time
+            if self.last_drain_time is not None else 'n/a')
+
+
 class TaskdWorker(object):
+    # "<module:function> <interval seconds>" entries, one per line
+    default_recurring = 'vulcanforge.notification.tasks:fire_mailboxes 300'
 
     def __init__(self, config_path, name='worker', only=None,
-                 relative_path=None, log=None, min_priority=10):
+                 relative_path=None, log=None, min_priority=10,
+                 concurrency=1, batch_size=1):
         self.config_path = config_path
         if relative_path is None:
             relative_path = os.getcwd()
@@ -34,6 +96,17 @@ class TaskdWorker(object):
         self.wsgi_error_log = None
         self.poll_interval = asint(config.get('monq.poll_interval', 10))
         self.task_queue_timeout = asint(config.get('task_queue.timeout', 2))
+        self.concurrency = max(1, asint(concurrency))
+        self.batch_size = max(1, asint(batch_size))
+        self.stats = TaskdStats()
+        self.in_flight = set()
+        self._slots = threading.Condition()
+        self.heartbeat_interval = asint(
+            config.get('taskd.heartbeat_interval', 10))
+        self.reap_after = asint(config.get(
+            'taskd.reap_after', self.heartbeat_interval * 6))
+        self._heartbeat_thread = None
+        self._heartbeat_stop = threading.Event()
 
     def graceful_restart(self, signum, frame):
         self.log.info('taskd pid %s recieved signal %s restarting gracefully',
@@ -47,8 +120,27 @@ class TaskdWorker(object):
         self.keep_running = False
 
     def log_current_task(self, signum, frame):
-        self.log.info('taskd pid %s is currently handling task %s',
-                      os.getpid(), getattr(self, 'task', None))
+        if self.concurrency > 1:
+            current = ', '.join(str(t) for t in list(self.in_flight))
+        else:
+            current = getattr(self, 'task', None)
+        self.log.info('taskd pid %s is currently handling task %s (%s)',
+                      os.getpid(), current, self.stats)
+        solr_indexer = getattr(pylons.app_globals, 'solr_indexer', None)
+        if solr_indexer:
+            self.log.info('taskd pid %s solr indexing: %s',
+                          os.getpid(), solr_indexer.stats())
+        smtp_client = self._smtp_client()
+        if smtp_client:
+            self.log.info('taskd pid %s smtp: %s',
+                          os.getpid(), smtp_client.stats())
+
+    def _smtp_client(self):
+        # only report on mail if this worker has sent any
+        tasks = sys.modules.get('vulcanforge.notification.tasks')
+        smtp_client = getattr(tasks, 'smtp_client', None)
+        if smtp_client is not None and smtp_client.stats()['connects']:
+            return smtp_client
 
     def start_app(self):
         self.wsgi_app = loadapp(
@@ -73,35 +165,215 @@ class TaskdWorker(object):
                 'wsgi.errors': self.wsgi_error_log or self.log,
             })
             result = list(self.wsgi_app(r.environ, start_response))
+            self.stats.task_done(True)
         except TaskdException as e:
             # task failed to complete
+            self.stats.task_done(False)
             self.log.error(
                 'taskd worker failed; %s; %s -- %s',
                 e.message, task.task_name, task._id)
         except Exception:
             # unknown exception
+            self.stats.task_done(False)
             self.log.exception('taskd worker error')
         finally:
             self.wsgi_error_log.flush()
 
+    def _run_tracked_task(self, task):
+        with self._slots:
+            self.in_flight.add(task)
+        try:
+            self.run_task(task)
+        finally:
+            with self._slots:
+                self.in_flight.discard(task)
+
+    def _run_pooled_task(self, task):
+        """Run a task on a pool thread. The fake request gives each thread
+        its own `c` and ODM session, so tasks do not share context.
+
+        """
+        try:
+            self.run_task(task)
+        finally:
+            ThreadLocalODMSession.close_all()
+            with self._slots:
+                self.in_flight.discard(task)
+                self._slots.notify()
+
+    def _claim_batch(self, only):
+        """Claim as many tasks as there are free slots, up to batch_size"""
+        with self._slots:
+            while self.keep_running and \
+                    len(self.in_flight) >= self.concurrency:
+                self._slots.wait(self.task_queue_timeout)
+            free = self.concurrency - len(self.in_flight)
+        if not self.keep_running:
+            return []
+        tasks = MonQTask.get_batch(min(free, self.batch_size),
+                                   process=self.name,
+                                   only=only,
+                                   min_priority=self.min_priority)
+        # tasks are handed off to pool threads; keep this thread's identity
+        # map from growing without bound
+        ThreadLocalODMSession.close_all()
+        self.stats.claimed(len(tasks))
+        return tasks
+
+    def _log_drain(self):
+        drain = self.stats.drained()
+        if drain:
+            count, elapsed = drain
+            self.log.info(
+                'taskd pid %s drained queue: %d tasks in %.2fs '
+                '(%.2f tasks/sec)', os.getpid(), count, elapsed,
+                count / elapsed if elapsed else 0.0)
+
+    def batch_event_loop(self, only=None):
+        """Claim up to batch_size tasks per round trip and run them on a
+        pool of `concurrency` threads.
+
+        """
+        if pylons.app_globals.task_queue:
+            waitfunc = self._waitfunc_queue
+        else:
+            waitfunc = self._waitfunc_noq
+
+        pool = ThreadPool(self.concurrency)
+        try:
+            while self.keep_running:
+                try:
+                    tasks = self._claim_batch(only)
+                except QueueConnectionError:
+                    self.log.exception("taskd cannot connect to task_queue")
+                    waitfunc = self._waitfunc_noq
+                    continue
+                if not tasks:
+                    if not self.in_flight:
+                        self._log_drain()
+                    try:
+                        waitfunc()
+                    except QueueConnectionError:
+                        self.log.exception(
+                            "taskd cannot connect to task_queue")
+                        waitfunc = self._waitfunc_noq
+                    continue
+                with self._slots:
+                    self.in_flight.update(tasks)
+                for task in tasks:
+                    pool.apply_async(self._run_pooled_task, (task,))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _heartbeat_loop(self):
+        """Heartbeat in-flight tasks, and requeue tasks of workers that
+        stopped heartbeating. Runs on its own thread until stop_heartbeat,
+        so tasks still running after a stop is requested keep beating.
+
+        """
+        # app globals are registered per thread
+        pylons.app_globals._push_object(config['pylons.app_globals'])
+        last_reap = 0
+        while not self._heartbeat_stop.is_set():
+            try:
+                with self._slots:
+                    task_ids = [t._id for t in self.in_flight]
+                MonQTask.beat(task_ids, self.name)
+                if time.time() - last_reap >= self.reap_after:
+                    last_reap = time.time()
+                    cutoff = datetime.utcnow() - timedelta(
+                        seconds=self.reap_after)
+                    MonQTask.reap(cutoff)
+            except Exception:
+                self.log.exception('taskd heartbeat error')
+            finally:
+                ThreadLocalODMSession.close_all()
+            self._heartbeat_stop.wait(self.heartbeat_interval)
+
+    def start_heartbeat(self):
+        if self.heartbeat_interval <= 0 or self._heartbeat_thread is not None:
+            return
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop, name='taskd-heartbeat')
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_thread is None:
+            return
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+        self._heartbeat_thread = None
+
+    def _promote_scheduled(self):
+        """Move due scheduled tasks onto the ready queue. Returns the number
+        of seconds until the next scheduled task (or None).
+
+        """
+        task_queue = pylons.app_globals.task_queue
+        if not hasattr(task_queue, 'pop_due'):
+            return None
+        due = task_queue.pop_due()
+        if due:
+            self.log.debug('promoting scheduled tasks %s', due)
+            MonQTask.promote(due)
+        next_ts = task_queue.next_scheduled()
+        if next_ts is not None:
+            return max(next_ts - time.time(), 0)
+
     def _waitfunc_queue(self):
         while self.keep_running:
-            taskid = pylons.app_globals.task_queue.get(
-                timeout=self.task_queue_timeout)
+            timeout = self.task_queue_timeout
+            until_next = self._promote_scheduled()
+            if until_next is not None:
+                # blpop treats 0 as "forever", so wait at least a second
+                timeout = max(1, min(timeout or until_next, int(until_next)))
+            taskid = pylons.app_globals.task_queue.get(timeout=timeout)
             if taskid:
                 self.log.debug('got item %s from redis queue', taskid)
                 return
 
     def _waitfunc_noq(self):
         time.sleep(self.poll_interval)
+        MonQTask.promote_due()
+
+    def setup_schedule(self):
+        """Recover scheduled tasks and post the configured recurring tasks"""
+        MonQTask.promote_due()
+        if pylons.app_globals.task_queue:
+            MonQTask.reschedule_pending()
+        entries = aslist(
+            config.get('taskd.recurring', self.default_recurring), '\n')
+        for entry in entries:
+            if not entry:
+                continue
+            try:
+                path, interval = entry.split()
+                MonQTask.ensure_recurring(import_object(path), asint(interval))
+            except Exception:
+                self.log.exception('Error scheduling recurring task %s', entry)
 
     def event_loop(self):
         self.start_app()
+        try:
+            self.setup_schedule()
+        except QueueConnectionError:
+            self.log.exception("taskd cannot connect to task_queue")
+        # beat for claimed tasks from the first claim on, so that reapers
+        # (the worker's own or `taskd timeout`) leave them alone
+        self.start_heartbeat()
 
         only = self.only
         if only:
             only = only.split(',')
 
+        if self.concurrency > 1 or self.batch_size > 1:
+            self.batch_event_loop(only)
+            self._stop()
+            return
+
         if pylons.app_globals.task_queue:
             waitfunc = self._waitfunc_queue
         else:
@@ -112,7 +384,8 @@ class TaskdWorker(object):
                                         only=only,
                                         min_priority=self.min_priority):
             if task:
-                self.run_task(task)
+                self.stats.claimed(1)
+                self._run_tracked_task(task)
             else:
                 break
 
@@ -132,9 +405,27 @@ class TaskdWorker(object):
                     min_priority=self.min_priority)
                 self.task = None
             if self.task:
-                self.run_task(self.task)
+                self.stats.claimed(1)
+                self._run_tracked_task(self.task)
+            else:
+                self._log_drain()
+
+        self._stop()
 
-        self.log.info('taskd pid %s stopping gracefully.', os.getpid())
+    def _stop(self):
+        self.log.info('taskd pid %s stopping gracefully (%s).',
+                      os.getpid(), self.stats)
+        self.stop_heartbeat()
+        solr_indexer = getattr(pylons.app_globals, 'solr_indexer', None)
+        if solr_indexer:
+            solr_indexer.flush(raise_errors=False)
+            self.log.info('taskd pid %s solr indexing: %s',
+                          os.getpid(), solr_indexer.stats())
+        smtp_client = self._smtp_client()
+        if smtp_client:
+            self.log.info('taskd pid %s smtp: %s',
+                          os.getpid(), smtp_client.stats())
+            smtp_client.close()
 
         if self.restart_when_done:
             self.log.info('taskd pid %s restarting itself.', os.getpid())
@@ -36,6 +36,7 @@ from vulcanforge.project.model.membership import (
     RegistrationRequest
 )
 from vulcanforge.project.tasks import update_project_indexes
+from vulcanforge.project import navdata
 from vulcanforge.project.validators import MOUNTPOINT_VALIDATOR
 from vulcanforge.neighborhood.exceptions import RegistrationError
 from vulcanforge.neighborhood.model import Neighborhood
@@ -197,7 +198,7 @@ class ProjectAdminController(BaseController):
                 thumbnail_meta=dict(project_id=c.project._id, category='icon'))
             reindex = True
             session(ProjectFile).flush()
-            g.cache.redis.expire('navdata', 0)
+            navdata.bump_project(c.project._id)
 
         if kwargs.get('delete_icon', False):
             ProjectFile.remove(dict(
@@ -206,7 +207,7 @@ class ProjectAdminController(BaseController):
             ))
             reindex = True
             session(ProjectFile).flush()
-            g.cache.redis.expire('navdata', 0)
+            navdata.bump_project(c.project._id)
 
         ad_text = kwargs.get('ad_text', None)
         unpublish_ad = kwargs.get('unpublish_ad', False)
@@ -534,7 +535,7 @@ class ProjectAdminController(BaseController):
                     thumbnail_meta=dict(
                         app_config_id=ac._id, category='icon', size=32))
                 flash("New icon uploaded", "success")
-                g.cache.redis.expire('navdata', 0)
+                navdata.bump_project(c.project._id)
             elif kwargs.get('delete_icon'):
                 old_icon = ac.get_icon()
                 if old_icon:
@@ -543,7 +544,7 @@ class ProjectAdminController(BaseController):
                         category='icon'
                     ))
                     flash("Custom icon deleted", "success")
-                    g.cache.redis.expire('navdata', 0)
+                    navdata.bump_project(c.project._id)
                 else:
                     flash("There was no custom icon to delete", "error")
 
@@ -8,9 +8,6 @@ app
 @author: U{tannern<tannern@gmail.com>}
 """
 
-import datetime
-
-from bson import ObjectId
 from ming.odm import session
 from pylons import app_globals as g, tmpl_context as c
 from tg import redirect
@@ -31,7 +28,7 @@ from .controllers import (
     ForgeDownloadsRootController,
     ForgeDownloadsRestController)
 from vulcanforge.tools.downloads import model as FDM
-from vulcanforge.common.util.counts import get_info
+from vulcanforge.common.util.counts import get_info, get_counter_sizes
 from .version import VERSION
 
 
@@ -79,6 +76,10 @@ class ForgeDownloadsApp(Application):
         return get_info(coll, app_configs, app_visits, tool_name, size_item,
                         trefs=trefs)
 
+    @classmethod
+    def artifact_sizes(cls, app_configs):
+        return get_counter_sizes(app_configs)
+
     def install(self, *args, **kwargs):
         super(ForgeDownloadsApp, self).install(*args, **kwargs)
         self._mk_root_dir()
@@ -119,24 +120,6 @@ class ForgeDownloadsApp(Application):
             ])
         return links
 
-    def artifact_counts(self, since=None):
-        ts = (since if isinstance(since, datetime.datetime)
-              else self.config._id.generation_time)
-        ts = ObjectId.from_datetime(ts)
-        base_query = {"app_config_id": self.config._id, "deleted": False}
-        match = {"$match": base_query}
-        let = {"$let": {"vars": {"app_visit": ts, "creation": '$_id'},
-                        "in": {"$gt": ["$$creation", "$$app_visit"]}}}
-        group = {"$group": {"_id": None, "all": {"$sum": 1},
-                            "total": {"$sum": "$filesize"},
-                            "new": {"$sum": {"$cond": [let, 1, 0]}}}}
-        db, file_coll = FDM.ForgeDownloadsFile.get_pymongo_db_and_collection()
-        agr = list(file_coll.aggregate([match, group]))
-        result = agr.pop() if agr else dict(all=0, new=0, total=0)
-        resp = dict(all=result['all'], new=result['new'],
-                    total_size=result['total'])
-        return resp
-
     def sidebar_menu(self):
         sidebarMenu = []
 
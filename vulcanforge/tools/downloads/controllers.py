@@ -489,7 +489,7 @@ class ContentRestController(RestController):
         zip_contained_file = FDM.ZipContainedFile.upsert(zip_file._id, inner_path)
         set_download_headers(os.path.basename(file_info['filename']))
         set_cache_headers(expires_in=1)
-        return zip_contained_file.read()
+        return zip_contained_file.iter_content()
 
     def _exchange_info(self):
         file_xcng_info, folder_xcng_info = [], []
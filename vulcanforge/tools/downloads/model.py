@@ -48,6 +48,7 @@ from vulcanforge.virusscan.model import S3VirusScannableMixin
 from vulcanforge.notification.model import Notification
 
 from tasks import delete_content_from_s3
+from .util import iter_zip_member
 
 from . import get_resource_path
 
@@ -130,6 +131,8 @@ class ForgeDownloadsFile(ForgeDownloadsAbstractItem,
 
     type_s = 'ForgeDownloadsFile'
     visualizable_kind = 'downloads_file'
+    counted = True
+    counter_size_field = 'filesize'
 
     # Used for large files to support the resume operation
     md5_signature = FieldProperty(str, if_missing='')
@@ -294,7 +297,9 @@ class ForgeDownloadsFile(ForgeDownloadsAbstractItem,
                 zip_manifest[key] = {
                     'filename': os.path.basename(zipinfo.filename.rstrip('/')),
                     'path': zipinfo.filename,
+                    'header_offset': zipinfo.header_offset,
                     'offset': zipinfo.header_offset + len(zipinfo.FileHeader()),
+                    'CRC': zipinfo.CRC,
                     'compressed_size': zipinfo.compress_size,
                     'file_size': zipinfo.file_size,
                     'timestamp': datetime(*zipinfo.date_time),
@@ -518,7 +523,17 @@ class ZipContainedFile(VisualizableArtifact):
     def index(self, **kwargs):
         return False
 
-    def read(self):
+    def iter_content(self):
+        """Yield the uncompressed content in chunks, read with a ranged GET
+        of just this member of the archive
+
+        """
+        if 'header_offset' in self.file_info:
+            return iter_zip_member(self.container.get_key(), self.file_info)
+        # manifests from before header offsets were recorded
+        return iter([self._read_from_zip_file()])
+
+    def _read_from_zip_file(self):
         zip_file = self.container.zip_file
 
         try:
@@ -528,6 +543,9 @@ class ZipContainedFile(VisualizableArtifact):
 
         return zip_file.open(zinfo).read()
 
+    def read(self):
+        return ''.join(self.iter_content())
+
     def serve(self, *args, **kwargs):
         """
         Sets the response headers and serves as a wsgi iter
@@ -539,7 +557,7 @@ class ZipContainedFile(VisualizableArtifact):
         set_download_headers(self.filename)
         # enable caching
         set_cache_headers(self._id.generation_time)
-        return self.read()
+        return self.iter_content()
 
     @LazyProperty
     def container(self):
@@ -0,0 +1,127 @@
+"""
+Reads members of zip archives stored in S3 straight from their zip manifest
+entries, with ranged GETs and streaming decompression, instead of opening
+the archive and scanning its central directory.
+
+"""
+import struct
+import zlib
+
+from vulcanforge.common.lib.zipfile import (
+    BadZipfile,
+    ZIP_STORED,
+    ZIP_DEFLATED,
+    structFileHeader,
+    sizeFileHeader,
+    stringFileHeader,
+    _FH_SIGNATURE,
+    _FH_FILENAME_LENGTH,
+    _FH_EXTRA_FIELD_LENGTH
+)
+
+CHUNK_SIZE = 64 * 1024
+
+# The local header of a member may carry a longer extra field than its
+# central directory entry; read this much past the member to cover it.
+EXTRA_FIELD_SLACK = 1024
+
+
+class S3RangeReader(object):
+    """
+    Sequential reader of the bytes of an S3 key from start on.
+
+    The first read fetches bytes up to stop with one ranged GET, which is
+    then streamed; reads past stop fetch the remainder with another one.
+
+    """
+    def __init__(self, key, start, stop):
+        self.key = key
+        self.position = start
+        self.stop = stop
+        self._response = None
+        self._response_stop = None
+
+    def _open(self, size):
+        stop = max(self.stop, self.position + size)
+        bucket = self.key.bucket
+        self._response = bucket.connection.make_request(
+            'GET', bucket, self.key.name,
+            headers={'Range': 'bytes={}-{}'.format(self.position, stop - 1)})
+        if self._response.status not in (200, 206):
+            status = self._response.status
+            self.close()
+            raise IOError('Ranged read of {} failed with status {}'.format(
+                self.key.name, status))
+        self._response_stop = stop
+
+    def read(self, size):
+        data = []
+        while size > 0:
+            if self._response is None:
+                self._open(size)
+            chunk = self._response.read(
+                min(size, self._response_stop - self.position))
+            if not chunk:
+                if self._response_stop > self.position:
+                    break  # end of the key
+                self.close()
+                continue
+            data.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def read_exactly(self, size):
+        data = self.read(size)
+        if len(data) != size:
+            raise BadZipfile('Truncated zip member in {}'.format(self.key.name))
+        return data
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+
+def iter_zip_member(key, entry, chunk_size=CHUNK_SIZE):
+    """
+    Yield the uncompressed content of the zip member described by a zip
+    manifest entry of the archive stored at key, in chunks.
+
+    """
+    compress_type = entry['compress_type']
+    if compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        raise NotImplementedError(
+            "compression type {}".format(compress_type))
+    reader = S3RangeReader(
+        key,
+        entry['header_offset'],
+        entry['offset'] + entry['compressed_size'] + EXTRA_FIELD_SLACK)
+    try:
+        fheader = struct.unpack(
+            structFileHeader, reader.read_exactly(sizeFileHeader))
+        if fheader[_FH_SIGNATURE] != stringFileHeader:
+            raise BadZipfile("Bad magic number for file header")
+        reader.read_exactly(
+            fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+
+        if compress_type == ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        else:
+            decompressor = None
+        crc = 0
+        remaining = entry['compressed_size']
+        while remaining > 0:
+            data = reader.read_exactly(min(chunk_size, remaining))
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+                if remaining == 0:
+                    data += decompressor.flush()
+            if data:
+                crc = zlib.crc32(data, crc)
+                yield data
+        if 'CRC' in entry and (crc & 0xffffffff) != entry['CRC']:
+            raise BadZipfile("Bad CRC-32 for file {}".format(entry['path']))
+    finally:
+        reader.close()
@@ -1,10 +1,8 @@
 #-*- python -*-
 import logging
 import urllib
-import datetime
 from itertools import islice
 
-from bson import ObjectId
 import pymongo
 from webhelpers.text import truncate
 from pylons import app_globals as g, tmpl_context as c, request
@@ -16,7 +14,10 @@ from vulcanforge.common.app import (
 from vulcanforge.common.tool import SitemapEntry, ConfigOption
 from vulcanforge.common.util import push_config
 from vulcanforge.common.util.exception import exceptionless
-from vulcanforge.common.util.counts import get_history_info
+from vulcanforge.common.util.counts import (
+    get_history_info,
+    get_attachment_sizes
+)
 from vulcanforge.resources import Icon
 from vulcanforge.tools.forum import model as DM, util, version
 from .controllers import RootController, RootRestController, TEMPLATE_DIR
@@ -79,6 +80,10 @@ class ForgeDiscussionApp(Application):
         return get_history_info(coll, app_configs, app_visits, tool_name,
                                 trefs)
 
+    @classmethod
+    def artifact_sizes(cls, app_configs):
+        return get_attachment_sizes(DM.ForumAttachment, app_configs)
+
     @classmethod
     def permissions(cls):
         perms = super(ForgeDiscussionApp, cls).permissions()
@@ -257,64 +262,6 @@ class ForgeDiscussionApp(Application):
         DM.ForumPost.query.remove(dict(app_config_id=self.config._id))
         super(ForgeDiscussionApp, self).uninstall(project)
 
-    def artifact_counts(self, since=None):
-        # Rely on page history object only
-
-        db, history_coll = DM.ForumPostHistory.get_pymongo_db_and_collection()
-
-        new_history_count = history_count = total_size = 0
-        history_objs = list(history_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-                }},
-            {'$group': {
-                '_id': '$artifact_id'
-            }},
-            {'$group': {
-                '_id': 1,
-                'count': { '$sum': 1}
-            }}
-        ]))
-
-        if history_objs:
-            history_count = history_objs[0]['count']
-        if since is not None and isinstance(since, datetime.datetime) :
-            new_history_objs = list(history_coll.aggregate([
-                {'$match': {
-                    'app_config_id': self.config._id,
-                    "_id": {"$gt":ObjectId.from_datetime(since)}
-                }},
-                {'$group': {
-                    '_id': '$artifact_id'
-                }},
-                {'$group': {
-                    '_id': 1,
-                    'count': { '$sum': 1}
-                }}
-            ]))
-            if new_history_objs:
-                new_history_count = new_history_objs[0]['count']
-
-        db, attachment_coll = \
-            DM.ForumAttachment.get_pymongo_db_and_collection()
-        file_aggregate = list(attachment_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-            }},
-            {'$group': {
-                '_id': 1,
-                'total_size': {'$sum': '$length'}
-            }}
-        ]))
-        if file_aggregate:
-            total_size = file_aggregate[0]['total_size']
-
-        return dict(
-            new=new_history_count,
-            all=history_count,
-            total_size=total_size
-        )
-
 
 class ForumAdminController(DefaultAdminController):
 
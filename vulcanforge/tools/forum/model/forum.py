@@ -257,6 +257,8 @@ class ForumPost(AbstractPost):
         name = 'forum_post'
         history_class = ForumPostHistory
 
+    counted = True
+
     discussion_id = ForeignIdProperty(Forum)
     thread_id = ForeignIdProperty(ForumThread)
 
@@ -30,6 +30,7 @@ from vulcanforge.common.tasks.index import add_global_objs
 from vulcanforge.neighborhood.exceptions import RegistrationError
 from vulcanforge.tools.home.model import PortalConfig
 from vulcanforge.tools.admin.admin_main import PROJECT_ADMIN_DESCRIPTION
+from vulcanforge.project import navdata
 from vulcanforge.project.model.membership import (
     MembershipCancelRequest,
     MembershipRemovalRequest
@@ -146,38 +147,6 @@ class ProjectHomeApp(Application):
     def admin_menu(self):
         return []
 
-    def artifact_counts(self, since=None):
-        db, role_coll = ProjectRole.get_pymongo_db_and_collection()
-
-        query_dict = {
-            "project_id":self.project._id,
-            "user_id": {'$ne': None},
-            "roles": {"$ne": []}
-        }
-        group_dict = {
-            '_id': '$user_id',
-            'id': {'$first': '$_id'}
-        }
-
-        role_aggregate = list(role_coll.aggregate([
-            {'$match': query_dict},
-            {'$group': group_dict}
-        ]))
-        new_member_count = member_count = len(role_aggregate)
-
-        if since is not None and isinstance(since, datetime):
-            query_dict['_id'] = {"$gt": ObjectId.from_datetime(since)}
-            role_aggregate = list(role_coll.aggregate([
-                {'$match': query_dict},
-                {'$group': group_dict}
-            ]))
-            new_member_count = len(role_aggregate)
-
-        return dict(
-            new=new_member_count,
-            all=member_count
-        )
-
 
 class ProjectHomeController(BaseController):
 
@@ -723,7 +692,7 @@ class ProjectHomeController(BaseController):
                 thumbnail_meta=dict(project_id=c.project._id,
                                     category='icon'))
             session(ProjectFile).flush()
-            g.cache.redis.expire('navdata', 0)
+            navdata.bump_project(c.project._id)
             if state(c.project).status != "dirty":
                 add_global_objs.post([c.project.index_id()])
         return {"status": "success"}
@@ -0,0 +1,152 @@
+"""
+Rollups of the custom fields of type 'sum' over subticket trees.
+
+Tickets store the ids of their supertickets, root first, in ancestor_ids,
+so the tickets under one are found by a single indexed query. A ticket with
+subtickets holds the sums of the values of the leaves under it; a rollup of
+a tree is one aggregation over its tickets and one bulk write of the sums
+that changed.
+
+These work on the pymongo collection of the tickets, outside of the ORM
+session: the writes create no versions and do not touch mod_date.
+
+$sum ignores strings, so values of sum fields must be stored as numbers:
+every write path goes through sum_value, and coerce_sums converts the
+numeric strings of older or imported data.
+
+"""
+from pymongo import UpdateOne
+
+# results of one tree in one round trip; a tree of 10,000 tickets with
+# subtickets is out of the ordinary
+BATCH_SIZE = 10000
+
+
+def sum_value(value):
+    """A value of a sum field as stored: a number, 0 if it is none"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def coerce_sums(coll, query, fields):
+    """
+    Convert the numeric strings in the sum fields of the tickets matching
+    query to numbers. Other strings count as 0 either way and are kept.
+
+    @return: the number of values converted
+
+    """
+    requests = []
+    for name in fields:
+        key = 'custom_fields.' + name
+        spec = dict(query)
+        spec[key] = {'$type': 'string'}
+        cursor = coll.find(spec, {key: 1}, batch_size=BATCH_SIZE)
+        for doc in cursor:
+            value = doc['custom_fields'][name]
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            requests.append(UpdateOne(
+                {'_id': doc['_id'], key: value}, {'$set': {key: number}}))
+    if requests:
+        coll.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def sums_pipeline(app_config_id, root_id, fields, exclude_ids=()):
+    """
+    Aggregation of the sums of the tickets with subtickets under (and
+    including) root_id, with their current values.
+
+    Leaves contribute their values to each of their ancestors; tickets with
+    subtickets contribute their current values to themselves, for
+    comparison. Ancestors of root_id are listed in exclude_ids.
+
+    """
+    has_subtickets = {'$gt': [{'$size': {'$ifNull': ['$sub_ids', []]}}, 0]}
+    project = {
+        'targets': {'$cond': [has_subtickets, ['$_id'], '$ancestor_ids']}
+    }
+    own = {'$eq': ['$_id', '$targets']}
+    group = {'_id': '$targets'}
+    for i, name in enumerate(fields):
+        project['f%d' % i] = '$custom_fields.' + name
+        group['sum%d' % i] = {'$sum': {'$cond': [own, 0, '$f%d' % i]}}
+        group['value%d' % i] = {'$max': {'$cond': [own, '$f%d' % i, None]}}
+    return [
+        {'$match': {
+            'app_config_id': app_config_id,
+            '$or': [{'_id': root_id}, {'ancestor_ids': root_id}]}},
+        {'$project': project},
+        {'$unwind': '$targets'},
+        {'$match': {'targets': {'$nin': list(exclude_ids)}}},
+        {'$group': group}
+    ]
+
+
+def changed_sums(results, fields):
+    """{ticket id: {field: sum}} of the results whose sums changed"""
+    changes = {}
+    for doc in results:
+        sums = {}
+        changed = False
+        for i, name in enumerate(fields):
+            sums[name] = float(doc['sum%d' % i])
+            if doc['value%d' % i] != sums[name]:
+                changed = True
+        if changed:
+            changes[doc['_id']] = sums
+    return changes
+
+
+def rollup_sums(coll, app_config_id, root_id, fields, exclude_ids=()):
+    """
+    Recompute the sum fields of the tickets with subtickets under (and
+    including) root_id, and write those that changed.
+
+    Values of leaves that are not numbers count as 0.
+
+    @return: {ticket id: {field: sum}} of the tickets written
+
+    """
+    if not fields:
+        return {}
+    results = coll.aggregate(
+        sums_pipeline(app_config_id, root_id, fields, exclude_ids),
+        batchSize=BATCH_SIZE)
+    changes = changed_sums(results, fields)
+    if changes:
+        coll.bulk_write([
+            UpdateOne({'_id': _id}, {'$set': dict(
+                ('custom_fields.' + name, value)
+                for name, value in sums.iteritems())})
+            for _id, sums in changes.iteritems()
+        ], ordered=False)
+    return changes
+
+
+def move_subtree(coll, app_config_id, ticket_id, old_path, new_path):
+    """
+    Rewrite the ancestor_ids of the tickets under ticket_id after its own
+    changed from old_path to new_path.
+
+    @return: {ticket id: ancestor_ids} of the tickets written
+
+    """
+    depth = len(old_path)
+    paths = {}
+    cursor = coll.find(
+        {'app_config_id': app_config_id, 'ancestor_ids': ticket_id},
+        {'ancestor_ids': 1}, batch_size=BATCH_SIZE)
+    for doc in cursor:
+        paths[doc['_id']] = list(new_path) + doc['ancestor_ids'][depth:]
+    if paths:
+        coll.bulk_write([
+            UpdateOne({'_id': _id}, {'$set': {'ancestor_ids': path}})
+            for _id, path in paths.iteritems()
+        ], ordered=False)
+    return paths
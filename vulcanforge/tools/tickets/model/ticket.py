@@ -30,6 +30,7 @@ from vulcanforge.discussion.model import Thread
 from vulcanforge.notification.model import Notification
 from vulcanforge.project.model import ProjectRole
 from vulcanforge.tools.tickets.tasks import refresh_search_counts
+from . import rollup
 from .session import ticket_orm_session
 
 LOG = logging.getLogger(__name__)
@@ -281,18 +282,22 @@ class Ticket(VersionedArtifact):
         indexes = [
             'ticket_num',
             'app_config_id',
-            ('app_config_id', 'custom_fields._milestone')]
+            ('app_config_id', 'custom_fields._milestone'),
+            ('app_config_id', 'ancestor_ids')]
         unique_indexes = [
             ('app_config_id', 'ticket_num')
         ]
 
     type_s = 'Ticket'
+    counted = True
     _id = FieldProperty(schema.ObjectId)
     created_date = FieldProperty(datetime, if_missing=datetime.utcnow)
     closed_date = FieldProperty(datetime, if_missing=None)
 
     super_id = FieldProperty(schema.ObjectId, if_missing=None)
     sub_ids = FieldProperty([schema.ObjectId], if_missing=[])
+    # supertickets, root first
+    ancestor_ids = FieldProperty([schema.ObjectId], if_missing=[])
     ticket_num = FieldProperty(int, required=True, allow_none=False)
     summary = FieldProperty(str, if_missing='')
     description = FieldProperty(str, if_missing='')
@@ -604,12 +609,22 @@ class Ticket(VersionedArtifact):
         }).all()
 
     def set_as_subticket_of(self, new_super_id):
-        # For this to be generally useful we would have to check first that
-        # new_super_id is not a sub_id (recursively) of self
-
         if self.super_id == new_super_id:
             return
 
+        new_super = None
+        if new_super_id is not None:
+            new_super = Ticket.query.get(
+                _id=new_super_id,
+                app_config_id=c.app.config._id
+            )
+            if new_super_id == self._id or \
+                    self._id in new_super.ancestor_ids:
+                LOG.warning('Not making ticket %s a subticket of its own '
+                            'subticket %s', self._id, new_super_id)
+                return
+
+        old_super = None
         if self.super_id is not None:
             old_super = Ticket.query.get(
                 _id=self.super_id,
@@ -617,72 +632,90 @@ class Ticket(VersionedArtifact):
             )
             old_super.sub_ids = [id for id in old_super.sub_ids
                                  if id != self._id]
-            old_super.dirty_sums(dirty_self=True)
 
+        old_path = list(self.ancestor_ids)
         self.super_id = new_super_id
-
-        if new_super_id is not None:
-            new_super = Ticket.query.get(
-                _id=new_super_id,
-                app_config_id=c.app.config._id
-            )
+        if new_super is not None:
             if new_super.sub_ids is None:
                 new_super.sub_ids = []
             if self._id not in new_super.sub_ids:
                 new_super.sub_ids.append(self._id)
-            new_super.dirty_sums(dirty_self=True)
+            self.ancestor_ids = list(new_super.ancestor_ids) + [new_super._id]
+        else:
+            self.ancestor_ids = []
+
+        db, coll = pymongo_db_collection(self.__class__)
+        paths = rollup.move_subtree(
+            coll, self.app_config_id, self._id, old_path, self.ancestor_ids)
+        imap = session(self.__class__).imap
+        for _id, path in paths.iteritems():
+            ticket = imap.get(self.__class__, _id)
+            if ticket is not None:
+                ticket.ancestor_ids = path
+        roots = []
+        for ticket in (old_super, new_super):
+            if ticket is not None:
+                root_id = (ticket.ancestor_ids or [ticket._id])[0]
+                if root_id not in roots:
+                    roots.append(root_id)
+        for root_id in roots:
+            self.rollup_sums(root_id)
+
+    @classmethod
+    def sum_field_names(cls):
+        globals = Globals.query.get(app_config_id=c.app.config._id)
+        return [cf.name for cf in globals.custom_fields or []
+                if cf['type'] == 'sum']
+
+    @classmethod
+    def rollup_sums(cls, root_id, exclude_ids=()):
+        """Recalculate the custom fields of type 'sum' (if any) of the
+        tickets with subtickets under (and including) root_id, whose
+        supertickets are exclude_ids.
 
-    def recalculate_sums(self, super_sums=None):
-        """Calculate custom fields of type 'sum' (if any) by recursing into
-        subtickets (if any).
+        The sums are aggregated from the flushed tickets and written in
+        mongo, without new versions. Tickets loaded in the session get the
+        new sums too, so a later flush does not revert them, and are indexed
+        by that flush; the others are indexed here.
 
         """
-        if super_sums is None:
-            super_sums = {}
-            globals = Globals.query.get(app_config_id=c.app.config._id)
-            for k in [cf.name for cf in globals.custom_fields or []
-                      if cf['type'] == 'sum']:
-                super_sums[k] = float(0)
-
-        # if there are no custom fields of type 'sum', we're done
-        if not super_sums:
-            return
+        fields = cls.sum_field_names()
+        if not fields:
+            return {}
+        session(cls).flush()
+        db, coll = pymongo_db_collection(cls)
+        changes = rollup.rollup_sums(
+            coll, c.app.config._id, root_id, fields, exclude_ids)
+        imap = session(cls).imap
+        ref_ids = []
+        for _id, sums in changes.iteritems():
+            ticket = imap.get(cls, _id)
+            if ticket is None:
+                ref_ids.append(cls.index_id_of(_id))
+            else:
+                for k, v in sums.iteritems():
+                    ticket.custom_fields[k] = v
+        if ref_ids:
+            from vulcanforge.artifact.tasks import add_artifacts
+            add_artifacts.post(ref_ids, taskd_coalesce=True)
+        return changes
 
-        # if this ticket has no subtickets, use its field values directly
-        if not self.sub_ids:
-            for k in super_sums:
-                try:
-                    v = float(self.custom_fields.get(k, 0))
-                except (TypeError, ValueError):
-                    v = 0
-                super_sums[k] += v
+    def recalculate_sums(self):
+        """Calculate custom fields of type 'sum' (if any) of this ticket
+        and its subtickets (recursively) from the leaves under it.
 
-        # else recurse into subtickets
-        else:
-            sub_sums = {}
-            for k in super_sums:
-                sub_sums[k] = float(0)
-            for id in self.sub_ids:
-                subticket = Ticket.query.get(
-                    _id=id, app_config_id=c.app.config._id)
-                subticket.recalculate_sums(sub_sums)
-            for k, v in sub_sums.iteritems():
-                self.custom_fields[k] = v
-                super_sums[k] += v
+        """
+        return self.rollup_sums(self._id, exclude_ids=self.ancestor_ids)
 
     def dirty_sums(self, dirty_self=False):
-        """From a changed ticket, climb the superticket chain to call
-        recalculate_sums at the root.
+        """From a changed ticket, recalculate the sums of the tree it is in,
+        if it is a subticket (or dirty_self).
 
         """
-        root = self if dirty_self else None
-        next_id = self.super_id
-        while next_id is not None:
-            root = Ticket.query.get(
-                _id=next_id, app_config_id=c.app.config._id)
-            next_id = root.super_id
-        if root is not None:
-            root.recalculate_sums()
+        if self.ancestor_ids:
+            self.rollup_sums(self.ancestor_ids[0])
+        elif dirty_self:
+            self.rollup_sums(self._id)
 
     def update(self, ticket_form):
         # update is not allowed to change the ticket_num
@@ -744,10 +777,7 @@ class Ticket(VersionedArtifact):
             for k, v in ticket_form['custom_fields'].iteritems():
                 if k in custom_sums:
                     # sums must be coerced to numeric type
-                    try:
-                        self.custom_fields[k] = float(v)
-                    except (TypeError, ValueError):
-                        self.custom_fields[k] = 0
+                    self.custom_fields[k] = rollup.sum_value(v)
                 elif k in other_custom_fields:
                     # strings are good enough for any other custom fields
                     self.custom_fields[k] = v
@@ -802,6 +832,12 @@ class Ticket(VersionedArtifact):
           - call this routine with a very high limit and TEST that
             count<=limit in the result
         limit=-1 is NOT recognized as 'all'.  500 is a reasonable limit.
+
+        SOLR only matches tickets one of the user's read roles can read,
+        so count is exact and a page takes one SOLR and one Mongo query.
+        The tickets are checked again in Mongo in case the index is
+        stale, once per distinct ACL: the tickets of the tool share their
+        parent security context, the tool.
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
         count = 0
@@ -811,9 +847,12 @@ class Ticket(VersionedArtifact):
             refined_sort += ',ticket_num_i asc'
         try:
             if q:
+                fq_dict = dict(kw.pop('fq_dict', None) or {})
+                fq_dict['read_roles'] = '"{}"'.format('" OR "'.join(
+                    sorted(g.security.get_user_read_roles())))
                 matches = g.search.search_artifact(
                     cls, q, rows=limit, sort=refined_sort, start=start,
-                    fl='ticket_num_i', **kw)
+                    fl='ticket_num_i', fq_dict=fq_dict, **kw)
             else:
                 matches = None
             solr_error = None
@@ -832,13 +871,13 @@ class Ticket(VersionedArtifact):
             for t in query:
                 ticket_for_num[t.ticket_num] = t
             # and pull them out in the order given by ticket_numbers
-            tickets = []
-            for tn in ticket_numbers:
-                if tn in ticket_for_num:
-                    if g.security.has_access(ticket_for_num[tn], 'read'):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count -= 1
+            tickets = [ticket_for_num[tn] for tn in ticket_numbers
+                       if tn in ticket_for_num]
+            readable = g.security.filter_by_access(
+                tickets, 'read', project=c.project,
+                key=lambda t: g.security.acl_key(t.acl))
+            count -= len(tickets) - len(readable)
+            tickets = readable
         sortable_custom_fields = \
             c.app.globals.sortable_custom_fields_shown_in_search()
         if not columns:
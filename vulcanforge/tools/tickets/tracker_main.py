@@ -33,8 +33,12 @@ from vulcanforge.common.controllers.decorators import (
 from vulcanforge.common import validators as V, helpers as h
 from vulcanforge.common.tool import SitemapEntry
 from vulcanforge.common.util import push_config
-from vulcanforge.common.util.counts import get_history_info
+from vulcanforge.common.util.counts import (
+    get_history_info,
+    get_attachment_sizes
+)
 from vulcanforge.common.util.exception import exceptionless
+from vulcanforge.common.util.model import pymongo_db_collection
 from vulcanforge.common.widgets import form_fields as ffw
 from vulcanforge.common.controllers import BaseController
 from vulcanforge.artifact.controllers import (
@@ -57,6 +61,7 @@ from vulcanforge.notification.model import Mailbox
 from vulcanforge.project.widgets import ProjectUserSelect
 from vulcanforge.resources import Icon
 from . import model as TM
+from .model.rollup import coerce_sums, sum_value
 from . import version
 from vulcanforge.tools.tickets.util import changelog
 from vulcanforge.tools.tickets.widgets.forms import TicketCustomField
@@ -136,6 +141,10 @@ class ForgeTrackerApp(Application):
         return get_history_info(coll, app_configs, app_visits, tool_name,
                                 trefs)
 
+    @classmethod
+    def artifact_sizes(cls, app_configs):
+        return get_attachment_sizes(TM.TicketAttachment, app_configs)
+
     @classmethod
     def permissions(cls):
         perms = super(ForgeTrackerApp, cls).permissions()
@@ -459,61 +468,6 @@ class ForgeTrackerApp(Application):
                    'reported_by_s:{username}'
         return template.format(base=self.config.url(), username=username)
 
-    def artifact_counts(self, since=None):
-        db, history_coll = TM.TicketHistory.get_pymongo_db_and_collection()
-
-        new_history_count = history_count = total_size = 0
-        history_objs = list(history_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-                }},
-            {'$group': {
-                '_id': '$artifact_id'
-            }},
-            {'$group': {
-                '_id': 1,
-                'count': { '$sum': 1}
-            }}
-        ]))
-
-        if history_objs:
-            history_count = history_objs[0]['count']
-        if since is not None and isinstance(since, datetime) :
-            new_history_objs = list(history_coll.aggregate([
-                {'$match': {
-                    'app_config_id': self.config._id,
-                    "_id": {"$gt":ObjectId.from_datetime(since)}
-                }},
-                {'$group': {
-                    '_id': '$artifact_id'
-                }},
-                {'$group': {
-                    '_id': 1,
-                    'count': { '$sum': 1}
-                }}
-            ]))
-            if new_history_objs:
-                new_history_count = new_history_objs[0]['count']
-
-        db, attachment_coll = TM.TicketAttachment.get_pymongo_db_and_collection()
-        file_aggregate = list(attachment_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-                }},
-            {'$group': {
-                '_id': 1,
-                'total_size': { '$sum': '$length'}
-            }}
-        ]))
-        if file_aggregate:
-                total_size = file_aggregate[0]['total_size']
-
-        return dict(
-            new=new_history_count,
-            all=history_count,
-            total_size=total_size
-        )
-
 
 class BaseTrackerController(BaseController):
 
@@ -561,14 +515,19 @@ class BaseTrackerController(BaseController):
                             values['assigned_to_ids'].append(user._id)
 
         custom_fields = {cf.name for cf in c.app.globals.custom_fields or []}
+        sum_fields = {cf.name for cf in c.app.globals.custom_fields or []
+                      if cf.type == 'sum'}
         custom_values = {}
         for k in custom_fields:
             if not c.app.globals.can_edit_field(k):
                 continue
             v = post_data.get(k)
             if v:
+                if k in sum_fields:
+                    v = sum_value(v)
                 custom_values[k] = v
 
+        root_ids = set()
         for ticket in tickets:
             changed = False
             for k, v in values.iteritems():
@@ -583,8 +542,12 @@ class BaseTrackerController(BaseController):
                 if ticket.custom_fields.get(k) != v:
                     ticket.custom_fields[k] = v
                     changed = True
+                    if k in sum_fields:
+                        root_ids.add((ticket.ancestor_ids or [ticket._id])[0])
             if changed:
                 ticket.commit()
+        for root_id in root_ids:
+            TM.Ticket.rollup_sums(root_id)
 
         redirect(request.referer or c.app.url)
 
@@ -1362,10 +1325,7 @@ class TicketController(BaseTrackerController):
                 value = post_custom_fields[cf.name]
                 if cf.type == 'sum':
                     any_sums = True
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0
+                    value = sum_value(value)
             elif cf.name in post_markdown_custom_fields:
                 value = post_markdown_custom_fields[cf.name]
             elif cf.name == '_milestone' and cf.name in post_data:
@@ -1469,7 +1429,17 @@ class TrackerAdminController(DefaultAdminController):
                 [w for w in NONALNUM_RE.split(field['label'].lower()) if w]
             )
             field['label'] = field['label'].title()
+        old_sums = {cf['name'] for cf in self.app.globals.custom_fields or []
+                    if cf['type'] == 'sum'}
         self.app.globals.custom_fields = custom_fields
+        new_sums = [field['name'] for field in custom_fields
+                    if field.get('type') == 'sum' and
+                    field['name'] not in old_sums]
+        if new_sums:
+            # fields that held strings until now
+            db, coll = pymongo_db_collection(TM.Ticket)
+            coerce_sums(coll, {'app_config_id': self.app.config._id},
+                        new_sums)
         flash('Fields updated')
         redirect(request.referer or 'permissions')
 
@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
 #-*- python -*-
 import logging
-import datetime
 
-from bson import ObjectId
 from pylons import app_globals as g, tmpl_context as c
 import pymongo
 from ming.odm import session
@@ -18,7 +16,10 @@ from vulcanforge.resources import Icon
 # Local imports
 from .version import __version__
 from .model import Page, WikiAttachment, Globals, PageHistory
-from vulcanforge.common.util.counts import get_history_info
+from vulcanforge.common.util.counts import (
+    get_history_info,
+    get_attachment_sizes
+)
 from vulcanforge.tools.wiki.controllers import (
     RootController,
     PageController,
@@ -92,6 +93,10 @@ class ForgeWikiApp(Application):
         return get_history_info(coll, app_configs, app_visits, tool_name,
                                 trefs)
 
+    @classmethod
+    def artifact_sizes(cls, app_configs):
+        return get_attachment_sizes(WikiAttachment, app_configs)
+
     @classmethod
     def permissions(cls):
         perms = super(ForgeWikiApp, cls).permissions()
@@ -360,59 +365,3 @@ class ForgeWikiApp(Application):
         if sort:
             cursor.sort('featured_ordinal', pymongo.ASCENDING)
         return cursor
-
-    def artifact_counts(self, since=None):
-        # Rely on page history object only
-
-        db, history_coll = PageHistory.get_pymongo_db_and_collection()
-
-        new_history_count = history_count = total_size = 0
-        history_objs = list(history_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-            }},
-            {'$group': {
-                '_id': '$artifact_id'
-            }},
-            {'$group': {
-                '_id': 1,
-                'count': { '$sum': 1}
-            }}
-        ]))
-        if history_objs:
-            history_count = history_objs[0]['count']
-        if since is not None and isinstance(since, datetime.datetime) :
-            new_history_objs = list(history_coll.aggregate([
-                {'$match': {
-                    'app_config_id': self.config._id,
-                    "_id": {"$gt":ObjectId.from_datetime(since)}
-                }},
-                {'$group': {
-                    '_id': '$artifact_id'
-                }},
-                {'$group': {
-                    '_id': 1,
-                    'count': { '$sum': 1}
-                }}
-            ]))
-            if new_history_objs:
-                new_history_count = new_history_objs[0]['count']
-
-        db, attachment_coll = WikiAttachment.get_pymongo_db_and_collection()
-        file_aggregate = list(attachment_coll.aggregate([
-            {'$match': {
-                'app_config_id': self.config._id,
-            }},
-            {'$group': {
-                '_id': 1,
-                'total_size': {'$sum': '$length'}
-            }}
-        ]))
-        if file_aggregate:
-            total_size = file_aggregate[0]['total_size']
-
-        return dict(
-            new=new_history_count,
-            all=history_count,
-            total_size=total_size
-        )
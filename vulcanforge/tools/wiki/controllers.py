@@ -36,6 +36,7 @@ from vulcanforge.common.widgets.util import PageList, PageSize
 from vulcanforge.discussion.controllers import AppDiscussionController
 from vulcanforge.discussion.widgets import ThreadWidget
 from vulcanforge.notification.model import Mailbox
+from vulcanforge.project import navdata
 from vulcanforge.tools.wiki.model import Page, Globals, WikiAttachment
 from vulcanforge.tools.wiki.widgets.wiki import CreatePageWidget, \
     WikiPageMenuBar
@@ -701,7 +702,7 @@ class PageController(BaseArtifactController, WikiContentBaseController):
                 for i, page in enumerate(cursor):
                     page.featured_ordinal = i
                 self.page.featured_ordinal = None
-            g.cache.redis.expire('navdata', 0)
+            navdata.bump_project(c.project._id)
 
         redirect(
             really_unicode(c.app.url + self.page.title +(u'/' if not name_conflict else u'/edit')).encode('utf-8')
@@ -923,7 +924,7 @@ class WikiAdminController(DefaultAdminController):
                                       _id=_id)
                 if page is not None and g.security.has_access(page, 'write'):
                     page.featured_label = value
-        g.cache.redis.expire('navdata', 0)
+        navdata.bump_project(c.project._id)
         flash('Wiki featured pages updated')
         redirect(c.project.url() + 'admin/tools')
 
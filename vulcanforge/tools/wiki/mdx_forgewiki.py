@@ -69,6 +69,7 @@ class WikiPageIncludePreprocessor(markdown.preprocessors.Preprocessor):
                 line_cursor += 1
                 continue
             lines.pop(line_cursor)  # remove the include tag
+            self.extension.live_content = True
             prefix, include_title = include_match.groups()
             if prefix is None:
                 prefix = ''
@@ -182,6 +183,10 @@ class WikiPageTreeBlockProcessor(markdown.blockprocessors.BlockProcessor):
     """
     regex = re.compile(r'^\{PageTree(?::(\d+))?(?: (.+))?\}$')
 
+    def __init__(self, parser, extension=None):
+        markdown.blockprocessors.BlockProcessor.__init__(self, parser)
+        self.extension = extension
+
     def test(self, parent, block):
         """
         Check the given block to see if it should be processed with `run`
@@ -206,6 +211,8 @@ class WikiPageTreeBlockProcessor(markdown.blockprocessors.BlockProcessor):
         """
         block = blocks.pop(0)
         m = self.regex.match(block)
+        if self.extension is not None:
+            self.extension.live_content = True
         tree_depth = m.group(1)
         try:  # convert optional depth argument to integer
             tree_depth = int(tree_depth)
@@ -351,6 +358,8 @@ class ForgeWikiExtension(markdown.Extension):
     include_end_pattern = re.compile(ur'([^¶]*)¶¶¶end-include¶¶¶(.*)')
 
     def extendMarkdown(self, md, md_globals):
+        md.registerExtension(self)
+        self.reset()
         # includes
         include_preprocessor = WikiPageIncludePreprocessor(md, self)
         md.preprocessors.add('forgewiki_include',
@@ -376,10 +385,18 @@ class ForgeWikiExtension(markdown.Extension):
         md.treeprocessors.add('toc', table_of_contents_tree_processor,
                               '<prettify')
         # {PageTree}
-        page_tree_block_processor = WikiPageTreeBlockProcessor(md.parser)
+        page_tree_block_processor = WikiPageTreeBlockProcessor(
+            md.parser, self)
         md.parser.blockprocessors.add("forgewiki_pagetree",
                                       page_tree_block_processor, '_begin')
 
+    def reset(self):
+        self.live_content = False
+
+    def is_cacheable(self):
+        """Included pages and page trees are not known to the cache"""
+        return not self.live_content
+
 
 # Types and Utilities
 
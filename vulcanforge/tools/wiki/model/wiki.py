@@ -96,6 +96,8 @@ class Page(VersionedArtifact, ExchangeableArtifact):
         history_class = PageHistory
         indexes = ['title', ('title', 'app_config_id', 'deleted')]
 
+    counted = True
+
     title = FieldProperty(str)
     text = FieldProperty(schema.String, if_missing='')
     viewable_by = FieldProperty([str])
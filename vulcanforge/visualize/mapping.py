@@ -1,13 +1,13 @@
 import hashlib
 import logging
 import mimetypes
-from pygments.lexers import get_lexer_for_filename
 import re
 import time
 
 from pylons import app_globals as g
 import pymongo
 
+from vulcanforge.config.render.highlight import lexers
 from vulcanforge.visualize.model import VisualizerConfig, ProcessingStatus
 
 
@@ -207,11 +207,8 @@ class VisualizerConfigMapper(object):
             mtype = mimetypes.guess_type(filename)[0]
             if mtype is None:
                 # fallback: pygments lexer detection
-                try:
-                    l = get_lexer_for_filename(filename)
-                    if l.mimetypes:
-                        mtype = l.mimetypes[0]
-                except:
-                    pass
+                l = lexers.for_filename(filename)
+                if l is not None and l.mimetypes:
+                    mtype = l.mimetypes[0]
         return mtype
 
@@ -7,6 +7,7 @@ __init__.py
 """
 
 
+import json
 import multiprocessing
 
 
@@ -55,6 +56,9 @@ INCOMING_MESSAGE_SCHEMA = {
     },
     "additionalProperties": False
 }
+# published on a user's channel, or on "system" for everyone, to make
+# connections forget the channel authorizations they have cached
+AUTHORIZATION_CHANGED = 'AuthorizationChanged'
 DEFAULT_SERVER_CONFIG = {
     'websocket.host': 'localhost',
     'websocket.port': 8002,
@@ -82,3 +86,8 @@ def load_auth_broker(config):
     modulename, classname = path.rsplit(':', 1)
     module = __import__(modulename, fromlist=[classname])
     return getattr(module, classname)
+
+
+def publish_authorization_change(redis_client, username=None):
+    channel = 'user.{}'.format(username) if username else 'system'
+    redis_client.publish(channel, json.dumps({'type': AUTHORIZATION_CHANGED}))
@@ -5,8 +5,10 @@ authorization
 
 @author: U{tannern<tannern@gmail.com>}
 """
+from cookielib import DefaultCookiePolicy
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from webob import Request
 from vulcanforge.common.exceptions import ImproperlyConfigured
 from vulcanforge.websocket.exceptions import NotAuthorized, NotAuthenticated
@@ -35,12 +37,31 @@ class BaseWebSocketAuthBroker(object):
 
 
 class WebSocketAuthBroker(BaseWebSocketAuthBroker):
+    _session = None
 
     def __init__(self, environ, config):
         super(WebSocketAuthBroker, self).__init__(environ, config)
         self.auth_api_root = config.get('websocket.auth_api_root')
         self.request = Request(environ)
 
+    @classmethod
+    def get_session(cls, config):
+        """HTTP session with a pool of keep-alive connections to the auth
+        api, shared by all connections of the server process.
+
+        """
+        if cls._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=int(config.get('websocket.auth_pool_size', 50)))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # each request carries its user's cookie; never keep any
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            cls._session = session
+        return cls._session
+
     def authenticate(self):
         response = self._call_api_method('authenticate')
         if response.status_code != 200:
@@ -103,6 +124,6 @@ class WebSocketAuthBroker(BaseWebSocketAuthBroker):
         url = '{}/{}?_session_id={}'.format(self.auth_api_root,
                                             method_name,
                                             session_id)
-        return requests.post(url, headers=self._get_headers(), data=data,
-                             verify=False)
+        return self.get_session(self.config).post(
+            url, headers=self._get_headers(), data=data, verify=False)
 
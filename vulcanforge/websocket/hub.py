@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+hub
+
+Fans messages out from one redis pub/sub connection per server process to the
+websocket connections subscribed to them.
+"""
+import logging
+from collections import defaultdict
+import gevent
+import gevent.queue
+
+
+LOG = logging.getLogger(__name__)
+
+
+class PubSubHub(object):
+    """
+    Holds a single redis subscription per channel for the whole process and
+    routes each message to the in-memory queue of every `Subscription` to
+    that channel.
+
+    Channels are subscribed in redis when their first subscriber arrives and
+    unsubscribed when their last one leaves. Pinned channels stay subscribed
+    so the redis connection is never released.
+    """
+    pinned_channels = ('system',)
+
+    def __init__(self, redis_client, queue_size=1000):
+        self.redis = redis_client
+        self.queue_size = queue_size
+        self.subscribers = defaultdict(set)
+        self.pubsub = None
+        self.counts = dict(messages=0, deliveries=0, dropped=0)
+        self._listener = None
+
+    def subscription(self):
+        """Create the pub/sub client of a new websocket connection"""
+        self.start()
+        return Subscription(self)
+
+    def start(self):
+        if self._listener is None or self._listener.dead:
+            self._listener = gevent.spawn(self._listen)
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.kill()
+            self._listener = None
+
+    def add(self, channel, subscription):
+        subscribers = self.subscribers[channel]
+        subscribers.add(subscription)
+        if len(subscribers) == 1 and channel not in self.pinned_channels \
+                and self.pubsub is not None:
+            self.pubsub.subscribe([channel])
+
+    def remove(self, channel, subscription):
+        subscribers = self.subscribers.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self.subscribers[channel]
+            if channel not in self.pinned_channels \
+                    and self.pubsub is not None:
+                self.pubsub.unsubscribe([channel])
+
+    def _listen(self):
+        while True:
+            self.pubsub = self.redis.pubsub()
+            try:
+                # channels added while disconnected are subscribed here
+                channels = set(self.pinned_channels)
+                channels.update(self.subscribers.keys())
+                self.pubsub.subscribe(list(channels))
+                for message in self.pubsub.listen():
+                    if message['type'] in ('message', 'pmessage'):
+                        self.dispatch(message)
+            except gevent.GreenletExit:
+                raise
+            except Exception:
+                LOG.exception("pub/sub hub connection failed")
+            finally:
+                pubsub, self.pubsub = self.pubsub, None
+                try:
+                    pubsub.reset()
+                except Exception:
+                    pass
+            gevent.sleep(1)
+
+    def dispatch(self, message):
+        self.counts['messages'] += 1
+        for subscription in list(self.subscribers.get(message['channel'], ())):
+            # each connection gets its own copy to mangle
+            subscription.put(dict(message))
+
+    def stats(self):
+        return dict(self.counts,
+                    channels=len(self.subscribers),
+                    subscriptions=sum(
+                        len(s) for s in self.subscribers.itervalues()))
+
+
+class Subscription(object):
+    """
+    A connection's subscriptions through the hub, with the interface of a
+    redis PubSub: `subscribe`, `unsubscribe` and a blocking `listen`.
+    Subscribe and unsubscribe acknowledgements are generated locally.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.channels = set()
+        self.queue = gevent.queue.Queue(maxsize=hub.queue_size)
+        self.closed = False
+
+    def subscribe(self, channels):
+        if isinstance(channels, basestring):
+            channels = [channels]
+        for channel in channels:
+            if channel not in self.channels:
+                self.channels.add(channel)
+                self.hub.add(channel, self)
+            self._acknowledge('subscribe', channel)
+
+    def unsubscribe(self, channels=None):
+        if isinstance(channels, basestring):
+            channels = [channels]
+        if not channels:
+            channels = list(self.channels)
+        for channel in channels:
+            if channel in self.channels:
+                self.channels.discard(channel)
+                self.hub.remove(channel, self)
+            self._acknowledge('unsubscribe', channel)
+
+    def _acknowledge(self, kind, channel):
+        self.put({
+            'type': kind,
+            'pattern': None,
+            'channel': channel,
+            'data': len(self.channels)
+        })
+
+    def put(self, message):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except gevent.queue.Full:
+            # a stalled client must not hold up the others
+            self.hub.counts['dropped'] += 1
+            LOG.warn("dropped message on %s for a slow connection",
+                     message.get('channel'))
+        else:
+            self.hub.counts['deliveries'] += 1
+
+    def listen(self):
+        while not self.closed:
+            message = self.queue.get()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        if self.closed:
+            return
+        for channel in self.channels:
+            self.hub.remove(channel, self)
+        self.channels.clear()
+        self.closed = True
+        # wake up the listener
+        self.queue.queue.clear()
+        self.queue.put_nowait(None)
@@ -6,6 +6,7 @@ reactor
 @author: U{tannern<tannern@gmail.com>}
 """
 import json
+import time
 import jsonschema
 from paste.deploy.converters import asint
 from vulcanforge.common.util.filesystem import import_object
@@ -36,6 +37,10 @@ class MessageReactor(object):
     """
     One reactor created for each connection. Incoming messages from the client
     are passed to the `react` method.
+
+    Granted authorizations are remembered per channel for
+    `websocket.auth_cache_ttl` seconds, so only channels not yet authorized
+    are sent to the auth broker.
     """
     incoming_message_schema = INCOMING_MESSAGE_SCHEMA
 
@@ -46,6 +51,8 @@ class MessageReactor(object):
         self.pubsub = pubsub_client
         self.auth = auth
         self.event_queue = _make_event_queue(config)
+        self.auth_cache_ttl = asint(config.get('websocket.auth_cache_ttl', 60))
+        self.authorized = {}
 
     def react(self, message):
         """
@@ -102,9 +109,30 @@ class MessageReactor(object):
         trigger = message.get('trigger')
         if trigger:
             event_targets.update(trigger['targets'])
+        now = time.time()
+        listen_channels = self._unauthorized('listen', listen_channels, now)
+        publish_channels = self._unauthorized(
+            'publish', publish_channels, now)
+        event_targets = self._unauthorized('target', event_targets, now)
+        if not (listen_channels or publish_channels or event_targets):
+            return
         self.auth.authorize(listen_channels=listen_channels,
                             publish_channels=publish_channels,
                             event_targets=event_targets)
+        expires = now + self.auth_cache_ttl
+        for kind, names in (('listen', listen_channels),
+                            ('publish', publish_channels),
+                            ('target', event_targets)):
+            for name in names:
+                self.authorized[kind, name] = expires
+
+    def _unauthorized(self, kind, names, now):
+        return set(name for name in names
+                   if self.authorized.get((kind, name), 0) <= now)
+
+    def clear_authorizations(self):
+        """Forget granted authorizations, e.g. when the user's roles change"""
+        self.authorized.clear()
 
     def subscribe(self, channels):
         self.pubsub.subscribe(channels)
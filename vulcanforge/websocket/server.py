@@ -16,9 +16,10 @@ import gevent.pool
 from gevent.pywsgi import WSGIServer
 import geventwebsocket
 from geventwebsocket.handler import WebSocketHandler
-from vulcanforge.websocket import load_auth_broker
+from vulcanforge.websocket import load_auth_broker, AUTHORIZATION_CHANGED
 from vulcanforge.websocket.exceptions import WebSocketException, \
     LostConnection, InvalidMessageException, NotAuthorized, NotAuthenticated
+from vulcanforge.websocket.hub import PubSubHub
 from vulcanforge.websocket.reactor import MessageReactor
 
 
@@ -33,13 +34,16 @@ class WebSocketApp(object):
         self.redis = redis.Redis(host=config['redis.host'],
                                  port=asint(config.get('redis.port', 6379)),
                                  db=asint(config.get('redis.db', 0)))
+        self.hub = PubSubHub(
+            self.redis,
+            queue_size=asint(config.get('websocket.queue_size', 1000)))
 
     def __call__(self, environ, start_response):
         LOG.debug("new connection")
         websocket = environ.get('wsgi.websocket')
         if websocket is None:
             return self._http_handler(environ, start_response)
-        pubsub = self.redis.pubsub()
+        pubsub = self.hub.subscription()
         auth_broker_class = load_auth_broker(self.config)
         broker = auth_broker_class(environ, self.config)
         reactor = MessageReactor(environ, self.config, broker, self.redis,
@@ -50,6 +54,7 @@ class WebSocketApp(object):
         try:
             controller.authenticate()
         except NotAuthenticated:
+            pubsub.close()
             LOG.debug("closed connection")
             return
         group = gevent.pool.Group()
@@ -73,6 +78,7 @@ class WebSocketApp(object):
             break_out()
         finally:
             group.kill()
+            pubsub.close()
             websocket.close()
             LOG.debug("closed connection")
 
@@ -118,7 +124,8 @@ class ConnectionController(object):
                 **self.connection_info)
             self._increment_count()
             self._extend_count_expire()
-            self.pubsub.subscribe(channels)
+            # the user channel carries authorization changes
+            self.pubsub.subscribe(channels + [self._user_channel_key])
 
     def _loop(self, method):
         try:
@@ -163,8 +170,23 @@ class ConnectionController(object):
     def _speak_frame(self):
         for message in self.pubsub.listen():
             message.pop('pattern', None)
+            if self._is_authorization_change(message):
+                self.reactor.clear_authorizations()
+                continue
             self.send(message)
 
+    def _is_authorization_change(self, message):
+        if message.get('type') != 'message':
+            return False
+        data = message.get('data')
+        if not isinstance(data, basestring) or \
+                AUTHORIZATION_CHANGED not in data:
+            return False
+        try:
+            return json.loads(data).get('type') == AUTHORIZATION_CHANGED
+        except (ValueError, AttributeError):
+            return False
+
     def send(self, message):
         self._extend_count_expire()
         try: